@@ -0,0 +1,114 @@
+"""A micro-benchmark of the restart checkpoints versus the ensembles.
+
+Each step changes the accumulated weights (frac) of all but the locked
+paths, retires a path and draws random numbers, as in a run, and the
+[current] section is saved either by rewriting restart.toml ("toml") or
+by appending to its log ("log", see infretis.checkpoint). The time
+includes turning the weights into strings, which the writers only do
+for the weights they write. The load time is that of restart.toml and
+its log at the end.
+
+Usage: python benchmark_checkpoint.py [steps]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tomli
+
+from infretis.checkpoint import (
+    CheckpointLog,
+    frac_table,
+    load_checkpoint,
+    write_restart,
+)
+
+
+def make_config(n_intf, workers):
+    """Return a config like that of a run with n_intf interfaces."""
+    return {
+        "simulation": {
+            "interfaces": list(np.linspace(0, 1, n_intf)),
+            "steps": 10**9,
+            "seed": 0,
+            "shooting_moves": ["wf"] * n_intf,
+        },
+        "runner": {"workers": workers},
+        "output": {"screen": 1, "delete_old": True},
+        "current": {
+            "traj_num": n_intf,
+            "cstep": 0,
+            "active": list(range(n_intf)),
+            "locked": [],
+            "size": n_intf,
+            "frac": {},
+            "wsubcycles": [0] * workers,
+            "tsubcycles": 0,
+        },
+    }
+
+
+def step(config, fracs, rgen, workers):
+    """Change the [current] section and the weights as in a step."""
+    current = config["current"]
+    n = current["size"] + 1
+    current["cstep"] += 1
+    retired = int(rgen.integers(len(current["active"])))
+    current["active"][retired] = current["traj_num"]
+    current["traj_num"] += 1
+    current["locked"] = [
+        [[i], [str(j)]] for i, j in enumerate(current["active"][: workers - 1])
+    ]
+    current["rng_state"] = rgen.bit_generator.state
+    locked = {lock[1][0] for lock in current["locked"]}
+    old = dict(fracs)
+    fracs.clear()
+    for pn in current["active"]:
+        frac = old.get(str(pn), np.zeros(n, dtype=np.longdouble))
+        if str(pn) not in locked:
+            frac = frac + rgen.random(n).astype(np.longdouble)
+        fracs[str(pn)] = frac
+
+
+def run(n_intf, steps, workers=4, compact=100):
+    """Return the time per step of the formats and the load time."""
+    times = {}
+    for fmt in ("toml", "log"):
+        rgen = np.random.default_rng(0)
+        config = make_config(n_intf, workers)
+        checkpoint = CheckpointLog("restart.toml", compact)
+        fracs = {}
+        elapsed = 0.0
+        for _ in range(steps):
+            step(config, fracs, rgen, workers)
+            start = time.perf_counter()
+            if fmt == "toml":
+                write_restart(config, dict(fracs), "restart.toml")
+            else:
+                checkpoint.write(config, dict(fracs))
+            elapsed += time.perf_counter() - start
+        times[fmt] = elapsed / steps
+
+    start = time.perf_counter()
+    with open("restart.toml", mode="rb") as f:
+        loaded = tomli.load(f)
+    load_checkpoint(loaded, "restart.toml")
+    times["load"] = time.perf_counter() - start
+    config["current"]["frac"] = frac_table(fracs)
+    assert loaded == config
+    return times
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print("ensembles  toml (ms)  log (ms)  load (ms)")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        for n_intf in (8, 16, 32, 64, 128):
+            times = run(n_intf, steps)
+            print(
+                f"{n_intf + 1:9d} {times['toml'] * 1e3:10.3f}"
+                f" {times['log'] * 1e3:9.3f} {times['load'] * 1e3:10.2f}"
+            )
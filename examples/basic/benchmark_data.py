@@ -0,0 +1,58 @@
+"""A micro-benchmark of reading infretis_data.txt and its binary file.
+
+Random rows are written for 8 ensembles with the DataWriter, as in a
+run with data_binary = true, and read back with read_data from the text
+and from the binary file.
+
+Usage: python benchmark_data.py [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from infretis.data import DataWriter, data_dtype, read_data
+
+SIZE = 8
+
+
+def write_rows(n_rows, chunk=10000):
+    """Write n_rows random rows to infretis_data.txt and its binary file."""
+    with open("infretis_data.txt", "w", encoding="utf-8") as write:
+        ens_str = "\t".join([f"{i:03.0f}" for i in range(SIZE)])
+        write.write("# " + f"\txxx\tlen\tmax OP\t\t{ens_str}\n")
+    writer = DataWriter("infretis_data.txt", SIZE, flush=60.0, binary=True)
+    rgen = np.random.default_rng(0)
+    for start in range(0, n_rows, chunk):
+        rows = np.zeros(min(chunk, n_rows - start), dtype=data_dtype(SIZE))
+        rows["pn"] = np.arange(start, start + len(rows))
+        rows["length"] = rgen.integers(10, 1000, len(rows))
+        rows["max_op"] = rgen.random(len(rows))
+        rows["frac"] = rgen.random((len(rows), SIZE))
+        rows["weights"] = rgen.random((len(rows), SIZE))
+        lines = [
+            f"\t{row['pn']:3.0f}\t{row['length']:5.0f}\t"
+            f"{row['max_op']:8.5f}\t"
+            + "\t".join(str(i) for i in row["frac"])
+            + "\t"
+            + "\t".join(str(i) for i in row["weights"])
+            + "\t\n"
+            for row in rows
+        ]
+        writer.write(lines, rows)
+    writer.flush()
+
+
+if __name__ == "__main__":
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        write_rows(n_rows)
+        for binary in (False, True):
+            start = time.perf_counter()
+            rows = read_data("infretis_data.txt", binary=binary)
+            elapsed = time.perf_counter() - start
+            name = "binary" if binary else "text"
+            print(f"{name:6s} {len(rows):9d} rows {elapsed:8.3f} s")
@@ -0,0 +1,257 @@
+"""A benchmark suite of the REPEX P matrix calculations.
+
+Random W matrices are made for a number of ensembles and workers:
+
+    equal: staircases with equal weights in each ensemble
+    wf: staircases with random weights, as from wire fencing
+    wide: like wf, but the paths reach further, giving larger blocks
+
+In each W matrix the ensembles of `workers - 1` running moves are
+locked. The timings of inf_retis, quick_prob (and the one ensemble at
+a time quick_prob_loop), permanent_prob, random_prob and pick are
+stored as JSON, and can be compared with the JSON of an earlier run,
+e.g. of the last release:
+
+    python benchmark_repex.py -o new.json --compare old.json
+
+The P matrices are calculated with `prob_precision = "longdouble"`,
+and `--precision float64` times the float64 precision instead.
+"""
+import argparse
+import json
+import platform
+import time
+from importlib import metadata
+
+import numpy as np
+
+from infretis.classes.path import Path
+from infretis.classes.repex import REPEX_state
+
+SIZES = (8, 12, 16, 20, 50, 100)
+WORKERS = (1, 4)
+KINDS = ("equal", "wf", "wide")
+
+
+def make_state(n, precision="longdouble"):
+    """Return a REPEX state for n ensembles, without P matrix caches."""
+    config = {
+        "current": {"size": n - 1, "cstep": 0},
+        "runner": {"workers": 1},
+        "simulation": {
+            "seed": 0,
+            "steps": 10,
+            "zeroswap": 0.0,
+            "pick_scheme": 0,
+            "prob_cache": 0,
+            "prob_precision": precision,
+        },
+        "output": {"screen": 0},
+    }
+    state = REPEX_state(config, minus=True)
+    state.ensembles = {i: {} for i in range(n)}
+    return state
+
+
+def make_w_matrix(rgen, n, kind):
+    """Return a W matrix with a minus ensemble for n ensembles."""
+    reach = {"equal": 0.75, "wf": 0.75, "wide": 0.9}[kind]
+    w_matrix = np.zeros((n, n))
+    w_matrix[0, 0] = 1.0
+    for i in range(1, n):
+        top = i
+        while top < n - 1 and rgen.random() < reach:
+            top += 1
+        if kind == "equal":
+            w_matrix[i, 1 : top + 1] = 1.0
+        else:
+            w_matrix[i, 1 : top + 1] = rgen.random(top) * 10 ** rgen.uniform(
+                0, 2, top
+            )
+    return w_matrix
+
+
+def make_locks(rgen, n, workers):
+    """Return the locks of the ensembles of workers - 1 running moves."""
+    locks = np.zeros(n)
+    locks[rgen.choice(np.arange(1, n), workers - 1, replace=False)] = 1
+    return locks
+
+
+def timing(func, repeats, setup=None):
+    """Return the best and mean time of a number of calls of func."""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def largest_block(state, w_matrix):
+    """Return the largest block of a W matrix, as in inf_retis."""
+    offset = state._offset
+    sorted_w = w_matrix[state.sort_rows(w_matrix, offset)]
+    blocks = state.find_blocks(sorted_w, offset=offset)
+    start, stop, direction = max(blocks, key=lambda block: block[1] - block[0])
+    if direction == -1:
+        cstop = start - 1 if start > 0 else None
+        return sorted_w[start:stop, stop - 1 : cstop : -1]
+    return sorted_w[start:stop, start:stop]
+
+
+def bench_pick(state, w_matrix, locks, repeats):
+    """Time pick() on a state with the W matrix and locks."""
+    for i in range(state.n):
+        path = Path()
+        path.path_number = i
+        state._trajs[i] = path
+    # pick swaps the rows of the state in place
+    state.state = w_matrix.copy()
+
+    def setup():
+        state._locks = locks.copy()
+        state._last_prob = None
+        state.locked = []
+        state.prob
+
+    return timing(state.pick, repeats, setup=setup)
+
+
+def run(repeats, precision="longdouble"):
+    """Run the benchmarks and return the results."""
+    rgen = np.random.default_rng(0)
+    results = []
+
+    def add(name, kind, n, workers, bench, **kwargs):
+        best, mean = bench(**kwargs)
+        results.append(
+            {
+                "name": name,
+                "kind": kind,
+                "n": n,
+                "workers": workers,
+                "best": best,
+                "mean": mean,
+            }
+        )
+        print(
+            f"{name:15s} {kind:6s} {n:4d} {workers:3d}"
+            f" {best * 1e3:10.3f} {mean * 1e3:10.3f}"
+        )
+
+    print("name            kind      n   w  best (ms)  mean (ms)")
+    for n in SIZES:
+        for kind in KINDS:
+            w_matrix = make_w_matrix(rgen, n, kind)
+            state = make_state(n, precision)
+            for workers in WORKERS:
+                locks = make_locks(rgen, n, workers)
+                add(
+                    "inf_retis",
+                    kind,
+                    n,
+                    workers,
+                    timing,
+                    func=lambda: state.inf_retis(w_matrix, locks),
+                    repeats=repeats,
+                )
+                add(
+                    "pick",
+                    kind,
+                    n,
+                    workers,
+                    bench_pick,
+                    state=state,
+                    w_matrix=w_matrix,
+                    locks=locks,
+                    repeats=repeats,
+                )
+            block = largest_block(state, w_matrix)
+            if kind == "equal":
+                for name in ("quick_prob", "quick_prob_loop"):
+                    add(
+                        name,
+                        kind,
+                        n,
+                        1,
+                        timing,
+                        func=lambda: getattr(state, name)(w_matrix[1:, 1:]),
+                        repeats=repeats,
+                    )
+            elif len(block) <= 12:
+                add(
+                    "permanent_prob",
+                    kind,
+                    len(block),
+                    1,
+                    timing,
+                    func=lambda: state.permanent_prob(block),
+                    repeats=repeats,
+                )
+            if kind == "wide" and len(block) > 12:
+                add(
+                    "random_prob",
+                    kind,
+                    len(block),
+                    1,
+                    timing,
+                    func=lambda: state.random_prob(block),
+                    repeats=max(repeats // 5, 1),
+                )
+    return results
+
+
+def compare(results, old_results, threshold=1.2):
+    """Print the change of the best times relative to an earlier run."""
+    old = {
+        (i["name"], i["kind"], i["n"], i["workers"]): i["best"]
+        for i in old_results
+    }
+    print("\nname            kind      n   w   old/new")
+    for item in results:
+        key = (item["name"], item["kind"], item["n"], item["workers"])
+        if key not in old:
+            continue
+        ratio = old[key] / item["best"]
+        flag = "  slower" if ratio * threshold < 1 else ""
+        print(
+            f"{item['name']:15s} {item['kind']:6s} {item['n']:4d}"
+            f" {item['workers']:3d} {ratio:9.2f}{flag}"
+        )
+
+
+def versions():
+    """Return the versions of infretis, numpy and python."""
+    try:
+        infretis_version = metadata.version("infretis")
+    except metadata.PackageNotFoundError:
+        infretis_version = "unknown"
+    return {
+        "infretis": infretis_version,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-o", "--output", default="benchmark_repex.json")
+    parser.add_argument("-r", "--repeats", type=int, default=10)
+    parser.add_argument("--compare", help="the JSON of an earlier run")
+    parser.add_argument(
+        "--precision", default="longdouble", choices=("longdouble", "float64")
+    )
+    args = parser.parse_args()
+
+    results = run(args.repeats, args.precision)
+    with open(args.output, "w", encoding="utf-8") as write:
+        json.dump(
+            {"versions": versions(), "results": results}, write, indent=2
+        )
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as read:
+            compare(results, json.load(read)["results"])
@@ -0,0 +1,42 @@
+"""A micro-benchmark of the runner submission and dispatch overhead."""
+import time
+
+from infretis.asyncrunner import aiorunner, future_list
+
+
+def return_data(inp: dict):
+    """Return data."""
+    inp["0"] += 1
+    return inp
+
+
+if __name__ == "__main__":
+    n_workers = 4
+    runner = aiorunner({}, n_workers=n_workers)
+    runner.set_task(return_data)
+    runner.start()
+    futures = future_list()
+
+    # warm up the worker processes before timing
+    for i in range(n_workers):
+        futures.add(runner.submit_work({"0": 0}))
+    for i in range(n_workers):
+        futures.as_completed()
+
+    for i in range(n_workers):
+        futures.add(runner.submit_work({"0": 0}))
+
+    it = 0
+    nit = 2000
+    start = time.perf_counter()
+    while it < nit:
+        items = futures.as_completed().result()
+        if it < nit - n_workers:
+            futures.add(runner.submit_work(items))
+        it += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"{nit} tasks with {n_workers} workers in {elapsed:.2f} s")
+    print(f"{nit / elapsed:.1f} tasks/second")
+
+    runner.stop()
@@ -0,0 +1,100 @@
+"""A micro-benchmark of REPEX_state.treat_output versus the ensembles.
+
+The paths are synthetic, with random weights in a staircase like in a
+TIS simulation, and each step picks an ensemble, changes the weights of
+the picked path and treats the rejected move. The time of a step is
+mostly the P matrix, which is shown with and without the caches of
+the P matrices and their blocks.
+
+Usage: python benchmark_treat_output.py [steps]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from infretis.classes.path import Path
+from infretis.classes.repex import REPEX_state
+
+
+def setup_state(n_intf, seed=0):
+    """Return a REPEX state with synthetic paths for n_intf interfaces."""
+    config = {
+        "current": {
+            "size": n_intf,
+            "cstep": 0,
+            "traj_num": n_intf,
+            "wsubcycles": [0],
+            "tsubcycles": 0,
+        },
+        "runner": {"workers": 1},
+        "simulation": {
+            "seed": seed,
+            "steps": 10**9,
+            "zeroswap": 0.5,
+            "pick_scheme": 0,
+            "interfaces": list(np.linspace(0, 1, n_intf)),
+            "load_dir": "load",
+            "tis_set": {"lambda_minus_one": False},
+            "shooting_moves": ["sh"] * n_intf,
+        },
+        "output": {"screen": 0, "delete_old": False},
+    }
+    state = REPEX_state(config, minus=True)
+    state.initiate_ensembles()
+    rgen = np.random.default_rng(seed)
+    for i in range(-1, n_intf - 1):
+        path = Path()
+        path.path_number = i + 1
+        path.weights = random_weights(rgen, i, n_intf)
+        state.add_traj(ens=i, traj=path, valid=path.weights, count=False)
+        state.traj_data[i + 1] = {
+            "weights": path.weights,
+            "frac": np.zeros(state.n, dtype="longdouble"),
+        }
+    return state, rgen
+
+
+def random_weights(rgen, ens, n_intf):
+    """Return random weights for a path from ensemble ens."""
+    if ens == -1:
+        return (1.0,)
+    # the path crosses the next interface with probability 0.75
+    top = min(ens + int(rgen.random() < 0.75), n_intf - 1)
+    weights = np.zeros(n_intf)
+    weights[: top + 1] = rgen.integers(1, 100, top + 1)
+    return tuple(weights)
+
+
+def run(n_intf, steps, reuse=True):
+    """Return the time per step and the P matrix calculations per step."""
+    state, rgen = setup_state(n_intf)
+    if not reuse:
+        state.prob_cache = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        state.cstep += 1
+        picked = state.pick()
+        for ens_num, item in picked.items():
+            item["traj"].weights = random_weights(rgen, ens_num, n_intf)
+        md_items = {"picked": picked, "status": "REJ", "pin": 0}
+        md_items["subcycles"] = 1
+        state.treat_output(md_items)
+    elapsed = time.perf_counter() - start
+    return elapsed / steps, state.n_prob / steps
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print("ensembles  step (ms)  no reuse (ms)  P matrices/step")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        for n_intf in (8, 12, 16, 20, 24, 32):
+            step, n_prob = run(n_intf, steps)
+            step_noreuse, _ = run(n_intf, steps, reuse=False)
+            print(
+                f"{n_intf + 1:9d} {step * 1e3:10.2f}"
+                f" {step_noreuse * 1e3:14.2f} {n_prob:16.2f}"
+            )
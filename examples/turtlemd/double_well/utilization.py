@@ -0,0 +1,71 @@
+"""Measure the worker utilization with and without speculative moves.
+
+The double well example is run for a number of `workers` and
+`speculative` settings in temporary folders. The utilization is the
+number of MD steps in moves that were used per second and per worker
+process, relative to a single worker without speculation.
+
+Usage: python utilization.py [steps]
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomli
+import tomli_w
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SETTINGS = [(1, 0), (2, 0), (4, 0), (7, 0), (4, 3), (7, 4), (7, 8)]
+
+
+def run(workers, speculative, steps):
+    """Run the example and return wall time, used steps and log."""
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("infretis.toml", "orderp.py"):
+            shutil.copy(os.path.join(HERE, name), tmp)
+        shutil.copytree(
+            os.path.join(HERE, "load_copy"), os.path.join(tmp, "load")
+        )
+        with open(os.path.join(tmp, "infretis.toml"), "rb") as read:
+            config = tomli.load(read)
+        config["runner"]["workers"] = workers
+        config["runner"]["speculative"] = speculative
+        config["runner"]["wmdrun"] = ["not used"] * (workers + speculative)
+        config["simulation"]["steps"] = steps
+        with open(os.path.join(tmp, "infretis.toml"), "wb") as write:
+            tomli_w.dump(config, write)
+
+        start = time.perf_counter()
+        subprocess.run(
+            ["infretisrun", "-i", "infretis.toml"],
+            cwd=tmp,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wall = time.perf_counter() - start
+        with open(os.path.join(tmp, "sim.log")) as read:
+            log = read.read()
+    used = sum(int(i) for i in re.findall(r"subcycles: (\d+)", log))
+    return wall, used, log
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_ens = 8
+    baseline = None
+    print("workers speculative workers/n_ens  wall (s)  utilization  spec")
+    for workers, speculative in SETTINGS:
+        wall, used, log = run(workers, speculative, steps)
+        rate = used / wall / (workers + speculative)
+        baseline = baseline or rate
+        spec = re.search(r"speculative moves: (.*)", log)
+        print(
+            f"{workers:7d} {speculative:11d} {workers / n_ens:13.2f}"
+            f" {wall:9.1f} {rate / baseline:12.2f}"
+            f"  {spec.group(1) if spec else '-'}"
+        )
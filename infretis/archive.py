@@ -0,0 +1,94 @@
+"""Archiving of the accepted paths in a background thread.
+
+When a path is accepted its order, energy and traj files are written to
+the load directory and its trajectories are moved there, with
+`delete_old` the files of old paths are removed, and restart.toml (or
+its log) is written, see
+:py:meth:`infretis.classes.repex.REPEX_state.treat_output`. On network
+file systems this can take long, and it can be done in a background
+thread, set in the [output] section:
+
+    [output]
+    archive_async = true
+
+The file operations are done one at a time in the order they are
+submitted, and the checkpoint of a step is submitted after the files
+of the step, so it never refers to files that are not archived yet.
+The scheduler does not wait for them, and the next move is dispatched
+right away. Only the trajectories are moved before that, as the worker
+of the move removes the files in its directory when it starts its next
+move, which is a rename on the same file system.
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger("main")
+
+
+class Archiver:
+    """Run file operations in order, in a background thread.
+
+    If the archiver is not enabled the operations are run right away.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        """Set up the archiver.
+
+        Args:
+            enabled: if the operations are run in a background thread
+        """
+        self.enabled = enabled
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """Run func(*args) after the operations submitted before it."""
+        if not self.enabled:
+            func(*args)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((func, args))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                # keep the order, nothing runs after a failure
+                if self._error is None:
+                    func(*args)
+            except BaseException as error:
+                logger.warning(f"archiving failed: {error}")
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def wait(self) -> None:
+        """Wait for the submitted operations, raising a failure."""
+        if self._thread is not None:
+            self._queue.join()
+        self.check()
+
+    def check(self) -> None:
+        """Raise a failure of the operations done so far."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self) -> None:
+        """Wait for the submitted operations and stop the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.wait()
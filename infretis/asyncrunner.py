@@ -5,11 +5,13 @@ import concurrent.futures
 import functools
 import logging
 import multiprocessing
+import pickle
 import threading
 import time
-from asyncio import Future
 from collections.abc import Callable
-from typing import Any, Dict, List, Optional
+from concurrent.futures import Future
+from queue import Empty, SimpleQueue
+from typing import Any, Dict, List, Optional, Tuple
 
 import infretis.core.tis
 from infretis.classes.engines.factory import create_engines
@@ -18,6 +20,10 @@ from infretis.classes.orderparameter import create_orderparameters
 
 logger = logging.getLogger("")
 logger.setLevel(logging.DEBUG)
+main_logger = logging.getLogger("main")
+
+DEFAULT_MAX_RETRIES = 2
+QUEUES = ("fifo", "priority")
 
 
 class RunnerError(Exception):
@@ -26,6 +32,61 @@ class RunnerError(Exception):
     pass
 
 
+class EnsembleCosts:
+    """Predict the cost of a task from earlier tasks in the same ensembles.
+
+    The cost of a finished task is the number of MD steps it ran, or
+    the sum of the trial path lengths if the steps are not known. The
+    predicted cost of a task in the ensembles `ens_nums` is the moving
+    average of the costs of earlier tasks in the same ensembles, and
+    the average over all ensembles for ensembles not seen yet.
+    """
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        """Set up the cost model.
+
+        Args:
+            alpha: the weight of a new cost in the moving averages
+        """
+        self.alpha = alpha
+        self.costs: Dict[Tuple[int, ...], float] = {}
+
+    @staticmethod
+    def _key(work_unit: Any) -> Optional[Tuple[int, ...]]:
+        """Return the ensembles of a unit of work, if any."""
+        if not isinstance(work_unit, dict) or "ens_nums" not in work_unit:
+            return None
+        return tuple(work_unit["ens_nums"])
+
+    def predict(self, work_unit: Any) -> float:
+        """Return the predicted cost of a unit of work.
+
+        Args:
+            work_unit: a unit of work encapsulated in a dict
+        """
+        key = self._key(work_unit)
+        if key in self.costs:
+            return self.costs[key]
+        if self.costs:
+            return sum(self.costs.values()) / len(self.costs)
+        return 0.0
+
+    def update(self, result: Any) -> None:
+        """Update the averages with the cost of a finished task.
+
+        Args:
+            result: the md_items returned by a task
+        """
+        key = self._key(result)
+        if key is None:
+            return
+        cost = result.get("subcycles") or sum(result.get("trial_len", []))
+        if key in self.costs:
+            self.costs[key] += self.alpha * (cost - self.costs[key])
+        else:
+            self.costs[key] = float(cost)
+
+
 class aiorunner:
     """A light asynchronuous runner based on asyncio.
 
@@ -36,6 +97,23 @@ class aiorunner:
     instances of that function in the background.
     As work is submitted to the runner, it is picked up by
     workers on-the-fly.
+
+    With `affinity = true` in the [runner] section, each worker gets
+    its own single-process executor and its own queue. Work carrying
+    a "pin" is then always executed by the same process, such that the
+    engines created in that process (and whatever state they keep
+    between moves) stay warm for that worker.
+
+    With `queue = "priority"` in the [runner] section, waiting work is
+    dispatched longest-expected-first instead of first-in-first-out,
+    with the expected costs from :py:class:`EnsembleCosts`. Starting the
+    long tasks in the high ensembles first hides their tail latency
+    behind the short tasks.
+
+    If a worker process dies, e.g. killed by the OOM killer or crashed
+    in an external code, its executor is broken. The executor is then
+    replaced and the work is submitted again, up to `max_retries`
+    times (set in the [runner] section) before the error is passed on.
     """
 
     def __init__(self, config: Dict, n_workers: int = 1) -> None:
@@ -46,25 +124,82 @@ class aiorunner:
             n_workers: number of workers active in the runner
         """
         self._n_workers: int = n_workers
-        self._counter = multiprocessing.get_context("spawn").Value("i", 0)
-        self._executor: concurrent.futures.Executor = (
-            concurrent.futures.ProcessPoolExecutor(
-                max_workers=n_workers,
-                initializer=worker_initializer,
-                initargs=(self._counter, config),
-                mp_context=multiprocessing.get_context("spawn"),
-            )
+        self._config = config
+        self._affinity: bool = config.get("runner", {}).get("affinity", False)
+        self._max_retries: int = config.get("runner", {}).get(
+            "max_retries", DEFAULT_MAX_RETRIES
+        )
+        self.failures: List[Dict[str, Any]] = []
+        self._priority: bool = (
+            config.get("runner", {}).get("queue", "fifo") == "priority"
         )
-        self._stop_event = asyncio.Event()
+        self.costs = EnsembleCosts()
+        self._n_queued = 0
+        self._stopping = False
+        self._mp_context = multiprocessing.get_context("spawn")
+        self._counter = self._mp_context.Value("i", 0)
+        self._executors: List[concurrent.futures.Executor] = [
+            self._create_executor(i)
+            for i in range(n_workers if self._affinity else 1)
+        ]
         self._loop = asyncio.new_event_loop()
         self._thread = threading.Thread(
             target=self._start_event_loop, daemon=True
         )
         self._thread.start()
-        self._queue: asyncio.Queue[Any] = asyncio.Queue()
+        # The queues have to live in the runner's own event loop
+        self._queues: List[asyncio.Queue[Any]] = [
+            asyncio.run_coroutine_threadsafe(
+                self._create_queue(), self._loop
+            ).result()
+            for _ in self._executors
+        ]
+        self._next_queue = 0
         self._task_f: Optional[Callable] = None
         self._tasks: Optional[List[asyncio.Task[Any]]] = None
 
+    def _create_executor(self, idx: int) -> concurrent.futures.Executor:
+        """Create the process pool executor number idx.
+
+        Args:
+            idx: the index of the executor, which is the worker id when
+                using affinity
+        """
+        if self._affinity:
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=1,
+                initializer=worker_initializer,
+                initargs=(self._counter, self._config, idx),
+                mp_context=self._mp_context,
+            )
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._n_workers,
+            initializer=worker_initializer,
+            initargs=(self._counter, self._config),
+            mp_context=self._mp_context,
+        )
+
+    def _replace_executor(
+        self, idx: int, broken: concurrent.futures.Executor
+    ) -> None:
+        """Replace a broken executor, unless this was done already.
+
+        All tasks sharing a broken executor fail, but only the first
+        one to get here replaces it.
+
+        Args:
+            idx: the index of the executor
+            broken: the broken executor
+        """
+        if self._executors[idx] is not broken:
+            return
+        broken.shutdown(wait=False)
+        if not self._affinity:
+            # the new processes take over the worker numbers
+            with self._counter.get_lock():
+                self._counter.value = 0
+        self._executors[idx] = self._create_executor(idx)
+
     def start(self) -> None:
         """Launch background tasks."""
         future = asyncio.run_coroutine_threadsafe(
@@ -83,6 +218,30 @@ class aiorunner:
         asyncio.set_event_loop(self._loop)
         self._loop.run_forever()
 
+    async def _create_queue(self) -> asyncio.Queue:
+        """Create the work queue from within the event loop."""
+        if self._priority:
+            return asyncio.PriorityQueue()
+        return asyncio.Queue()
+
+    async def _put(self, queue: asyncio.Queue, item: Any) -> None:
+        """Put an item in a queue.
+
+        In a priority queue the item is preceded by the negative
+        predicted cost and a counter, such that the most expensive work
+        comes first, work of equal cost in submission order, and the
+        None sentinels last.
+
+        Args:
+            queue: the queue
+            item: a (work_unit, future) tuple or a None sentinel
+        """
+        if self._priority:
+            cost = -self.costs.predict(item[0]) if item else float("inf")
+            self._n_queued += 1
+            item = (cost, self._n_queued, item)
+        await queue.put(item)
+
     def set_task(self, task_f: Callable) -> None:
         """Attach the task function to the runner.
 
@@ -93,59 +252,119 @@ class aiorunner:
 
     async def _task_wrapper(
         self,
-        stop_event: asyncio.Event,
         queue: asyncio.Queue,
-        executor: concurrent.futures.Executor,
+        executor_idx: int,
         taskID: int,
     ) -> None:
         """Wrap the sync task.
 
         To enable running the sync task_f
-        from a dynamic list of tasks.
+        from a dynamic list of tasks. The wrapper awaits the
+        queue, so work is dispatched as soon as it is submitted,
+        and returns when it gets a None sentinel.
 
         Args:
-            stop_event: a asyncio event to stop the worker
             queue: an asyncio queue to get work from
-            executor: an executor
+            executor_idx: the index of the executor to run the work in
             taskID : an ID for the long running task
         """
-        while not stop_event.is_set():
-            try:
-                # Unpack queue element
-                md_item, future = queue.get_nowait()
+        while True:
+            # Unpack queue element
+            item = await queue.get()
+            if self._priority:
+                item = item[-1]
+            if item is None:
+                queue.task_done()
+                break
+            md_item, future = item
 
-                # Run the task in the event loop
-                assert self._task_f
-                loop = asyncio.get_running_loop()
+            # Run the task in the event loop
+            assert self._task_f
+            loop = asyncio.get_running_loop()
+            try:
+                payload = pickle.dumps(md_item)
+            except Exception as e:
+                future.set_exception(e)
+                queue.task_done()
+                continue
+            attempt = 0
+            while True:
+                executor = self._executors[executor_idx]
                 try:
-                    md_item = await loop.run_in_executor(
-                        executor, functools.partial(self._task_f, md_item)
+                    data = await loop.run_in_executor(
+                        executor,
+                        functools.partial(run_pickled, self._task_f, payload),
+                    )
+                    result = unpickle_result(data, len(payload))
+                    self.costs.update(result)
+                    future.set_result(result)
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    if self._stopping:
+                        # the runner terminated the workers itself
+                        future.set_exception(e)
+                        break
+                    # A worker process died, replace it and try again
+                    self._replace_executor(executor_idx, executor)
+                    attempt += 1
+                    self.failures.append(
+                        {
+                            "time": time.time(),
+                            "worker": taskID,
+                            "error": str(e),
+                        }
                     )
-                    future.set_result(md_item)
+                    main_logger.warning(
+                        "Worker process of task %s died (attempt %s of %s)",
+                        taskID,
+                        attempt,
+                        self._max_retries + 1,
+                    )
+                    if attempt <= self._max_retries:
+                        continue
+                    future.set_exception(e)
                 except Exception as e:
                     # Pass the exception up in the future
                     future.set_exception(e)
+                break
 
-                # Mask the task as done
-                queue.task_done()
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.02)
+            # Mask the task as done
+            queue.task_done()
 
-    async def _add_work_to_queue(
-        self, work_unit: Dict[str, Any]
-    ) -> asyncio.Future:
+    async def _add_work_to_queue(self, work_unit: Dict[str, Any]) -> Future:
         """Async function adding work to queue, returns a future.
 
+        The returned future is a thread-safe concurrent future, such
+        that it can be resolved from the event loop thread and waited
+        upon from the thread submitting the work.
+
         Args
             work_unit: a unit of work encapsulated in a dict
 
         Return:
             A future wih the results of the work
         """
-        future: asyncio.Future = asyncio.Future()
-        await self._queue.put((work_unit, future))
+        future: Future = Future()
+        await self._put(self._select_queue(work_unit), (work_unit, future))
         return future
 
+    def _select_queue(self, work_unit: Any) -> asyncio.Queue:
+        """Select the queue a unit of work is put in.
+
+        Without affinity all workers share a single queue. With
+        affinity, pinned work goes to the queue of the worker with the
+        same pin and other work is distributed round-robin.
+
+        Args
+            work_unit: a unit of work encapsulated in a dict
+        """
+        if len(self._queues) == 1:
+            return self._queues[0]
+        pin = work_unit.get("pin") if isinstance(work_unit, dict) else None
+        if not isinstance(pin, int):
+            pin = self._next_queue
+            self._next_queue += 1
+        return self._queues[pin % len(self._queues)]
+
     def submit_work(self, work_unit: Dict[str, Any]) -> Future:
         """Submit work to the runner.
 
@@ -159,10 +378,9 @@ class aiorunner:
             raise RunnerError(
                 "Unable to submit work if the tasks haven't been initiated"
             )
-        future = asyncio.run(self._add_work_to_queue(work_unit))
-        # Need to wait otherwise some race condition can occur
-        time.sleep(0.05)
-        return future
+        return asyncio.run_coroutine_threadsafe(
+            self._add_work_to_queue(work_unit), self._loop
+        ).result()
 
     async def _start_tasks(self) -> None:
         """Launch the background tasks."""
@@ -172,7 +390,9 @@ class aiorunner:
             self._tasks = [
                 asyncio.create_task(
                     self._task_wrapper(
-                        self._stop_event, self._queue, self._executor, i
+                        self._queues[i % len(self._queues)],
+                        i % len(self._executors),
+                        i,
                     )
                 )
                 for i in range(self._n_workers)
@@ -182,33 +402,106 @@ class aiorunner:
 
     async def wait_for_tasks_to_end(self) -> None:
         """Async function waiting for tasks to end."""
-        while len(asyncio.all_tasks(self._loop)) > 0:
-            await asyncio.sleep(0.1)
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _stop_tasks(self) -> None:
+        """Queue one stop sentinel per task and wait for them to end.
+
+        The sentinels are placed behind any remaining work, so all
+        submitted work is processed before the tasks return.
+        """
+        for i in range(len(self._tasks or [])):
+            await self._put(self._queues[i % len(self._queues)], None)
+        await self.wait_for_tasks_to_end()
+
+    async def _cancel_tasks(self) -> None:
+        """Cancel the tasks and wait for them to end."""
+        for task in self._tasks or []:
+            task.cancel()
+        await asyncio.gather(*(self._tasks or []), return_exceptions=True)
 
     def n_workers(self) -> int:
         """Return runner number of workers."""
         return self._n_workers
 
-    def stop(self) -> None:
-        """Terminate the runner."""
-        # Make sure there is no more work in the queue
-        # before dispatching the task stopping event
-        while self._queue.qsize() > 0:
-            time.sleep(0.1)
+    def stop(self, wait: bool = True) -> None:
+        """Terminate the runner.
 
-        # Stop ongoing tasks
-        self._stop_event.set()
-
-        # Wait until all tasks are done
-        asyncio.run(self.wait_for_tasks_to_end())
+        Args:
+            wait: if True, process the remaining work first. Otherwise
+                the queued work is dropped and the worker processes are
+                terminated, killing the tasks they are running.
+        """
+        if not wait:
+            self._stopping = True
+            for executor in self._executors:
+                processes = list(getattr(executor, "_processes", {}).values())
+                executor.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    process.terminate()
+            asyncio.run_coroutine_threadsafe(
+                self._cancel_tasks(), self._loop
+            ).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            return
+
+        # Process the remaining work and stop ongoing tasks
+        asyncio.run_coroutine_threadsafe(
+            self._stop_tasks(), self._loop
+        ).result()
 
         # Close the event loop
         self._loop.call_soon_threadsafe(self._loop.stop)
         self._thread.join()
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+
+
+def run_pickled(task_f: Callable, payload: bytes) -> bytes:
+    """Run a task on a pickled unit of work and pickle the result.
+
+    The runners pickle the work themselves, rather than leaving it to
+    the executor or connection, so that they know how many bytes are
+    sent to and from the workers. The time the task started and ended
+    on the worker is added to dict results.
+
+    Args:
+        task_f: the task function
+        payload: the pickled unit of work
+    """
+    task_start = time.time()
+    result = task_f(pickle.loads(payload))
+    if isinstance(result, dict):
+        result["task_start"] = task_start
+        result["task_end"] = time.time()
+    return pickle.dumps(result)
+
+
+def unpickle_result(data: bytes, n_sent: int) -> Any:
+    """Unpickle the result of a task and record the transferred bytes.
 
+    Args:
+        data: the pickled result from :py:func:`run_pickled`
+        n_sent: the size of the pickled unit of work
+    """
+    result = pickle.loads(data)
+    if isinstance(result, dict):
+        result["bytes_sent"] = n_sent
+        result["bytes_received"] = len(data)
+    return result
+
+
+def worker_initializer(counter, config, worker_id=None):
+    """Initialize function for each worker process.
 
-def worker_initializer(counter, config):
-    """Initialize function for each worker process."""
+    Args:
+        counter: a shared counter used to number the workers
+        config: the configuration dictionary
+        worker_id: a fixed worker number, used instead of the counter
+            when the runner pins work to worker processes
+    """
     # load engines if infretis simulation
     if "simulation" in config:
         engines, _ = create_engines(config)
@@ -216,9 +509,11 @@ def worker_initializer(counter, config):
 
         # set the ENGINES variable in the tis file for each worker
         infretis.core.tis.ENGINES = engines
-    with counter.get_lock():  # Ensure that counter increment is thread-safe
-        worker_id = counter.value
-        counter.value += 1
+    if worker_id is None:
+        # Ensure that counter increment is thread-safe
+        with counter.get_lock():
+            worker_id = counter.value
+            counter.value += 1
     fileh = logging.FileHandler(f"worker{worker_id}.log", mode="a")
     log_levl = getattr(logging, "info".upper(), logging.INFO)
     fileh.setLevel(log_levl)
@@ -230,28 +525,45 @@ def worker_initializer(counter, config):
 
 
 class future_list:
-    """A managed list of future."""
+    """A managed list of future.
+
+    Completed futures are pushed onto a thread-safe queue by a done
+    callback, so waiting for the next result blocks without using any
+    CPU and futures are returned in the order they completed.
+    """
 
     def __init__(self) -> None:
         """Initialize future list."""
-        self._futures: List[asyncio.Future] = []
+        self._futures: List[Future] = []
+        self._done: SimpleQueue = SimpleQueue()
 
-    def add(self, future: asyncio.Future) -> None:
+    def add(self, future: Future) -> None:
         """Add a future to list."""
         self._futures.append(future)
+        # Called right away if the future is already done
+        future.add_done_callback(self._done.put)
+
+    def __len__(self) -> int:
+        """Return the number of futures not returned yet."""
+        return len(self._futures)
 
-    def as_completed(self) -> Optional[asyncio.Future]:
+    def as_completed(
+        self, timeout: Optional[float] = None
+    ) -> Optional[Future]:
         """Get future as they are done.
 
+        Args:
+            timeout: the maximum time to wait for a future, in seconds
+
         Return:
             return a future from the list, whenever it is done
-            or return None when the list is empty.
+            or return None when the list is empty or on timeout.
         """
-        future_out = None
-        while len(self._futures) > 0 and not future_out:
-            for fut in list(self._futures):
-                if fut.done():
-                    future_out = fut
-                    self._futures.remove(fut)
-                    break
+        if len(self._futures) == 0:
+            return None
+        try:
+            future_out = self._done.get(timeout=timeout)
+        except Empty:
+            return None
+        self._futures.remove(future_out)
         return future_out
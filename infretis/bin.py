@@ -4,6 +4,7 @@ import argparse
 
 from infretis.scheduler import scheduler
 from infretis.setup import setup_config
+from infretis.socketrunner import DEFAULT_ADDRESS, worker_daemon
 
 
 def infretisrun():
@@ -29,3 +30,33 @@ def internalrun(input_file):
     if config is None:
         return
     scheduler(config)
+
+
+def infretisworker():
+    """Start a worker daemon for the socket runner."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a",
+        "--address",
+        help="Address of the infretis runner, 'host:port' or 'unix:path'",
+        default=DEFAULT_ADDRESS,
+    )
+    parser.add_argument(
+        "-w", "--worker", help="Worker number", type=int, required=True
+    )
+    parser.add_argument(
+        "-k",
+        "--authkey",
+        help="Key shared with the runner ([runner] authkey), "
+        "by default the INFRETIS_AUTHKEY environment variable",
+    )
+    parser.add_argument(
+        "-r",
+        "--reconnect",
+        help="Seconds to keep trying to (re)connect to the runner",
+        type=float,
+        default=60.0,
+    )
+
+    args = parser.parse_args()
+    worker_daemon(args.address, args.authkey, args.worker, args.reconnect)
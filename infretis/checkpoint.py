@@ -0,0 +1,211 @@
+"""Restart checkpoints for infRETIS.
+
+By default the whole configuration is written to restart.toml after
+every step. For long runs this can instead be switched to a log in the
+[output] section:
+
+    [output]
+    checkpoint = "log"  # or "toml"
+    checkpoint_compact = 100  # steps between rewrites of restart.toml
+
+With the "log" format the [current] section is appended to
+restart.jsonl as one JSON line after each step, where the accumulated
+weights (`frac`) only hold the paths that changed since the previous
+line and `drop` the paths that were retired. The weights are given to
+the writers as arrays and only turned into strings (to keep their
+precision) for the paths in the line, or for all of them when
+restart.toml is rewritten. Likewise, the buffered rows
+of infretis_data.txt (`data_pending`, see :py:mod:`infretis.data`) are
+only saved when they are new (`data`), or all of them after a write of
+the rows (`data_reset`). Every `checkpoint_compact` steps, and when the
+run stops, restart.toml is rewritten and the log is emptied.
+
+restart.toml is written to a temporary file that replaces the old one,
+so a crash never leaves a partly written restart.toml, and a partly
+written last line of the log is skipped when loading. On restart, the
+lines newer than restart.toml are applied to its [current] section by
+:py:func:`load_checkpoint`, see :py:func:`infretis.setup.setup_config`.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import tomli_w
+
+FORMATS = ("toml", "log")
+
+
+def log_file(toml_file: str) -> str:
+    """Return the name of the log of a restart file."""
+    return os.path.splitext(toml_file)[0] + ".jsonl"
+
+
+def write_toml(config: Dict[str, Any], toml_file: str) -> None:
+    """Write the configuration to a toml file, replacing it atomically.
+
+    Args:
+        config: the configuration dictionary
+        toml_file: the name of the toml file
+    """
+    tmp_file = toml_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        tomli_w.dump(config, f)
+    os.replace(tmp_file, toml_file)
+
+
+def frac_table(fracs: Dict[str, np.ndarray]) -> Dict[str, List[str]]:
+    """Return the accumulated weights as strings, keeping their precision.
+
+    Args:
+        fracs: the accumulated weights of the paths
+
+    Returns:
+        The `frac` table of the [current] section.
+    """
+    return {key: [str(i) for i in frac] for key, frac in fracs.items()}
+
+
+def write_restart(
+    config: Dict[str, Any], fracs: Dict[str, np.ndarray], toml_file: str
+) -> None:
+    """Write the configuration with the accumulated weights to a toml file.
+
+    Args:
+        config: the configuration dictionary
+        fracs: the accumulated weights of the paths
+        toml_file: the name of the toml file
+    """
+    config["current"]["frac"] = frac_table(fracs)
+    write_toml(config, toml_file)
+
+
+def load_checkpoint(config: Dict[str, Any], toml_file: str) -> int:
+    """Apply the log of a restart file to its [current] section.
+
+    Only the lines with a later step than the [current] section are
+    applied, as the older lines are already in the toml file.
+
+    Args:
+        config: the configuration dictionary loaded from `toml_file`
+        toml_file: the name of the restart file
+
+    Returns:
+        The number of lines applied.
+    """
+    name = log_file(toml_file)
+    if not os.path.isfile(name):
+        return 0
+    current = config["current"]
+    applied = 0
+    with open(name, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line was cut short by a crash
+                break
+            if record["current"]["cstep"] <= current["cstep"]:
+                continue
+            frac = current.get("frac", {})
+            for key in record["drop"]:
+                frac.pop(key, None)
+            frac.update(record["frac"])
+            pending = current.get("data_pending", [])
+            if record.get("data_reset", False):
+                pending = []
+            current.update(record["current"])
+            current["frac"] = frac
+            if "data" in record:
+                current["data_pending"] = pending + record["data"]
+            applied += 1
+    return applied
+
+
+class CheckpointLog:
+    """Append the [current] section of each step to a log.
+
+    The first write, and every `compact`-th write after it, rewrites the
+    toml file and empties the log, such that `compact = 1` is the same
+    as the "toml" format.
+    """
+
+    def __init__(self, toml_file: str = "restart.toml", compact: int = 100):
+        """Set up the log of a restart file.
+
+        Args:
+            toml_file: the name of the restart file
+            compact: the number of writes between rewrites of `toml_file`
+        """
+        self.toml_file = toml_file
+        self.file = log_file(toml_file)
+        self.compact = compact
+        self.lines = 0
+        # the accumulated weights as in the files, None before a write
+        self._fracs: Optional[Dict[str, np.ndarray]] = None
+        # the buffered rows of the data file as in the files
+        self._pending: List[str] = []
+
+    def write_toml(
+        self, config: Dict[str, Any], fracs: Dict[str, np.ndarray]
+    ) -> None:
+        """Rewrite the toml file and empty the log.
+
+        Args:
+            config: the configuration dictionary
+            fracs: the accumulated weights of the paths
+        """
+        write_restart(config, fracs, self.toml_file)
+        # the log is older than the toml file now, so a crash before
+        # it is emptied is harmless
+        with open(self.file, "w", encoding="utf-8"):
+            pass
+        self.lines = 0
+        self._fracs = fracs
+        self._pending = list(config["current"].get("data_pending", []))
+
+    def write(
+        self, config: Dict[str, Any], fracs: Dict[str, np.ndarray]
+    ) -> None:
+        """Save the [current] section of a step.
+
+        Args:
+            config: the configuration dictionary
+            fracs: the accumulated weights of the paths
+        """
+        if self._fracs is None or self.lines >= self.compact - 1:
+            self.write_toml(config, fracs)
+            return
+        current = config["current"]
+        old = self._fracs
+        record = {
+            "current": {
+                key: value
+                for key, value in current.items()
+                if key not in ("frac", "data_pending")
+            },
+            "frac": frac_table(
+                {
+                    key: frac
+                    for key, frac in fracs.items()
+                    if key not in old or not np.array_equal(frac, old[key])
+                }
+            ),
+            "drop": [key for key in old if key not in fracs],
+        }
+        if "data_pending" in current:
+            pending = current["data_pending"]
+            written = self._pending
+            if pending[: len(written)] == written:
+                record["data"] = pending[len(written) :]
+            else:
+                record["data"] = pending
+                record["data_reset"] = True
+            self._pending = list(pending)
+        with open(self.file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        self.lines += 1
+        self._fracs = fracs
@@ -2,7 +2,7 @@
 
 from __future__ import annotations
 
-import importlib
+import importlib.util
 import logging
 from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
 
@@ -96,6 +96,8 @@ def create_engines(
         engines[engine] = []
         engine_occ[engine] = []
         n_create = min(n_engine, config["runner"]["workers"])
+        # speculative moves run on extra workers that need engines too
+        n_create += config["runner"].get("speculative", 0)
         for i in range(n_create):
             check_engine(config, eng_key=engine)
             engine_occ[engine].append(-1)
@@ -136,6 +138,10 @@ def assign_engines(
 ) -> Dict[Any, int]:
     """Assign non-occupied engine(s) to a worker based on the engine_occ dict.
 
+    A worker gets back the engine instance(s) it used in its previous
+    move whenever it needs the same engine type again, so that any
+    state kept by the engine between moves is reused.
+
     Args:
         engine_occ: The dict containing engine_occupations.
         eng_names: The engine names to get.
@@ -146,14 +152,20 @@ def assign_engines(
             eng_names[i].
     """
     # first free all engines that where occupied by worker i
+    warm = {}
     for eng_key in engine_occ.keys():
         for i, occupied_by in enumerate(engine_occ[eng_key]):
             if pin == occupied_by:
                 engine_occ[eng_key][i] = -1
+                warm[eng_key] = i
 
     # then get non-occupied engines of type 'eng_names'
     out = {}
     for eng_key in eng_names:
+        if eng_key in warm:
+            engine_occ[eng_key][warm[eng_key]] = pin
+            out[eng_key] = warm[eng_key]
+            continue
         for i, occupied_by in enumerate(engine_occ[eng_key]):
             if occupied_by == -1:
                 engine_occ[eng_key][i] = pin
@@ -31,6 +31,9 @@ LOG_DEBUG_FMT = (
     "[%(levelname)s] [%(name)s, %(funcName)s() at"
     " line %(lineno)d]: %(message)s"
 )
+# the formats of the stored paths, see PathStorage.output_path_files()
+PATH_FORMATS = ("txt", "npz")
+PATH_ARCHIVE = "path.npz"
 if TYPE_CHECKING:  # pragma: no cover
     from collections.abc import Callable, Iterable
 
@@ -139,6 +142,36 @@ def read_some_lines(
         yield new_block
 
 
+def read_single_block(filename: str) -> Optional[List[str]]:
+    """Read the data lines of a file with a single block of data.
+
+    This is a fast path of :py:func:`read_some_lines` for the files of
+    a stored path, such that the lines can be parsed at once, e.g. with
+    `np.loadtxt`.
+
+    Args:
+        filename: This is the name/path of the file to open and read.
+
+    Returns:
+        The lines after the leading comments, or None if the file has
+        no data, several blocks or empty lines, which are left to
+        :py:func:`read_some_lines`.
+    """
+    with open(filename, encoding="utf-8") as fileh:
+        lines = fileh.read().splitlines()
+    start = 0
+    while start < len(lines) and lines[start].lstrip().startswith("#"):
+        start += 1
+    data = lines[start:]
+    if not data:
+        return None
+    for line in data:
+        stripline = line.strip()
+        if not stripline or stripline.startswith("#"):
+            return None
+    return data
+
+
 def _make_header(labels: List[str], width: List[int], spacing: int = 1) -> str:
     """Format a table header with the given labels.
 
@@ -838,12 +871,16 @@ class PathStorage(OutputBase):
         formatter = OutputFormatter("empty formatter", header=None)
         super().__init__(formatter)
         self.keep_traj_fnames = keep_traj_fnames
+        self.path_format = "txt"
 
     def output_path_files(
         self, step: int, data: List[Any], target_dir: str
     ) -> List[Tuple[str, str]]:
         """Write the output files for energy, path and order parameter.
 
+        With the "npz" `path_format` the data is written to a single
+        binary file instead, see :py:func:`write_path_archive`.
+
         Args:
             step: The current simulation step.
             data: A tuple containing:
@@ -858,6 +895,13 @@ class PathStorage(OutputBase):
                   for organizing internally in archives.
         """
         path, status = data[0], data[1]
+        if self.path_format == "npz":
+            full_path = os.path.join(target_dir, PATH_ARCHIVE)
+            relative_path = os.path.join(
+                self.out_dir_fmt.format(step), PATH_ARCHIVE
+            )
+            write_path_archive(full_path, step, path, status)
+            return [(full_path, relative_path)]
         files = []
         for key, val in self.formatters.items():
             logger.debug("Storing: %s", key)
@@ -892,10 +936,50 @@ class PathStorage(OutputBase):
         Returns:
             A copy of the input path.
         """
+        path_copy, source = PathStorage._copy_path(path, target_dir, prefix)
+        PathStorage._move_files(source, target_dir, keep_traj_fnames)
+        return path_copy
+
+    @staticmethod
+    def _copy_path(
+        path: InfPath, target_dir: str, prefix: Optional[str] = None
+    ) -> Tuple[InfPath, Dict[str, str]]:
+        """Copy a path with the file names in a given target directory.
+
+        Args:
+            path: The path to copy.
+            target_dir: The location where we are moving the path to.
+            prefix: A prefix for the file names of copied files.
+
+        Returns:
+            A tuple containing:
+                - A copy of the input path.
+                - A dict which defines the "source -> destination" of
+                  the files to move.
+        """
         path_copy = path.copy()
         new_pos, source = _generate_file_names(
             path_copy, target_dir, prefix=prefix
         )
+        # Update positions:
+        for pos, phasepoint in zip(new_pos, path_copy.phasepoints):
+            phasepoint.config = (pos[0], pos[1])
+            # phasepoint.particles.set_pos(pos)
+        return path_copy, source
+
+    @staticmethod
+    def _move_files(
+        source: Dict[str, str], target_dir: str, keep_traj_fnames: list
+    ) -> None:
+        """Move the files of a path to a given target directory.
+
+        Args:
+            source: The "source -> destination" of the files to move.
+            target_dir: The location where we are moving the path to.
+            keep_traj_fnames: A list file extensions that are matched aginst
+              the source directories in which the trajectories are stored.
+              File extensions that match the pattern are also stored.
+        """
         # keep any files where extension match the patterns in keep_traj_fnames
         if keep_traj_fnames:
             for source_file in source.copy().keys():
@@ -906,10 +990,6 @@ class PathStorage(OutputBase):
                     fpath = os.path.join(source_dir, new_fname)
                     if os.path.isfile(fpath):
                         source[fpath] = os.path.join(target_dir, new_fname)
-        # Update positions:
-        for pos, phasepoint in zip(new_pos, path_copy.phasepoints):
-            phasepoint.config = (pos[0], pos[1])
-            # phasepoint.particles.set_pos(pos)
         for src, dest in source.items():
             if src != dest:
                 if os.path.exists(dest):
@@ -918,15 +998,19 @@ class PathStorage(OutputBase):
                         os.remove(dest)
                 logger.debug("Copy %s -> %s", src, dest)
                 shutil.move(src, dest)
-        return path_copy
 
-    def output(self, step: int, data: Any) -> InfPath:
+    def output(
+        self, step: int, data: Any, archiver: Optional[Any] = None
+    ) -> InfPath:
         """Format the path data and store the path.
 
         Args:
             step: The current simulation step.
             data: A dictionary containing the path and the directory to
                 write to.
+            archiver: An :py:class:`infretis.archive.Archiver` to write
+                the order, energy and traj files in the background,
+                otherwise they are written before returning.
 
         Returns:
             A copy of the path (moved to the new directory).
@@ -945,12 +1029,19 @@ class PathStorage(OutputBase):
         # To organize things we create a subfolder for storing the
         # files. This is on form: /path/to/000/traj/11/traj
         traj_dir = os.path.join(archive_path, "accepted")
+        path_copy, source = self._copy_path(path, traj_dir)
         # Create the needed directories:
         make_dirs(traj_dir)
+        # the trajectories are moved right away, as the worker removes
+        # the files in its directory when it starts its next move
+        self._move_files(source, traj_dir, self.keep_traj_fnames)
         # Write order, energy and traj files to the archive:
-        _ = self.output_path_files(step, [path, "ACC"], archive_path)
-        path = self._move_path(path, traj_dir, self.keep_traj_fnames)
-        return path
+        job = (step, [path, "ACC"], archive_path)
+        if archiver is None:
+            self.output_path_files(*job)
+        else:
+            archiver.submit(self.output_path_files, *job)
+        return path_copy
 
     def write(self, towrite: str, end: str = "\n") -> bool:
         """We do not need the write method for this object."""
@@ -965,6 +1056,59 @@ class PathStorage(OutputBase):
         return f"{self.__class__.__name__} - archive writer."
 
 
+def write_path_archive(
+    filename: str, step: int, path: InfPath, status: str
+) -> None:
+    """Write the data of a path to a binary file.
+
+    The file holds the same data as the order.txt, energy.txt and
+    traj.txt of a path, as NumPy arrays with one row per phase point:
+    the order parameters, the energies (NaN if not set), and the frame
+    references as an index into the trajectory file names, the frame
+    index and if the velocities are reversed. It is read back by
+    :py:func:`infretis.classes.path.load_path`.
+
+    Args:
+        filename: The file to write.
+        step: The current simulation step.
+        path: The path to store.
+        status: The status of the path.
+    """
+    files: Dict[str, int] = {}
+    file_index, index, reverse = [], [], []
+    for phasepoint in path.phasepoints:
+        fname, idx = phasepoint.config
+        fname = os.path.basename(fname)
+        file_index.append(files.setdefault(fname, len(files)))
+        index.append(0 if idx is None else idx)
+        reverse.append(bool(phasepoint.vel_rev))
+    energies = {
+        key: [
+            np.nan if getattr(pp, key, None) is None else getattr(pp, key)
+            for pp in path.phasepoints
+        ]
+        for key in EnergyFormatter.ENERGY_TERMS
+    }
+    with open(filename, "wb") as output:
+        np.savez(
+            output,
+            step=np.int64(step),
+            status=np.str_(status),
+            move=np.str_(path.generated),
+            order=np.array(
+                [pp.order for pp in path.phasepoints], dtype=np.float64
+            ),
+            files=np.array(list(files), dtype=np.str_),
+            file_index=np.array(file_index, dtype=np.int32),
+            index=np.array(index, dtype=np.int64),
+            reverse=np.array(reverse, dtype=bool),
+            **{
+                key: np.array(value, dtype=np.float64)
+                for key, value in energies.items()
+            },
+        )
+
+
 def get_log_formatter(level: int) -> LogFormatter:
     """Select a log format based on a given level.
 
@@ -4,14 +4,18 @@ from __future__ import annotations
 
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
 from infretis.classes.formatter import (
+    PATH_ARCHIVE,
     EnergyPathFile,
+    EnergyPathFormatter,
     OrderPathFile,
     PathExtFile,
+    read_single_block,
 )
 from infretis.classes.system import System
 
@@ -290,6 +294,26 @@ class Path:
         """Check if two paths are not equal."""
         return not self == other
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Return the state used for pickling the path.
+
+        Paths are pickled every time they are sent to or from a worker.
+        The phase points are packed into arrays when possible, which is
+        much smaller and faster to (un)pickle than a list of long paths
+        of System objects.
+        """
+        state = self.__dict__.copy()
+        packed = _pack_phasepoints(self.phasepoints)
+        if packed is not None:
+            state["phasepoints"] = packed
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Restore a pickled path, unpacking the phase points."""
+        if isinstance(state["phasepoints"], dict):
+            state["phasepoints"] = _unpack_phasepoints(state["phasepoints"])
+        self.__dict__.update(state)
+
     def update_energies(
         self,
         ekin: Union[np.ndarray, List[float]],
@@ -328,6 +352,180 @@ class Path:
                 setattr(phasepoint, name, enei)
 
 
+_SYSTEM_ATTRS = set(System().__dict__)
+_ENERGY_ATTRS = ("ekin", "vpot", "etot", "temp")
+
+
+def _pack_phasepoints(
+    phasepoints: List[System],
+) -> Optional[Dict[str, Any]]:
+    """Pack phase points into arrays.
+
+    Args:
+        phasepoints: The phase points of a path.
+
+    Returns:
+        A dict with the phase point attributes as arrays, or None if
+        the phase points can not be packed without loss, e.g. when they
+        have extra attributes or order parameters of different length.
+    """
+    if not phasepoints:
+        return None
+    for phasepoint in phasepoints:
+        if (
+            type(phasepoint) is not System
+            or phasepoint.__dict__.keys() != _SYSTEM_ATTRS
+            or not isinstance(phasepoint.config[0], str)
+            or not isinstance(phasepoint.config[1], (int, np.integer))
+        ):
+            return None
+
+    orders = [phasepoint.order for phasepoint in phasepoints]
+    order_type = type(orders[0])
+    # exact types, as subclasses of list or ndarray are not rebuilt
+    if order_type not in (list, np.ndarray) or any(
+        type(order) is not order_type for order in orders
+    ):
+        return None
+    if len(set(len(order) for order in orders)) != 1:
+        return None
+    vel_rev = [phasepoint.vel_rev for phasepoint in phasepoints]
+    if not all(isinstance(rev, bool) for rev in vel_rev):
+        return None
+
+    # configuration files are shared by many frames
+    files: Dict[str, int] = {}
+    file_idx = np.empty(len(phasepoints), dtype=np.int32)
+    frame_idx = np.empty(len(phasepoints), dtype=np.int64)
+    for i, phasepoint in enumerate(phasepoints):
+        file_idx[i] = files.setdefault(phasepoint.config[0], len(files))
+        frame_idx[i] = phasepoint.config[1]
+
+    packed: Dict[str, Any] = {
+        "files": list(files),
+        "file_idx": file_idx,
+        "frame_idx": frame_idx,
+        "order": np.array(orders),
+        "order_list": order_type is list,
+        "vel_rev": np.array(vel_rev, dtype=bool),
+    }
+
+    for name in _ENERGY_ATTRS:
+        values = [getattr(phasepoint, name) for phasepoint in phasepoints]
+        is_none = np.array([value is None for value in values], dtype=bool)
+        if not all(
+            isinstance(value, (float, np.floating)) or value is None
+            for value in values
+        ):
+            return None
+        packed[name] = (
+            np.array(
+                [np.nan if value is None else value for value in values],
+                dtype=np.float64,
+            ),
+            is_none,
+        )
+
+    # positions and velocities are usually only kept on disk
+    for name in ("pos", "vel", "temperature"):
+        values = [getattr(phasepoint, name) for phasepoint in phasepoints]
+        if all(_is_empty(value) for value in values):
+            packed[name] = None
+        else:
+            packed[name] = values
+
+    boxes = [phasepoint.box for phasepoint in phasepoints]
+    packed["box"] = boxes
+    box0 = boxes[0]
+    if all(box is box0 for box in boxes):
+        packed["box"] = box0
+    elif isinstance(box0, np.ndarray):
+        key0 = (box0.shape, box0.dtype, box0.tobytes())
+        if all(
+            isinstance(box, np.ndarray)
+            and (box.shape, box.dtype, box.tobytes()) == key0
+            for box in boxes
+        ):
+            packed["box"] = box0
+    return packed
+
+
+def _is_empty(value: Any) -> bool:
+    """Check if a value is the default empty array or dict of a System."""
+    if isinstance(value, np.ndarray):
+        return value.shape == (0,) and value.dtype == np.float64
+    return isinstance(value, dict) and not value
+
+
+def _unpack_phasepoints(packed: Dict[str, Any]) -> List[System]:
+    """Recreate the phase points packed by :py:func:`_pack_phasepoints`."""
+    n_frames = len(packed["file_idx"])
+    files = packed["files"]
+    if packed["order_list"]:
+        orders = packed["order"].tolist()
+    else:
+        orders = list(packed["order"])
+    columns = {}
+    for name in _ENERGY_ATTRS:
+        values, is_none = packed[name]
+        columns[name] = values.tolist()
+        for i in np.flatnonzero(is_none):
+            columns[name][i] = None
+    # the empty defaults can be shared, they are replaced, not modified
+    empty = np.zeros(0)
+    for name, default in (("pos", empty), ("vel", empty), ("temperature", {})):
+        if packed[name] is None:
+            columns[name] = [default] * n_frames
+        else:
+            columns[name] = packed[name]
+    if isinstance(packed["box"], list):
+        columns["box"] = packed["box"]
+    else:
+        columns["box"] = [packed["box"]] * n_frames
+
+    phasepoints = []
+    for (
+        file_i,
+        frame_i,
+        order,
+        vel_rev,
+        ekin,
+        vpot,
+        etot,
+        temp,
+        pos,
+        vel,
+        temperature,
+        box,
+    ) in zip(
+        packed["file_idx"].tolist(),
+        packed["frame_idx"].tolist(),
+        orders,
+        packed["vel_rev"].tolist(),
+        *(columns[name] for name in _ENERGY_ATTRS),
+        columns["pos"],
+        columns["vel"],
+        columns["temperature"],
+        columns["box"],
+    ):
+        phasepoint = System.__new__(System)
+        phasepoint.__dict__.update(
+            config=(files[file_i], frame_i),
+            order=order,
+            pos=pos,
+            vel=vel,
+            vel_rev=vel_rev,
+            ekin=ekin,
+            vpot=vpot,
+            etot=etot,
+            temp=temp,
+            box=box,
+            temperature=temperature,
+        )
+        phasepoints.append(phasepoint)
+    return phasepoints
+
+
 def paste_paths(
     path_back: Path,
     path_forw: Path,
@@ -393,34 +591,33 @@ def paste_paths(
 
 def load_path(pdir: str) -> Path:
     """Load a path from the given directory."""
+    if os.path.isfile(os.path.join(pdir, PATH_ARCHIVE)):
+        return _load_path_archive(pdir)
     trajtxt = os.path.join(pdir, "traj.txt")
     ordertxt = os.path.join(pdir, "order.txt")
     assert os.path.isfile(trajtxt)
     assert os.path.isfile(ordertxt)
 
     # load trajtxt
-    with PathExtFile(trajtxt, "r") as trajfile:
-        # Just get the first trajectory:
-        traj = next(trajfile.load())
-
-        # Update trajectory to use full path names:
-        for i, snapshot in enumerate(traj["data"]):
-            config = os.path.join(pdir, "accepted", snapshot[1])
-            traj["data"][i][1] = config
-            reverse = int(snapshot[3]) == -1
-            idx = int(snapshot[2])
-            traj["data"][i][2] = idx
-            traj["data"][i][3] = reverse
-
-        for config in set(frame[1] for frame in traj["data"]):
-            assert os.path.isfile(config)
+    traj = _load_traj(trajtxt)
+
+    # Update trajectory to use full path names:
+    for i, snapshot in enumerate(traj):
+        config = os.path.join(pdir, "accepted", snapshot[1])
+        traj[i][1] = config
+        reverse = int(snapshot[3]) == -1
+        idx = int(snapshot[2])
+        traj[i][2] = idx
+        traj[i][3] = reverse
+
+    for config in set(frame[1] for frame in traj):
+        assert os.path.isfile(config)
 
     # load ordertxt
-    with OrderPathFile(ordertxt, "r") as orderfile:
-        orderdata = next(orderfile.load())["data"][:, 1:]
+    orderdata = _load_order(ordertxt)
 
     path = Path()
-    for snapshot, order in zip(traj["data"], orderdata):
+    for snapshot, order in zip(traj, orderdata):
         frame = System()
         frame.order = order
         frame.config = (snapshot[1], snapshot[2])
@@ -431,6 +628,58 @@ def load_path(pdir: str) -> Path:
     return path
 
 
+def _load_traj(trajtxt: str) -> List[List[str]]:
+    """Load the rows of the first trajectory of a traj.txt file."""
+    lines = read_single_block(trajtxt)
+    if lines is not None:
+        traj = [line.split() for line in lines]
+        if all(len(row) == len(traj[0]) for row in traj):
+            return traj
+    with PathExtFile(trajtxt, "r") as trajfile:
+        # Just get the first trajectory:
+        return next(trajfile.load())["data"]
+
+
+def _load_order(ordertxt: str) -> np.ndarray:
+    """Load the order parameters of the first block of an order.txt."""
+    lines = read_single_block(ordertxt)
+    if lines is not None:
+        try:
+            return np.loadtxt(lines, ndmin=2)[:, 1:]
+        except ValueError:
+            pass
+    with OrderPathFile(ordertxt, "r") as orderfile:
+        return next(orderfile.load())["data"][:, 1:]
+
+
+def _load_path_archive(pdir: str) -> Path:
+    """Load a path from its binary file in the given directory.
+
+    See :py:func:`infretis.classes.formatter.write_path_archive`.
+    """
+    with np.load(os.path.join(pdir, PATH_ARCHIVE)) as data:
+        configs = [
+            os.path.join(pdir, "accepted", str(fname))
+            for fname in data["files"]
+        ]
+        for config in configs:
+            assert os.path.isfile(config)
+
+        path = Path()
+        for order, file_index, idx, reverse in zip(
+            data["order"], data["file_index"], data["index"], data["reverse"]
+        ):
+            frame = System()
+            frame.order = order
+            frame.config = (configs[file_index], int(idx))
+            frame.vel_rev = bool(reverse)
+            path.phasepoints.append(frame)
+        path.update_energies(
+            data["ekin"], data["vpot"], data["etot"], data["temp"]
+        )
+    return path
+
+
 def _load_energies_for_path(path: Path, dirname: str) -> None:
     """Load energy data for a path.
 
@@ -440,24 +689,54 @@ def _load_energies_for_path(path: Path, dirname: str) -> None:
     """
     energy_file_name = os.path.join(dirname, "energy.txt")
     try:
-        with EnergyPathFile(energy_file_name, "r") as energyfile:
-            energy = next(energyfile.load())
-            path.update_energies(
-                energy["data"]["ekin"],
-                energy["data"]["vpot"],
-                energy["data"].get("etot", []),
-                energy["data"].get("temp", []),
-            )
+        lines = read_single_block(energy_file_name)
+        energy = None
+        if lines is not None:
+            try:
+                data = np.loadtxt(lines, ndmin=2)
+            except ValueError:
+                pass
+            else:
+                terms = EnergyPathFormatter.ENERGY_TERMS
+                energy = {
+                    "data": {
+                        key: data[:, i + 1]
+                        for i, key in enumerate(terms[: data.shape[1] - 1])
+                    }
+                }
+        if energy is None:
+            with EnergyPathFile(energy_file_name, "r") as energyfile:
+                energy = next(energyfile.load())
+        path.update_energies(
+            energy["data"]["ekin"],
+            energy["data"]["vpot"],
+            energy["data"].get("etot", []),
+            energy["data"].get("temp", []),
+        )
     except FileNotFoundError:
         pass
 
 
 def load_paths_from_disk(config: Dict[str, Any]) -> List[Path]:
-    """Load paths from disk."""
+    """Load paths from disk.
+
+    The paths are loaded by `load_workers` threads (set in the
+    [simulation] section, default 4), as loading is mostly waiting for
+    the file system.
+    """
     load_dir = config["simulation"]["load_dir"]
+    workers = config["simulation"].get("load_workers", 4)
+    pdirs = [
+        os.path.join(load_dir, str(pnumber))
+        for pnumber in config["current"]["active"]
+    ]
+    if workers > 1 and len(pdirs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(load_path, pdirs))
+    else:
+        loaded = [load_path(pdir) for pdir in pdirs]
     paths = []
-    for pnumber in config["current"]["active"]:
-        new_path = load_path(os.path.join(load_dir, str(pnumber)))
+    for pnumber, new_path in zip(config["current"]["active"], loaded):
         status = "re" if "restarted_from" in config["current"] else "ld"
         ### TODO: important for shooting move if 'ld' is set. need a smart way
         ### to remember if status is 'sh' or 'wf' etc. maybe in the toml file.
@@ -2,21 +2,37 @@
 
 import logging
 import os
+import shutil
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 
 import numpy as np
-import tomli_w
 from numpy.random import default_rng
 
+from infretis.archive import Archiver
+from infretis.checkpoint import CheckpointLog, write_restart
 from infretis.classes.engines.factory import assign_engines
-from infretis.classes.formatter import PathStorage
+from infretis.classes.formatter import PATH_ARCHIVE, PathStorage
+from infretis.classes.path import Path
 from infretis.core.core import make_dirs
 from infretis.core.tis import calc_cv_vector
+from infretis.data import DataWriter, data_dtype
 
 logger = logging.getLogger("main")  # pylint: disable=invalid-name
 logger.addHandler(logging.NullHandler())
 DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+# number of Gray-code states processed at once in the permanents
+GLYNN_CHUNK = 4096
+# the chains, maximum sweeps, first sweeps between the checks and the
+# largest R-hat of the sampled P matrices, see REPEX_state.random_prob()
+RANDOM_CHAINS = 64
+RANDOM_SWEEPS = 50000
+RANDOM_CHECK = 100
+RANDOM_RHAT = 1.01
+# the float types of the P matrices, see REPEX_state.gradient_prob()
+PRECISIONS = ("longdouble", "float64")
 
 
 def spawn_rng(rgen):
@@ -39,6 +55,82 @@ def spawn_rng(rgen):
     )
 
 
+def glynn_row_sums(M, chunk=GLYNN_CHUNK, dtype="longdouble"):
+    """Generate the signed row sums of Glynn's permanent formula.
+
+    The sign vectors of the formula are visited in Gray-code order, the
+    last row always having a + sign, such that each state differs from
+    the previous one by a single flipped row. The row sums of a chunk of
+    states are found at once as a cumulative sum of the row flips, which
+    gives the same values as updating the sums state by state.
+
+    Args:
+        M: an n x m matrix
+        chunk: the number of states in each chunk
+        dtype: the float type of the row sums
+
+    Yields:
+        The signs (+1 or -1, the product of the sign vector), the row
+        sums (one row per state), and the row flipped after each state
+        with the change of its sign (-2, +2, or 0 after the last state)
+        for a chunk of states.
+    """
+    n = len(M)
+    num_loops = 2 ** (n - 1)
+    row_comb = np.sum(M, axis=0, dtype=dtype)
+    for start in range(1, num_loops + 1, chunk):
+        stop = min(start + chunk, num_loops + 1)
+        bin_index = np.arange(start, stop, dtype=np.int64)
+        # state k flips the row of the lowest set bit of k, and the
+        # flip is -2 if that row gets a - sign and +2 otherwise
+        flip_row = np.log2(bin_index & -bin_index).astype(np.int64)
+        new_grey = bin_index ^ (bin_index >> 1)
+        direction = np.where(new_grey >> flip_row & 1, -2, 2)
+        # the sums before each flip are the sums of the states
+        flips = M[flip_row[:-1]] * direction[:-1, None]
+        row_combs = np.cumsum(
+            np.concatenate(([row_comb], flips)), axis=0, dtype=dtype
+        )
+        signs = np.where(bin_index % 2, 1, -1)
+        if stop > num_loops:
+            direction[-1] = 0
+        yield signs, row_combs, flip_row, direction
+        if stop <= num_loops:
+            row_comb = row_combs[-1] + M[flip_row[-1]] * direction[-1]
+
+
+class PrefetchStopped(Exception):
+    """Raised in the prefetch() thread when it is asked to stop."""
+
+
+def cumulative(weights):
+    """Return the cumulative distribution of non-negative weights.
+
+    The weights are normalized and summed up as in ``rgen.choice``, so
+    :py:func:`sample_cdf` gives the same index as
+    ``rgen.choice(len(weights), p=weights / sum(weights))`` for the same
+    random number.
+
+    Args:
+        weights: a 1D array of weights
+    """
+    cdf = np.cumsum(np.nan_to_num(weights / np.sum(weights)))
+    if not cdf[-1] > 0:
+        raise ValueError("probabilities do not sum to 1")
+    cdf /= cdf[-1]
+    return cdf
+
+
+def sample_cdf(cdf, rgen):
+    """Draw an index from a cumulative distribution by binary search.
+
+    Args:
+        cdf: a cumulative distribution from :py:func:`cumulative`
+        rgen: the random number generator
+    """
+    return int(np.searchsorted(cdf, rgen.random(), side="right"))
+
+
 class REPEX_state:
     """Define the REPEX object."""
 
@@ -57,10 +149,15 @@ class REPEX_state:
     def __init__(self, config, minus=False):
         """Initiate REPEX given confic dict from *toml file."""
         self.config = config
+        # the data of the paths, not shared with earlier states
+        self.traj_data = {}
         # storage of additional trajectory files
         self.pstore.keep_traj_fnames = config.get("output", {}).get(
             "keep_traj_fnames", []
         )
+        self.pstore.path_format = config.get("output", {}).get(
+            "path_format", "txt"
+        )
         # set rng
         if "restarted_from" in config["current"]:
             self.set_rgen()
@@ -78,10 +175,38 @@ class REPEX_state:
         self.state = np.zeros(shape=(n, n))
         self._locks = np.ones(shape=n)
         self._last_prob = None
+        # least recently used caches of the P matrices and the exact P
+        # matrices of their blocks, see inf_retis(), and the number of
+        # P matrix calculations
+        self.prob_cache = config["simulation"].get("prob_cache", 128)
+        self._prob_cache = OrderedDict()
+        self._block_probs = OrderedDict()
+        self.cache_hits = {"prob": 0, "block": 0}
+        self.cache_misses = {"prob": 0, "block": 0}
+        self.n_prob = 0
+        # calculate P matrices while waiting for the workers, see
+        # prefetch()
+        self.prefetch_prob = config["simulation"].get("prefetch_prob", False)
+        self._prefetch_thread = None
+        self._prefetch_stop = threading.Event()
         self._random_count = 0
+        # the largest block with an exact P matrix, see inf_retis()
+        self.max_exact_block = config["simulation"].get("max_exact_block", 20)
+        # the target standard error of the sampled P matrices
+        self.random_tol = config["simulation"].get("random_tol", 5e-3)
+        # the float type of the P matrices and the accumulated weights
+        self.prob_dtype = config["simulation"].get(
+            "prob_precision", "longdouble"
+        )
         self._trajs = [""] * n
         self.zeroswap = config["simulation"]["zeroswap"]
         self.pick_scheme = config["simulation"]["pick_scheme"]
+        # favour slowly converging ensembles, see pick()
+        self.pick_convergence = config["simulation"].get("pick_convergence", 0)
+        # the accepted paths of each ensemble, kept over restarts
+        self._ens_acc = np.array(
+            config["current"].get("ens_acc", [0] * n), dtype=float
+        )
 
         # detect any locked ens-path pairs exist pre start
         self.locked0 = list(self.config["current"].get("locked", []))
@@ -95,10 +220,38 @@ class REPEX_state:
         # keep track of olds in case of delete_old = True
         self.pn_olds = {}
 
+        # speculative moves run by extra workers, see pick_speculative()
+        self.speculative = config.get("runner", {}).get("speculative", 0)
+        self.spec_rgen = default_rng(seed=(config["simulation"]["seed"], 1))
+        self.spec_moves = {}
+        self.spec_stats = {"submitted": 0, "used": 0, "discarded": 0}
+
+        # archives the accepted paths, in a thread with archive_async
+        self.archiver = Archiver(
+            config.get("output", {}).get("archive_async", False)
+        )
+        # buffers the rows of infretis_data.txt, see data_writer
+        self._data_writer = None
+
+        # save the steps to a log instead of restart.toml, see
+        # write_checkpoint()
+        self.checkpoint = None
+        if config.get("output", {}).get("checkpoint", "toml") == "log":
+            self.checkpoint = CheckpointLog(
+                "./restart.toml",
+                config["output"].get("checkpoint_compact", 100),
+            )
+
     @property
     def prob(self):
-        """Calculate the P matrix."""
+        """Calculate the P matrix.
+
+        The P matrix is only calculated when it is needed, and is kept
+        until the state or the locks change, so the changes of a whole
+        step lead to a single calculation.
+        """
         if self._last_prob is None:
+            self.n_prob += 1
             prob = self.inf_retis(abs(self.state), self._locks)
             self._last_prob = prob.copy()
         return self._last_prob
@@ -143,6 +296,23 @@ class REPEX_state:
         """Retrieve data_file from config dict."""
         return self.config["output"]["data_file"]
 
+    @property
+    def data_writer(self):
+        """Retrieve the writer of the data file, see infretis.data."""
+        if self._data_writer is None:
+            output = self.config["output"]
+            self._data_writer = DataWriter(
+                self.data_file,
+                self.n - 1,
+                flush=output.get("data_flush", 0.0),
+                binary=output.get("data_binary", False),
+            )
+            # the rows that were not written before a restart
+            self._data_writer.restore(
+                self.config["current"].get("data_pending", [])
+            )
+        return self._data_writer
+
     @property
     def interfaces(self):
         """Retrieve interfaces from config dict."""
@@ -164,8 +334,13 @@ class REPEX_state:
         if self.config["output"]["keep_maxop_trajs"]:
             self.config["current"]["maxop"] = val
 
-    def pick(self):
-        """Pick path and ens."""
+    def pick_cdf(self):
+        """Return the cumulative distribution of the picks.
+
+        The picks follow the flattened P matrix, weighted by
+        `pick_scheme` and `pick_convergence`, and a pick is a binary
+        search in the distribution, see :py:func:`sample_cdf`.
+        """
         prob = self.prob.astype("float64")
         if self.pick_scheme > 0:
             # Pick ensemble based on weight, primarily only necessary
@@ -174,9 +349,17 @@ class REPEX_state:
             ens_weights = np.zeros(self.n)
             ens_weights[valid_idx] = np.arange(1, len(valid_idx) + 1)
             prob *= ens_weights**self.pick_scheme
+        if self.pick_convergence > 0:
+            # The error of the ensemble averages goes as 1/sqrt(n) with
+            # n the number of decorrelated (accepted) paths, so pick the
+            # ensembles with few accepted paths more often.
+            ens_weights = (1.0 + self._ens_acc) ** -0.5
+            prob *= ens_weights**self.pick_convergence
+        return cumulative(prob.flatten())
 
-        prob = prob.flatten()
-        p = self.rgen.choice(self.n**2, p=np.nan_to_num(prob / np.sum(prob)))
+    def pick(self):
+        """Pick path and ens."""
+        p = sample_cdf(self.pick_cdf(), self.rgen)
         traj, ens = np.divmod(p, self.n)
 
         self.swap(traj, ens)
@@ -224,8 +407,8 @@ class REPEX_state:
 
     def pick_traj_ens(self, ens):
         """Pick traj ens."""
-        prob = self.prob.astype("float64")[:, ens].flatten()
-        traj = self.rgen.choice(self.n, p=np.nan_to_num(prob / np.sum(prob)))
+        prob = self.prob.astype("float64")[:, ens]
+        traj = sample_cdf(cumulative(prob), self.rgen)
         self.swap(traj, ens)
         self.lock(ens)
         return self._trajs[ens]
@@ -271,6 +454,7 @@ class REPEX_state:
         """Fill md_items with picked path and ens."""
         # Remove previous picked
         md_items.pop("picked", None)
+        md_items.pop("speculative", None)
 
         # pick/lock ens & path
         if self.toinitiate >= 0:
@@ -287,6 +471,10 @@ class REPEX_state:
         else:
             md_items["picked"] = self.pick()
 
+        return self.prep_picked(md_items)
+
+    def prep_picked(self, md_items):
+        """Fill md_items with the worker settings for the picked ens."""
         # Record ens_nums
         md_items["ens_nums"] = list(md_items["picked"].keys())
 
@@ -330,6 +518,158 @@ class REPEX_state:
 
         return md_items
 
+    def pick_speculative(self, md_items, pin):
+        """Pick an ens and path for a speculative move.
+
+        Speculative moves keep workers busy beyond the number of
+        ensembles that can be locked. They are picked from the current
+        P matrix with a separate random generator, without locking the
+        ensemble, and are only used if a later regular pick selects the
+        same ensemble and path, see :py:meth:`match_speculative`.
+
+        Args:
+            md_items: the md_items dict to fill
+            pin: the worker pin that runs the move
+
+        Returns:
+            The filled md_items, or None if there is nothing to pick.
+        """
+        if np.all(self._locks[:-1] == 1):
+            return None
+        prob = self.prob.astype("float64").copy()
+        # do not speculate twice on the same ens and path
+        for entry in self.spec_moves.values():
+            for idx, traj in enumerate(self._trajs[:-1]):
+                if traj.path_number == entry["pn"]:
+                    prob[idx, entry["ens_num"] + self._offset] = 0.0
+        prob = prob.flatten()
+        if not np.sum(prob) > 0:
+            return None
+        p = sample_cdf(cumulative(prob), self.spec_rgen)
+        traj_idx, ens = np.divmod(p, self.n)
+        traj = self._trajs[traj_idx]
+        ens_num = ens - self._offset
+
+        # the moves must not change the ensemble dicts of the state
+        ens_pick = dict(self.ensembles[ens_num + 1])
+        ens_pick["rgen"] = spawn_rng(spawn_rng(self.spec_rgen))
+        md_items.pop("speculative", None)
+        md_items["picked"] = {
+            ens_num: {
+                "ens": ens_pick,
+                "traj": traj,
+                "pn_old": traj.path_number,
+            }
+        }
+        # each move gets its own folder, so that the files of finished
+        # moves are kept until they are used or discarded
+        spec_id = self.spec_stats["submitted"]
+        md_items["pin"] = pin
+        md_items["w_folder"] = os.path.join(
+            os.getcwd(), f"worker{pin}", f"spec{spec_id}"
+        )
+        make_dirs(md_items["w_folder"])
+        md_items = self.prep_picked(md_items)
+        md_items["speculative"] = spec_id
+        self.spec_moves[spec_id] = {
+            "ens_num": ens_num,
+            "pn": traj.path_number,
+            "md_items": None,
+            "promoted": False,
+            "w_folder": md_items["w_folder"],
+        }
+        self.spec_stats["submitted"] += 1
+        return md_items
+
+    def match_speculative(self, md_items):
+        """Match a regular pick with a speculative move.
+
+        A pick of a single ensemble is served by the oldest speculative
+        move on the same ensemble and path, whether that move has
+        finished or not. Since the speculative move started from the
+        same path with independent random numbers, its outcome is a
+        valid trial for the pick. The match never depends on the
+        outcome of the move, so finished rejections and acceptances
+        are used alike.
+
+        Args:
+            md_items: the md_items of the regular pick
+
+        Returns:
+            The id of the matched speculative move, or None.
+        """
+        if len(md_items["ens_nums"]) != 1:
+            return None
+        ens_num = md_items["ens_nums"][0]
+        pn_old = md_items["pnum_old"][0]
+        for spec_id, entry in self.spec_moves.items():
+            if (
+                entry["ens_num"] == ens_num
+                and entry["pn"] == pn_old
+                and not entry["promoted"]
+            ):
+                entry["promoted"] = True
+                self.spec_stats["used"] += 1
+                return spec_id
+        return None
+
+    def finish_speculative(self, md_items):
+        """Store the result of a speculative move.
+
+        Args:
+            md_items: the md_items returned by the speculative move
+
+        Returns:
+            The md_items if a regular pick is waiting for them, else
+            None.
+        """
+        entry = self.spec_moves[md_items["speculative"]]
+        if entry["promoted"]:
+            self.spec_moves.pop(md_items["speculative"])
+            return md_items
+        entry["md_items"] = md_items
+        self.discard_speculative()
+        return None
+
+    def pop_speculative(self, spec_id):
+        """Return the finished md_items of a matched speculative move."""
+        entry = self.spec_moves[spec_id]
+        if entry["md_items"] is None:
+            return None
+        self.spec_moves.pop(spec_id)
+        return entry["md_items"]
+
+    def discard_speculative(self, spec_id=None):
+        """Discard speculative moves that can no longer be used.
+
+        Finished moves on paths that left the simulation are dropped,
+        as well as the move `spec_id` if given (e.g. a failed move).
+        Moves that are still running are dropped once they finish.
+        """
+        live = self.live_paths()
+        for key in list(self.spec_moves):
+            entry = self.spec_moves[key]
+            if key == spec_id or (
+                entry["md_items"] is not None and entry["pn"] not in live
+            ):
+                self.spec_moves.pop(key)
+                self.spec_stats["discarded"] += 1
+                if entry["md_items"] is not None or key == spec_id:
+                    shutil.rmtree(entry["w_folder"], ignore_errors=True)
+
+    def end_speculative(self, md_items):
+        """Clean up after a used speculative move has been treated.
+
+        The folder of the move is removed and the md_items are set up
+        to be reused by the regular worker with the same pin.
+        """
+        shutil.rmtree(md_items.pop("w_folder"), ignore_errors=True)
+        md_items["w_folder"] = os.path.join(
+            os.getcwd(), f"worker{md_items['pin']}"
+        )
+        make_dirs(md_items["w_folder"])
+        md_items.pop("speculative")
+
     def add_traj(self, ens, traj, valid, count=True, n=0):
         """Add traj to state and calculate P matrix."""
         if ens >= 0 and self._offset != 0:
@@ -363,11 +703,8 @@ class REPEX_state:
         self.state[ens, :] = valid
         self.unlock(ens)
 
-        # Calculate P matrix
-        self.prob
-
     def sort_trajstate(self):
-        """Sort trajs and calculate P matrix."""
+        """Sort trajs, the P matrix is calculated when needed."""
         needstomove = [
             self.state[idx][:-1][idx] == 0 for idx in range(self.n - 1)
         ]
@@ -385,8 +722,6 @@ class REPEX_state:
             needstomove = [
                 self.state[idx][:-1][idx] == 0 for idx in range(self.n - 1)
             ]
-        self._last_prob = None
-        self.prob
 
     def lock(self, ens):
         """Lock ensemble."""
@@ -406,10 +741,24 @@ class REPEX_state:
         """Swap to keep the locks symmetric."""
         # mainly to keep the locks symmetric
         self.state[[ens, traj]] = self.state[[traj, ens]].copy()
+        if self._locks[ens] == self._locks[traj]:
+            # the P matrix of the swapped paths is swapped as well
+            if self._last_prob is not None:
+                prob = self._last_prob
+                prob[[ens, traj]] = prob[[traj, ens]].copy()
+        else:
+            self._last_prob = None
         temp1 = self._trajs[ens]
         self._trajs[ens] = self._trajs[traj]
         self._trajs[traj] = temp1
 
+    def get_path(self, path_number):
+        """Return the live or locked path with the given path number."""
+        for traj in self._trajs[:-1]:
+            if traj.path_number == path_number:
+                return traj
+        raise ValueError(f"Path {path_number} is not in the state!")
+
     def live_paths(self):
         """Return list of live paths."""
         return [traj.path_number for traj in self._trajs[:-1]]
@@ -449,6 +798,7 @@ class REPEX_state:
             # cstep >= tsteps we return false.
             self.print_end()
             self.write_toml()
+            self.archiver.close()
             logger.info("date: " + datetime.now().strftime(DATE_FORMAT))
             return False
 
@@ -486,35 +836,31 @@ class REPEX_state:
         self.toinitiate -= 1
         return self.toinitiate >= 0
 
-    def inf_retis(self, input_mat, locks):
-        """Permanent calculator."""
+    def inf_retis(self, input_mat, locks, prefetch=False):
+        """Permanent calculator.
+
+        Args:
+            input_mat: the W matrix
+            locks: the locked ensembles, 1 if locked
+            prefetch: if True, do not count the cache hits and misses and
+                return None instead of sampling a block
+        """
         # Drop locked rows and columns
         bool_locks = locks == 1
         # get non_locked minus interfaces
         offset = self._offset - sum(bool_locks[: self._offset])
-        # make insert list
-        i = 0
-        insert_list = []
-        for lock in bool_locks:
-            if lock:
-                insert_list.append(i)
-            else:
-                i += 1
-
         # Drop locked rows and columns
-        non_locked = input_mat[~bool_locks, :][:, ~bool_locks]
+        free = np.flatnonzero(~bool_locks)
+        non_locked = input_mat[np.ix_(free, free)]
 
-        # Sort based on the index of the last non-zero values in the rows
-        # argmax(a>0) gives back the first column index that is nonzero
-        # so looping over the columns backwards and multiplying by -1
-        # gives the right ordering
-        minus_idx = np.argsort(np.argmax(non_locked[:offset] > 0, axis=1))
-        pos_idx = (
-            np.argsort(-1 * np.argmax(non_locked[offset:, ::-1] > 0, axis=1))
-            + offset
-        )
+        # the P matrix only depends on the non-locked W matrix and locks
+        prob_key = (bool_locks.tobytes(), non_locked.tobytes())
+        prob = self._cache_get("prob", self._prob_cache, prob_key, prefetch)
+        if prob is not None:
+            return prob.copy()
+        random_count = self._random_count
 
-        sort_idx = np.append(minus_idx, pos_idx)
+        sort_idx = self.sort_rows(non_locked, offset)
         sorted_non_locked = non_locked[sort_idx]
 
         # check if all trajectories have equal weights
@@ -545,7 +891,7 @@ class REPEX_state:
 
         equal = equal_minus and equal_pos
 
-        out = np.zeros(shape=sorted_non_locked.shape, dtype="longdouble")
+        out = np.zeros(shape=sorted_non_locked.shape, dtype=self.prob_dtype)
         if equal:
             # All trajectories have equal weights, run fast algorithm
             # run_fast
@@ -557,9 +903,9 @@ class REPEX_state:
                 # Catch only minus ens available
                 out[offset:] = self.quick_prob(sorted_non_locked[offset:])
         else:
-            # TODO DEBUG print
-            # print("DEBUG this should not happen outside of wirefencing")
             blocks = self.find_blocks(sorted_non_locked, offset=offset)
+            # inaccurate float64 blocks are redone in longdouble
+            longdouble = self.prob_dtype == "longdouble"
             for start, stop, direction in blocks:
                 if direction == -1:
                     cstart, cstop = stop - 1, start - 1
@@ -571,26 +917,40 @@ class REPEX_state:
                 subarr_T = subarr.T
                 if len(subarr) == 1:
                     out[start:stop, start:stop] = 1
-                elif np.all(subarr_T[np.where(subarr_T != subarr_T[0])] == 0):
+                    continue
+                if np.all(subarr_T[np.where(subarr_T != subarr_T[0])] == 0):
                     # Either the same weight as the last one or zero
                     temp = self.quick_prob(subarr)
                     out[start:stop, cstart:cstop:direction] = temp
-                elif len(subarr) <= 12:
-                    # We can run this subsecond
-                    temp = self.permanent_prob(subarr)
-                    out[start:stop, cstart:cstop:direction] = temp
-                else:
-                    self._random_count += 1
-                    # TODO DEBUG PRINTS
-                    print(
-                        f"random #{self._random_count}, "
-                        f"dims = {len(subarr)}"
-                    )
-                    # do n random parallel samples
-                    temp = self.random_prob(subarr)
-                    out[start:stop, cstart:cstop:direction] = temp
-
-        out[sort_idx] = out.copy()  # COPY REQUIRED TO NOT BRAKE STATE!!!
+                    continue
+                key = (subarr.shape, subarr.tobytes())
+                temp = self._cache_get(
+                    "block", self._block_probs, key, prefetch
+                )
+                if temp is None:
+                    if len(subarr) <= self.max_exact_block:
+                        # All the minors at once, about a second for 20
+                        temp = self.permanent_prob(subarr)
+                        if not (self.valid_prob(temp) or longdouble):
+                            # retry with the extra precision
+                            temp = self.gradient_prob(
+                                subarr, dtype="longdouble"
+                            )
+                        if not self.valid_prob(temp):
+                            logger.info(
+                                "inaccurate P matrix for a block of"
+                                f" {len(subarr)}, sampling it instead"
+                            )
+                            temp = None
+                        else:
+                            self._cache_put(self._block_probs, key, temp)
+                    if temp is None and prefetch:
+                        return None
+                    if temp is None:
+                        self._random_count += 1
+                        # do n random parallel samples
+                        temp = self.random_prob(subarr)
+                out[start:stop, cstart:cstop:direction] = temp
 
         # Make sure we have a valid probability square
         assert np.allclose(np.sum(out, axis=1), 1)
@@ -599,41 +959,176 @@ class REPEX_state:
         # edge case that negative probs exist: set to zero
         if np.sum(out < 0) > 0:
             out[out < 0] = 0
-            logger.info(f"Found {int(np.sum(out<0))} precision \
+            logger.info(
+                f"Found {int(np.sum(out<0))} precision \
                 errors in the P-matrix, setting negative \
-                elements to 0. min: {np.min(out):.3e}")
-
-        # reinsert zeroes for the locked ensembles
-        final_out_rows = np.insert(out, insert_list, 0, axis=0)
+                elements to 0. min: {np.min(out):.3e}"
+            )
 
-        # reinsert zeroes for the locked trajectories
-        final_out = np.insert(final_out_rows, insert_list, 0, axis=1)
+        # undo the sorting and reinsert zeroes for the locked ensembles
+        # and trajectories
+        final_out = np.zeros(input_mat.shape, dtype=out.dtype)
+        final_out[np.ix_(free[sort_idx], free)] = out
 
+        # a sampled P matrix is not reused, such that the same random
+        # numbers are drawn after a restart with empty caches
+        if self._random_count == random_count:
+            self._cache_put(self._prob_cache, prob_key, final_out.copy())
         return final_out
 
+    def _cache_get(self, name, cache, key, prefetch=False):
+        """Return a cached P matrix or None, and count hits and misses."""
+        if key not in cache:
+            if not prefetch:
+                self.cache_misses[name] += 1
+            return None
+        if not prefetch:
+            self.cache_hits[name] += 1
+        cache.move_to_end(key)
+        return cache[key]
+
+    def prefetch(self):
+        """Calculate the P matrices needed after rejected moves.
+
+        A rejected move adds its paths back with unchanged weights, so
+        the P matrix of the next step is known before the move ends if
+        it is rejected. These P matrices are put in the P matrix cache,
+        in the order of the picks, until `stop_prefetch()` is called.
+        P matrices that need sampling are skipped, as sampling draws
+        random numbers.
+        """
+        state = abs(self.state)
+        for ens_nums, _ in list(self.locked):
+            if self._prefetch_stop.is_set():
+                return
+            locks = self._locks.copy()
+            locks[[ens + self._offset for ens in ens_nums]] = 0
+            try:
+                self.inf_retis(state, locks, prefetch=True)
+            except PrefetchStopped:
+                return
+
+    def start_prefetch(self):
+        """Start prefetch() in a thread, e.g. while waiting for workers.
+
+        The state must not be changed before `stop_prefetch()`.
+        """
+        if not self.prefetch_prob or not self.locked:
+            return
+        self._prefetch_stop.clear()
+        self._prefetch_thread = threading.Thread(
+            target=self.prefetch, daemon=True
+        )
+        self._prefetch_thread.start()
+
+    def stop_prefetch(self):
+        """Stop the prefetch() thread.
+
+        The permanents check for the stop after each chunk of Gray-code
+        states, so a large block does not delay the next step.
+        """
+        if self._prefetch_thread is None:
+            return
+        self._prefetch_stop.set()
+        self._prefetch_thread.join()
+        self._prefetch_thread = None
+
+    def _check_prefetch_stop(self):
+        """Raise PrefetchStopped in a prefetch() thread asked to stop."""
+        if (
+            self._prefetch_stop.is_set()
+            and threading.current_thread() is self._prefetch_thread
+        ):
+            raise PrefetchStopped
+
+    def _cache_put(self, cache, key, value):
+        """Add a P matrix to a cache, dropping the least recently used."""
+        cache[key] = value
+        while len(cache) > self.prob_cache:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def sort_rows(arr, offset):
+        """Return the order of the rows of a W matrix for find_blocks().
+
+        Args:
+            arr: the W matrix without the locked ensembles
+            offset: the number of minus ensembles in `arr`
+        """
+        # Sort based on the index of the last non-zero values in the rows
+        # argmax(a>0) gives back the first column index that is nonzero
+        # so looping over the columns backwards and multiplying by -1
+        # gives the right ordering
+        minus_idx = np.argsort(np.argmax(arr[:offset] > 0, axis=1))
+        pos_idx = (
+            np.argsort(-1 * np.argmax(arr[offset:, ::-1] > 0, axis=1))
+            + offset
+        )
+        return np.append(minus_idx, pos_idx)
+
     def find_blocks(self, arr, offset):
         """Find blocks in a W matrix."""
         if len(arr) == 1:
             return (0, 1, 1)
-        # Assume no zeroes on the diagonal or lower triangle
-        temp_arr = arr.copy()
-        # for counting minus blocks
-        temp_arr[:offset, :offset] = arr[:offset, :offset].T
-        temp_arr[offset:, :offset] = 1  # add ones to the lower triangle
-        non_zero = np.count_nonzero(temp_arr, axis=1)
-        blocks = []
-        start = 0
-        for i, e in enumerate(non_zero):
-            if e == i + 1:
-                direction = -1 if start < offset else 1
-                blocks.append((start, e, direction))
-                start = e
-        return blocks
+        # Assume no zeroes on the diagonal or lower triangle. The minus
+        # block is counted transposed, and the lower triangle as ones.
+        non_zero = np.empty(len(arr), dtype=np.int64)
+        non_zero[:offset] = np.count_nonzero(
+            arr[:offset, :offset], axis=0
+        ) + np.count_nonzero(arr[:offset, offset:], axis=1)
+        non_zero[offset:] = offset + np.count_nonzero(
+            arr[offset:, offset:], axis=1
+        )
+        # a block ends where the rows so far only reach the columns so far
+        stops = np.flatnonzero(non_zero == np.arange(1, len(arr) + 1)) + 1
+        starts = np.concatenate(([0], stops[:-1]))
+        return [
+            (int(start), int(stop), -1 if start < offset else 1)
+            for start, stop in zip(starts, stops)
+        ]
 
     def quick_prob(self, arr):
-        """Quick P matrix calculation for specific W matrix."""
-        total_traj_prob = np.ones(shape=arr.shape[0], dtype="longdouble")
-        out_mat = np.zeros(shape=arr.shape, dtype="longdouble")
+        """Quick P matrix calculation for specific W matrix.
+
+        The non-zero weights of each ensemble are equal. Going from the
+        last ensemble to the first, each ensemble is shared among its
+        paths in proportion to the probability the paths have left. In
+        a staircase W matrix the paths of an ensemble are also in the
+        next lower (non-empty) ensemble, so the probability left in an
+        ensemble is the integer s_c = max(s_c+1 - 1, 0) + new_c, with
+        new_c the paths that enter in ensemble c. This is a Lindley
+        recursion, solved with a cumulative minimum, and the P matrix
+        follows from cumulative products over the ensembles. Other
+        W matrices are done ensemble by ensemble.
+        """
+        working = arr != 0
+        filled = np.flatnonzero(working.any(axis=0))
+        cols = working[:, filled]
+        if not np.all(cols[:, 1:] <= cols[:, :-1]):
+            return self.quick_prob_loop(arr)
+        # the paths entering each ensemble, from the last one
+        new = np.diff(np.sum(cols, axis=0)[::-1], prepend=0)
+        steps = np.concatenate(([0], np.cumsum(new[:-1] - 1)))
+        left = steps - np.minimum.accumulate(steps) + new
+        left = left[::-1].astype(self.prob_dtype)
+        # the share of a path in an ensemble, and the part it keeps
+        share = np.zeros_like(left)
+        keep = np.ones_like(left)
+        share[left > 0] = 1 / left[left > 0]
+        keep[left > 0] = 1 - share[left > 0]
+        kept = np.cumprod(np.where(cols, keep, 1)[:, ::-1], axis=1)[:, ::-1]
+        kept = np.concatenate(
+            (kept[:, 1:], np.ones((len(arr), 1), dtype=self.prob_dtype)),
+            axis=1,
+        )
+        out_mat = np.zeros(shape=arr.shape, dtype=self.prob_dtype)
+        out_mat[:, filled] = cols * kept * share
+        return out_mat
+
+    def quick_prob_loop(self, arr):
+        """Quick P matrix calculation, one ensemble at a time."""
+        total_traj_prob = np.ones(shape=arr.shape[0], dtype=self.prob_dtype)
+        out_mat = np.zeros(shape=arr.shape, dtype=self.prob_dtype)
         working_mat = np.where(arr != 0, 1, 0)  # convert non-zero numbers to 1
 
         for i, column in enumerate(working_mat.T[::-1]):
@@ -648,118 +1143,288 @@ class REPEX_state:
         return out_mat
 
     def permanent_prob(self, arr):
-        """P matrix calculation for specific W matrix."""
-        out = np.zeros(shape=arr.shape, dtype="longdouble")
-        # Don't overwrite input arr
-        scaled_arr = arr.copy()
-        n = len(scaled_arr)
-        # Rescaling the W-matrix avoids numerical instabilites when the
-        # matrix is large and contains large weights from
-        # high-acceptance moves
-        for i in range(n):
-            scaled_arr[i, :] /= np.max(scaled_arr[i, :])
-        for i in range(n):
-            rows = [r for r in range(n) if r != i]
-            sub_arr = scaled_arr[rows, :]
-            for j in range(n):
-                if scaled_arr[i][j] == 0:
-                    continue
-                columns = [r for r in range(n) if r != j]
-                M = sub_arr[:, columns]
-                f = self.fast_glynn_perm(M)
-                out[i][j] = f * scaled_arr[i][j]
-        return out / max(np.sum(out, axis=1))
-
-    def random_prob(self, arr, n=10_000):
-        """P matrix calculation for specific W matrix."""
-        out = np.eye(len(arr), dtype="longdouble")
-        current_state = np.eye(len(arr))
-        choices = len(arr) // 2
-        even = choices * 2 == len(arr)
-
-        # The probability to go right
-        prob_right = np.nan_to_num(np.roll(arr, -1, axis=1) / arr)
-
-        # The probability to go left
-        prob_left = np.nan_to_num(np.roll(arr, 1, axis=1) / arr)
-
-        start = 0
-        zero_one = np.array([0, 1])
-        p_m = np.array([1, -1])
-        temp = np.where(current_state == 1)
-
-        for i in range(n):
-            direction = self.rgen.choice(p_m)
-            if not even:
-                start = self.rgen.choice(zero_one)
+        """P matrix calculation for specific W matrix.
 
-            temp_left = prob_left[temp]
-            temp_right = prob_right[temp]
+        The permanents of all the minors are found at once, after
+        scaling W towards a doubly stochastic matrix, see
+        :py:meth:`gradient_prob`.
+        """
+        return self.gradient_prob(arr)
+
+    def all_minor_perms(self, M, dtype=None):
+        """Permanents of all the (n-1) x (n-1) minors of M.
+
+        The permanent is linear in each element, with the permanent of
+        the minor as coefficient, so the minors are the gradient of
+        Glynn's formula. With d_s the sign vector and e_s the products
+        of all the row sums but one of state s, the gradient is the sum
+        of the outer products d_s e_s. As d_s only changes by one row
+        flip per state, the sum follows from the running sum of e_s at
+        each flip, which costs about as much as one permanent,
+        O(2^n n), instead of O(2^n n^3) for all the minors one by one.
+
+        Args:
+            M: an n x n matrix
+            dtype: the float type, by default `self.prob_dtype`
+
+        Returns:
+            An n x n matrix with the permanent of M without row i and
+            column j at [i, j].
+        """
+        dtype = dtype or self.prob_dtype
+        n = len(M)
+        if n == 1:
+            return np.ones((1, 1), dtype=dtype)
+        running = np.zeros(n, dtype=dtype)
+        flipped = np.zeros((n, n), dtype=dtype)
+        last_signs = np.ones(n)
+        for signs, row_combs, flip_row, direction in glynn_row_sums(
+            M, dtype=dtype
+        ):
+            self._check_prefetch_stop()
+            ones = np.ones((len(row_combs), 1), dtype=dtype)
+            before = np.cumprod(
+                np.concatenate((ones, row_combs[:, :-1]), axis=1), axis=1
+            )
+            after = np.cumprod(
+                np.concatenate((ones, row_combs[:, :0:-1]), axis=1), axis=1
+            )[:, ::-1]
+            terms = signs[:, None] * before * after
+            sums = np.cumsum(
+                np.concatenate(([running], terms)), axis=0, dtype=dtype
+            )[1:]
+            running = sums[-1]
+            np.add.at(flipped, flip_row, direction[:, None] * sums)
+            np.add.at(last_signs, flip_row, direction)
+        # sum_s d_s e_s = d_last sum_s e_s - sum_k dir_k (sum_{s<=k} e_s)
+        grad = last_signs[:, None] * running - flipped
+        return grad / 2 ** (n - 1)
+
+    def gradient_prob(self, arr, n_balance=100, dtype=None):
+        """P matrix from the permanents of all the minors of W.
+
+        The minors are found at once with :py:meth:`all_minor_perms`,
+        the gradient of Glynn's formula. The P matrix does not change when
+        rows or columns of W are scaled, so W is first scaled towards a
+        doubly stochastic matrix (Sinkhorn balancing). This keeps the
+        cancellations in Glynn's formula small, and the P matrix
+        accurate to about machine precision for blocks of 20+.
+
+        After balancing, every row sum in Glynn's formula is at most 1
+        in magnitude, so the rounding error of a minor is at most about
+        n eps, with eps the machine precision of `dtype`, while a
+        minor is at least (n-1)!/(n-1)^(n-1) (van der Waerden). With
+        float64 this bounds the relative error by about 1e-7 for a
+        block of 20, and in practice it is close to eps.
+
+        Args:
+            arr: the W matrix
+            n_balance: the maximum number of balancing iterations
+            dtype: the float type, by default `self.prob_dtype`
+        """
+        dtype = dtype or self.prob_dtype
+        scaled_arr = arr.astype(dtype)
+        for _ in range(n_balance):
+            scaled_arr /= np.sum(scaled_arr, axis=1)[:, None]
+            col_sums = np.sum(scaled_arr, axis=0)
+            scaled_arr /= col_sums
+            if np.max(np.abs(col_sums - 1)) < 1e-12:
+                break
+        out = self.all_minor_perms(scaled_arr, dtype=dtype) * scaled_arr
+        return out / max(np.sum(out, axis=1))
 
-            if not even:
-                start = self.rgen.choice(zero_one)
+    @staticmethod
+    def valid_prob(arr):
+        """Check that the rows and columns of a P matrix sum to 1."""
+        return np.allclose(np.sum(arr, axis=1), 1) and np.allclose(
+            np.sum(arr, axis=0), 1
+        )
 
-            if direction == -1:
-                probs = (
-                    temp_left[start:-1:2]
-                    * np.roll(temp_right, 1, axis=0)[start:-1:2]
+    def random_prob(self, arr, n=RANDOM_SWEEPS, chains=RANDOM_CHAINS):
+        """P matrix estimate for a W matrix by sampling.
+
+        A number of independent Markov chains over the assignments of
+        paths to ensembles are advanced at once, each from its own
+        random start, see :py:meth:`random_assignments`. Each sweep
+        tries to swap the paths of pairs of ensembles with the
+        Metropolis acceptance, alternating between neighbouring pairs
+        and random pairs.
+
+        The first half of the sweeps is discarded as burn-in: the
+        sweeps are doubled until, over the second half, the chains
+        agree (the Gelman-Rubin R-hat of every element is below
+        RANDOM_RHAT) and the standard error of the estimate, from the
+        spread of the chain averages, is below `self.random_tol`, or
+        until `n` sweeps. All random numbers are drawn from
+        `self.rgen`, so the estimate is the same on restart.
+
+        Args:
+            arr: the W matrix of a block
+            n: the maximum number of sweeps
+            chains: the number of chains
+        """
+        size = len(arr)
+        perm = self.random_assignments(arr, chains)
+        # the burn-in before the first check
+        sweeps = max(min(RANDOM_CHECK, n // 2), 1)
+        self._random_sweeps(arr, perm, sweeps)
+        while True:
+            window = min(sweeps, n - sweeps)
+            means = self._random_sweeps(arr, perm, window)
+            sweeps += window
+            if sweeps >= n:
+                break
+            # Gelman-Rubin, the variance in a chain of the 0 or 1 of a
+            # path in an ensemble is mean (1 - mean)
+            within = np.mean(means * (1 - means), axis=0)
+            between = means.var(axis=0, ddof=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rhat = np.sqrt(
+                    ((window - 1) / window * within + between) / within
                 )
+            # the chains agree exactly, e.g. none has the path there
+            rhat[between == 0] = 1.0
+            error = np.sqrt(between / chains)
+            if rhat.max() < RANDOM_RHAT and error.max() < self.random_tol:
+                break
+        out = means.mean(axis=0)
+        return out.reshape(size, size).astype(self.prob_dtype)
+
+    def random_assignments(self, arr, chains):
+        """Return random assignments of paths to ensembles.
+
+        The ensembles with the fewest valid paths are given a random
+        valid path first. For W matrices where the valid ensembles of
+        the paths are nested, as for the RETIS staircases, this never
+        runs out of valid paths and every valid assignment is equally
+        likely. A chain that runs out starts from the assignment of W,
+        the path of row i in ensemble i.
+
+        Args:
+            arr: the W matrix of a block
+            chains: the number of assignments
+
+        Returns:
+            A (chains, n) array with the path in ensemble i at [k, i].
+        """
+        size = len(arr)
+        valid = arr != 0
+        order = np.argsort(np.sum(valid, axis=0), kind="stable")
+        perm = np.tile(np.arange(size), (chains, 1))
+        for chain in range(chains):
+            free = np.ones(size, dtype=bool)
+            for ens in order:
+                paths = np.flatnonzero(free & valid[:, ens])
+                if len(paths) == 0:
+                    break
+                path = paths[self.rgen.integers(len(paths))]
+                perm[chain, ens] = path
+                free[path] = False
             else:
-                probs = temp_right[start:-1:2] * temp_left[start + 1 :: 2]
-
-            r_nums = self.rgen.random(choices)
-            success = r_nums < probs
-
-            for j in np.where(success)[0]:
-                idx = j * 2 + start
-                temp_state = current_state[:, [idx + direction, idx]]
-                current_state[:, [idx, idx + direction]] = temp_state
-                temp_state_2 = temp[0][[idx + direction, idx]]
-                temp[0][[idx, idx + direction]] = temp_state_2
+                continue
+            perm[chain] = np.arange(size)
+        return perm
 
-            out += current_state
+    def _random_sweeps(self, arr, perm, sweeps):
+        """Advance the chains of random_prob() by a number of sweeps.
 
-        return out / (n + 1)
+        Args:
+            arr: the W matrix of a block
+            perm: the assignments of the chains, updated in place
+            sweeps: the number of sweeps
 
-    def fast_glynn_perm(self, M):
-        """Glynn permanent."""
-
-        def cmp(a, b):
-            if a == b:
-                return 0
-            elif a > b:
-                return 1
+        Returns:
+            The fraction of sweeps with path j in ensemble i in each
+            chain, as an array of shape (chains, n * n) with [k, j*n+i].
+        """
+        chains, size = perm.shape
+        choices = size // 2
+        rows = np.arange(chains)[:, None]
+        cols = np.arange(size)
+        pairs = 2 * np.arange(choices)
+        counts = np.zeros((chains, size * size))
+        # a zero weight gives a ratio of 0, inf or nan (rejected)
+        errstate = np.errstate(divide="ignore", invalid="ignore")
+        for sweep in range(sweeps):
+            if sweep % 2:
+                # random pairs of ensembles
+                order = self.rgen.permuted(
+                    np.broadcast_to(cols, (chains, size)), axis=1
+                )
+                idx = order[:, pairs]
+                other = order[:, pairs + 1]
             else:
-                return -1
-
-        row_comb = np.sum(M, axis=0, dtype="longdouble")
-        n = len(M)
-
-        total = 0
-        old_grey = 0
-        sign = +1
+                # neighbouring pairs (idx, other), wrapping around
+                direction = self.rgen.integers(0, 2, size=(chains, 1)) * 2 - 1
+                idx = pairs
+                if size % 2:
+                    idx = idx + self.rgen.integers(0, 2, size=(chains, 1))
+                other = (idx + direction) % size
+            path_i = perm[rows, idx]
+            path_o = perm[rows, other]
+            with errstate:
+                ratio = (arr[path_i, other] * arr[path_o, idx]) / (
+                    arr[path_i, idx] * arr[path_o, other]
+                )
+            success = self.rgen.random((chains, choices)) < ratio
+            perm[rows, idx] = np.where(success, path_o, path_i)
+            perm[rows, other] = np.where(success, path_i, path_o)
+            counts[rows, perm * size + cols] += 1
+        return counts / sweeps
 
-        binary_power_dict = {2**i: i for i in range(n)}
-        num_loops = 2 ** (n - 1)
+    def fast_glynn_perm(self, M):
+        """Glynn permanent.
 
-        for bin_index in range(1, num_loops + 1):
-            total += sign * np.multiply.reduce(row_comb)
+        The Gray-code states are processed in chunks of array
+        operations (see :py:func:`glynn_row_sums`), and the terms are
+        summed in the same order as a state-by-state loop would.
+        """
+        total = np.zeros((), dtype=self.prob_dtype)
+        for signs, row_combs, _, _ in glynn_row_sums(M, dtype=self.prob_dtype):
+            terms = signs * np.multiply.reduce(row_combs, axis=1)
+            total = np.cumsum(np.concatenate(([total], terms)))[-1]
+        return total / 2 ** (len(M) - 1)
 
-            new_grey = bin_index ^ (bin_index // 2)
-            grey_diff = old_grey ^ new_grey
-            grey_diff_index = binary_power_dict[grey_diff]
-            direction = 2 * cmp(old_grey, new_grey)
-            if direction:
-                new_vector = M[grey_diff_index]
-                row_comb += new_vector * direction
+    def write_toml(self):
+        """Toml writer."""
+        self.archiver.wait()
+        if self._data_writer is not None:
+            self._data_writer.flush(sync=True)
+        self.update_current()
+        if self.checkpoint is not None:
+            self.checkpoint.write_toml(self.config, self.current_fracs())
+        else:
+            write_restart(self.config, self.current_fracs(), "./restart.toml")
 
-            sign = -sign
-            old_grey = new_grey
+    def write_checkpoint(self):
+        """Save the state after a step for a possible restart.
 
-        return total / num_loops
+        This rewrites restart.toml, or appends to its log with the
+        "log" checkpoint format, see :py:mod:`infretis.checkpoint`.
+        The files are written by the archiver, after the paths of the
+        step, see :py:mod:`infretis.archive`.
+        """
+        self.archiver.check()
+        if self._data_writer is not None:
+            self._data_writer.maybe_flush()
+        self.update_current()
+        # update_current() makes a new [current] section but for the
+        # subcycles, so this is a copy of the config at this step
+        config = dict(self.config)
+        config["current"] = dict(self.config["current"])
+        config["current"]["wsubcycles"] = list(
+            self.config["current"]["wsubcycles"]
+        )
+        fracs = self.current_fracs()
+        if self.checkpoint is None:
+            self.archiver.submit(
+                write_restart, config, fracs, "./restart.toml"
+            )
+        else:
+            self.archiver.submit(self.checkpoint.write, config, fracs)
 
-    def write_toml(self):
-        """Toml writer."""
+    def update_current(self):
+        """Update the [current] section of the config with the state."""
         self.config["current"]["active"] = self.live_paths()
         locked_ep = []
         for tup in self.locked:
@@ -769,14 +1434,31 @@ class REPEX_state:
         self.config["current"]["locked"] = locked_ep
         self.config["current"]["rng_state"] = self.rgen.bit_generator.state
 
-        # save accumulative fracs
+        # the accumulative fracs are filled in by the writer of the
+        # checkpoint, see current_fracs()
         self.config["current"]["frac"] = {}
-        for key in sorted(self.traj_data.keys()):
-            fracs = [str(i) for i in self.traj_data[key]["frac"]]
-            self.config["current"]["frac"][str(key)] = fracs
 
-        with open("./restart.toml", "wb") as f:
-            tomli_w.dump(self.config, f)
+        # the accepted paths of each ensemble, see pick_cdf()
+        current = self.config["current"]
+        if self.pick_convergence > 0 or "ens_acc" in current:
+            current["ens_acc"] = [int(i) for i in self._ens_acc]
+
+        # the buffered rows of infretis_data.txt, as their paths are gone
+        output = self.config.get("output", {})
+        if output.get("data_flush", 0.0) > 0 or "data_pending" in current:
+            current["data_pending"] = self.data_writer.pending()
+
+    def current_fracs(self):
+        """Return a copy of the accumulated weights of the paths.
+
+        The weights are only turned into the strings of the [current]
+        section when the checkpoint is written, and then only those
+        that are needed, see :py:mod:`infretis.checkpoint`.
+        """
+        return {
+            str(key): self.traj_data[key]["frac"].copy()
+            for key in sorted(self.traj_data)
+        }
 
     def printing(self):
         """Check if print."""
@@ -820,6 +1502,11 @@ class REPEX_state:
             f"worker: {self.cworker} total time:"
             f"{simtime:.2f}s and subcycles: {subcycles}"
         )
+        if "bytes_sent" in md_items:
+            logger.info(
+                f"sent: {md_items['bytes_sent']/1024:.1f} kB and received:"
+                f" {md_items['bytes_received']/1024:.1f} kB"
+            )
         self.print_state()
 
     def print_start(self):
@@ -829,6 +1516,18 @@ class REPEX_state:
                 f"ensemble selection scheme: {self.pick_scheme}"
                 + " should only be used with Inf-init"
             )
+        if self.pick_convergence > 0:
+            logger.info(
+                f"ensemble selection weighted by convergence: "
+                f"{self.pick_convergence}"
+            )
+        if self.prefetch_prob:
+            logger.info("P matrices of rejected moves are prefetched")
+        if self.checkpoint is not None:
+            logger.info(
+                "steps are saved to restart.jsonl, restart.toml is written"
+                f" every {self.checkpoint.compact} steps"
+            )
         logger.info("stored ensemble paths:")
         ens_num = self.live_paths()
         logger.info(
@@ -838,10 +1537,7 @@ class REPEX_state:
 
     def print_state(self):
         """Print state."""
-        last_prob = True
-        if isinstance(self._last_prob, type(None)):
-            self.prob
-            last_prob = False
+        self.prob
 
         logger.info("===")
         logger.info(" xx |\tv Ensemble numbers v")
@@ -889,8 +1585,6 @@ class REPEX_state:
             oil = False
 
         logger.info("===")
-        if not last_prob:
-            self._last_prob = None
 
     def print_end(self):
         """Print end."""
@@ -909,6 +1603,13 @@ class REPEX_state:
                 ]
             )
             logger.info(f"{key:03.0f} * {values} *")
+        for name in ("prob", "block"):
+            hits, misses = self.cache_hits[name], self.cache_misses[name]
+            rate = hits / max(hits + misses, 1)
+            logger.info(
+                f"{name} P matrix cache: {hits} hits, {misses} misses"
+                f" ({rate:.1%} hit rate)"
+            )
 
     def treat_output(self, md_items):
         """Treat output."""
@@ -920,6 +1621,9 @@ class REPEX_state:
         for ens_num in picked.keys():
             pn_old = picked[ens_num]["pn_old"]
             out_traj = picked[ens_num]["traj"]
+            if not isinstance(out_traj, Path):
+                # an unchanged path is returned by its path number
+                out_traj = self.get_path(out_traj)
             self.ensembles[ens_num + 1] = picked[ens_num]["ens"]
 
             for idx, lock in enumerate(self.locked):
@@ -939,9 +1643,11 @@ class REPEX_state:
                         os.getcwd(), self.config["simulation"]["load_dir"]
                     ),
                 }
-                out_traj = self.pstore.output(self.cstep, data)
+                out_traj = self.pstore.output(
+                    self.cstep, data, archiver=self.archiver
+                )
                 self.traj_data[traj_num] = {
-                    "frac": np.zeros(self.n, dtype="longdouble"),
+                    "frac": np.zeros(self.n, dtype=self.prob_dtype),
                     "max_op": out_traj.ordermax,
                     "min_op": out_traj.ordermin,
                     "length": out_traj.length,
@@ -953,33 +1659,14 @@ class REPEX_state:
                 if self.config["output"]["delete_old"] and pn_old > self.n - 2:
                     if len(self.pn_olds) > self.n - 2:
                         pn_old_del, del_dic = next(iter(self.pn_olds.items()))
-                        load_dir = self.config["simulation"]["load_dir"]
-                        if self.config["output"]["keep_maxop_trajs"]:
-                            path_dir = os.path.join(load_dir, pn_old_del)
-                            # delete trajectory files if low orderp (infinit)
-                            # and directory is not a symlink
-                            if del_dic["max_op"][
-                                0
-                            ] < self.maxop and not os.path.islink(path_dir):
-                                # update maxop and then delete|
-                                for adress in del_dic["adress"]:
-                                    os.remove(adress)
-                        else:
-                            # delete trajectory files
-                            for adress in del_dic["adress"]:
-                                os.remove(adress)
-                        # delete txt files
-                        if self.config["output"]["delete_old_all"]:
-                            for txt in ("order.txt", "traj.txt", "energy.txt"):
-                                txt_adress = os.path.join(
-                                    load_dir, pn_old_del, txt
-                                )
-                                if os.path.isfile(txt_adress):
-                                    os.remove(txt_adress)
-                            os.rmdir(
-                                os.path.join(load_dir, pn_old_del, "accepted")
-                            )
-                            os.rmdir(os.path.join(load_dir, pn_old_del))
+                        self.archiver.submit(
+                            delete_old_files,
+                            self.config["simulation"]["load_dir"],
+                            pn_old_del,
+                            del_dic,
+                            self.maxop,
+                            self.config["output"],
+                        )
                         # pop the deleted path.
                         self.pn_olds.pop(pn_old_del)
                     # keep delete list:
@@ -990,6 +1677,8 @@ class REPEX_state:
                         }
             pn_news.append(out_traj.path_number)
             self.add_traj(ens_num, out_traj, valid=out_traj.weights)
+            if md_items["status"] == "ACC":
+                self._ens_acc[ens_num + self._offset] += 1
 
         # record weights
         locked_trajs = self.locked_paths()
@@ -1012,7 +1701,7 @@ class REPEX_state:
         if self.printing():
             self.print_shooted(md_items, pn_news)
         # save for possible restart
-        self.write_toml()
+        self.write_checkpoint()
 
         return md_items
 
@@ -1047,7 +1736,7 @@ class REPEX_state:
                 "length": paths[i + 1].length,
                 "adress": paths[i + 1].adress,
                 "weights": paths[i + 1].weights,
-                "frac": np.array(frac, dtype="longdouble"),
+                "frac": np.array(frac, dtype=self.prob_dtype),
             }
             # keep track of max op of i+ path
             if paths[i + 1].ordermax[0] > self.maxop:
@@ -1068,7 +1757,7 @@ class REPEX_state:
             "length": paths[0].length,
             "weights": paths[0].weights,
             "adress": paths[0].adress,
-            "frac": np.array(frac, dtype="longdouble"),
+            "frac": np.array(frac, dtype=self.prob_dtype),
         }
 
     def initiate_ensembles(self):
@@ -1112,35 +1801,75 @@ class REPEX_state:
         self.ensembles = pensembles
 
 
+def delete_old_files(load_dir, pn_old, del_dic, maxop, output):
+    """Delete the files of an old path, see delete_old in [output]."""
+    if output["keep_maxop_trajs"]:
+        path_dir = os.path.join(load_dir, pn_old)
+        # delete trajectory files if low orderp (infinit)
+        # and directory is not a symlink
+        if del_dic["max_op"][0] < maxop and not os.path.islink(path_dir):
+            for adress in del_dic["adress"]:
+                os.remove(adress)
+    else:
+        # delete trajectory files
+        for adress in del_dic["adress"]:
+            os.remove(adress)
+    # delete txt files
+    if output["delete_old_all"]:
+        for txt in ("order.txt", "traj.txt", "energy.txt", PATH_ARCHIVE):
+            txt_adress = os.path.join(load_dir, pn_old, txt)
+            if os.path.isfile(txt_adress):
+                os.remove(txt_adress)
+        os.rmdir(os.path.join(load_dir, pn_old, "accepted"))
+        os.rmdir(os.path.join(load_dir, pn_old))
+
+
 def write_to_pathens(state, pn_archive):
     """Write data to infretis_data.txt."""
     traj_data = state.traj_data
     size = state.n
 
-    with open(state.data_file, "a") as fp:
-        for pn in pn_archive:
-            string = ""
-            string += f"\t{pn:3.0f}\t"
-            string += f"{traj_data[pn]['length']:5.0f}" + "\t"
-            string += f"{traj_data[pn]['max_op'][0]:8.5f}" + "\t"
-            frac = []
-            weight = []
-            if len(traj_data[pn]["weights"]) == 1:
-                f0 = traj_data[pn]["frac"][0]
-                w0 = traj_data[pn]["weights"][0]
+    lines = []
+    # the same rows for the binary file, see infretis.data
+    rows = np.zeros(len(pn_archive), dtype=data_dtype(size - 1))
+    rows["frac"] = np.nan
+    rows["weights"] = np.nan
+    for row, pn in zip(rows, pn_archive):
+        string = ""
+        string += f"\t{pn:3.0f}\t"
+        string += f"{traj_data[pn]['length']:5.0f}" + "\t"
+        string += f"{traj_data[pn]['max_op'][0]:8.5f}" + "\t"
+        row["pn"] = pn
+        row["length"] = traj_data[pn]["length"]
+        row["max_op"] = traj_data[pn]["max_op"][0]
+        frac = []
+        weight = []
+        if len(traj_data[pn]["weights"]) == 1:
+            f0 = traj_data[pn]["frac"][0]
+            w0 = traj_data[pn]["weights"][0]
+            frac.append("----" if f0 == 0.0 else str(f0))
+            weight.append("----" if f0 == 0.0 else str(w0))
+            frac += ["----"] * (size - 2)
+            weight += ["----"] * (size - 2)
+            if f0 != 0.0:
+                row["frac"][0] = f0
+                row["weights"][0] = w0
+        else:
+            frac.append("----")
+            weight.append("----")
+            for w0, f0 in zip(
+                traj_data[pn]["weights"][:-1], traj_data[pn]["frac"][1:-1]
+            ):
                 frac.append("----" if f0 == 0.0 else str(f0))
                 weight.append("----" if f0 == 0.0 else str(w0))
-                frac += ["----"] * (size - 2)
-                weight += ["----"] * (size - 2)
-            else:
-                frac.append("----")
-                weight.append("----")
-                for w0, f0 in zip(
-                    traj_data[pn]["weights"][:-1], traj_data[pn]["frac"][1:-1]
-                ):
-                    frac.append("----" if f0 == 0.0 else str(f0))
-                    weight.append("----" if f0 == 0.0 else str(w0))
-            fp.write(
-                string + "\t".join(frac) + "\t" + "\t".join(weight) + "\t\n"
-            )
-            traj_data.pop(pn)
+            fracs = np.asarray(traj_data[pn]["frac"][1:-1], dtype=np.float64)
+            seen = fracs != 0.0
+            row["frac"][1:][seen] = fracs[seen]
+            row["weights"][1:][seen] = np.asarray(
+                traj_data[pn]["weights"][:-1], dtype=np.float64
+            )[seen]
+        lines.append(
+            string + "\t".join(frac) + "\t" + "\t".join(weight) + "\t\n"
+        )
+        traj_data.pop(pn)
+    state.data_writer.write(lines, rows)
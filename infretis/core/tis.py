@@ -85,6 +85,10 @@ def run_md(md_items: Dict[str, Any]) -> Dict[str, Any]:
                 minus=minus,
             )
             picked[ens_num]["traj"] = trial
+        elif picked[ens_num]["traj"].path_number is not None:
+            # the scheduler still holds the unchanged input path, so
+            # only send back a reference to it
+            picked[ens_num]["traj"] = picked[ens_num]["traj"].path_number
 
     md_items.update(
         {
@@ -0,0 +1,208 @@
+"""Writing and reading the path data of infretis_data.txt.
+
+The accepted paths are written as rows of infretis_data.txt when they
+leave the simulation, see `infretis.classes.repex.write_to_pathens`.
+The rows can be buffered and the same data can be written to a binary
+file next to it, set in the [output] section:
+
+    [output]
+    data_flush = 60.0  # seconds between writes, 0 writes every row
+    data_binary = true  # also write infretis_data.bin
+
+The buffered rows are always written when the run stops, followed by
+an fsync. Until then they are saved in the [current] section of the
+restart file as `data_pending`, as the paths of the rows are no longer
+in the restart file, and after a crash the rows that are missing from
+the files are written on restart, see :py:meth:`DataWriter.restore`.
+
+The binary file holds one record per row with the path number, length,
+maximum order parameter and the fracs and weights of each ensemble as
+float64, where the "----" of the text are NaN. It is read back with
+:py:func:`read_data`, which otherwise parses the text.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+
+def binary_file(data_file: str) -> str:
+    """Return the name of the binary file of a data file."""
+    return os.path.splitext(data_file)[0] + ".bin"
+
+
+def data_dtype(size: int) -> np.dtype:
+    """Return the record type of the rows for `size` ensembles."""
+    return np.dtype(
+        [
+            ("pn", np.int64),
+            ("length", np.int64),
+            ("max_op", np.float64),
+            ("frac", np.float64, (size,)),
+            ("weights", np.float64, (size,)),
+        ]
+    )
+
+
+def read_size(data_file: str) -> int:
+    """Return the number of ensembles from the header of a data file."""
+    with open(data_file, encoding="utf-8") as f:
+        for line in f:
+            if "max OP" in line:
+                return len(line.split()) - 5
+    raise ValueError(f"No header found in '{data_file}'!")
+
+
+def read_data(data_file: str, binary: Optional[bool] = None) -> np.ndarray:
+    """Read the rows of a data file.
+
+    Args:
+        data_file: the name of the text file, e.g. infretis_data.txt
+        binary: read the binary file, by default if it exists
+
+    Returns:
+        A structured array with the fields of :py:func:`data_dtype`.
+    """
+    size = read_size(data_file)
+    dtype = data_dtype(size)
+    if binary is None:
+        binary = os.path.isfile(binary_file(data_file))
+    if binary:
+        return np.fromfile(binary_file(data_file), dtype=dtype)
+    with open(data_file, encoding="utf-8") as f:
+        return parse_rows(f.read(), size)
+
+
+def parse_rows(text: str, size: int) -> np.ndarray:
+    """Parse rows of a data file.
+
+    Args:
+        text: the rows, and possibly comments
+        size: the number of ensembles
+
+    Returns:
+        A structured array with the fields of :py:func:`data_dtype`.
+    """
+    values = np.loadtxt(
+        io.StringIO(text.replace("----", "nan")),
+        comments="#",
+        ndmin=2,
+        dtype=np.float64,
+    )
+    rows = np.empty(len(values), dtype=data_dtype(size))
+    rows["pn"] = values[:, 0]
+    rows["length"] = values[:, 1]
+    rows["max_op"] = values[:, 2]
+    rows["frac"] = values[:, 3 : 3 + size]
+    rows["weights"] = values[:, 3 + size :]
+    return rows
+
+
+class DataWriter:
+    """Buffer the rows of a data file and its binary file."""
+
+    def __init__(
+        self,
+        data_file: str,
+        size: int,
+        flush: float = 0.0,
+        binary: bool = False,
+    ) -> None:
+        """Set up the writer.
+
+        Args:
+            data_file: the name of the text file
+            size: the number of ensembles
+            flush: the time between writes of the rows, in seconds
+            binary: if the rows are also written to the binary file
+        """
+        self.file = data_file
+        self.size = size
+        self.flush_interval = flush
+        self.binary = binary
+        self._lines: List[str] = []
+        self._rows: List[np.ndarray] = []
+        self._last_flush = time.perf_counter()
+
+    def write(self, lines: List[str], rows: np.ndarray) -> None:
+        """Add rows, and write them if `flush` seconds have passed.
+
+        Args:
+            lines: the rows of the text file
+            rows: the same rows as records of :py:func:`data_dtype`
+        """
+        self._lines += lines
+        if self.binary:
+            self._rows.append(rows)
+        self.maybe_flush()
+
+    def pending(self) -> List[str]:
+        """Return the buffered rows of the text file."""
+        return list(self._lines)
+
+    def restore(self, lines: List[str]) -> None:
+        """Write the rows of a restart that are missing from the files.
+
+        The rows are those of :py:meth:`pending` when the restart file
+        was written, and some may have been written after it.
+
+        Args:
+            lines: the rows of the text file
+        """
+        if not lines:
+            return
+        pns = [line.split(None, 1)[0] for line in lines]
+        with open(self.file, encoding="utf-8") as f:
+            written = {
+                line.split(None, 1)[0]
+                for line in f
+                if line.strip() and not line.startswith("#")
+            }
+        with open(self.file, "a", encoding="utf-8") as fp:
+            fp.write(
+                "".join(
+                    line for pn, line in zip(pns, lines) if pn not in written
+                )
+            )
+        if self.binary:
+            name = binary_file(self.file)
+            written_pn = set()
+            if os.path.isfile(name):
+                dtype = data_dtype(self.size)
+                written_pn = set(np.fromfile(name, dtype=dtype)["pn"])
+            rows = parse_rows("".join(lines), self.size)
+            with open(name, "ab") as fp:
+                rows[[int(pn) not in written_pn for pn in pns]].tofile(fp)
+
+    def maybe_flush(self) -> None:
+        """Write the buffered rows if `flush` seconds have passed."""
+        if time.perf_counter() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, sync: bool = False) -> None:
+        """Write the buffered rows.
+
+        Args:
+            sync: if the files are also synced to the disk
+        """
+        self._last_flush = time.perf_counter()
+        if not self._lines:
+            return
+        with open(self.file, "a") as fp:
+            fp.write("".join(self._lines))
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        if self.binary:
+            with open(binary_file(self.file), "ab") as fp:
+                np.concatenate(self._rows).tofile(fp)
+                if sync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+        self._lines = []
+        self._rows = []
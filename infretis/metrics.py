@@ -0,0 +1,247 @@
+"""Worker and scheduler metrics for infRETIS.
+
+The metrics are switched on by setting a file in the [output] section:
+
+    [output]
+    metrics_file = "metrics.jsonl"
+    metrics_format = "jsonl"  # or "prometheus"
+    metrics_interval = 60.0  # seconds between writes
+
+With the "jsonl" format a snapshot of the accumulated metrics is
+appended as one JSON line at each write. The "prometheus" format
+rewrites the file with the current values in the Prometheus text
+exposition format, e.g. for the node-exporter textfile collector.
+
+The task timings (`task_start` and `task_end`) are measured on the
+workers, see :py:func:`infretis.asyncrunner.run_pickled`, while
+`md_start` is set when the scheduler prepares a task, such that
+`task_start - md_start` is the latency between submitting a task and
+a worker starting it.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+FORMATS = ("jsonl", "prometheus")
+
+
+class _Stat:
+    """Accumulate the count, sum and maximum of a quantity."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        """Add a new value."""
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def as_dict(self) -> Dict[str, float]:
+        """Return the accumulated values as a dict."""
+        return {"count": self.count, "sum": self.sum, "max": self.max}
+
+
+class Metrics:
+    """Collect timings of the workers and the scheduler.
+
+    If no `metrics_file` is given in the [output] section, all methods
+    return right away and nothing is written.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        """Set up the metrics from the configuration.
+
+        Args:
+            config: the configuration dictionary
+        """
+        output = config.get("output", {})
+        self.file = output.get("metrics_file", None)
+        self.format = output.get("metrics_format", "jsonl")
+        self.interval = output.get("metrics_interval", 60.0)
+        self.enabled = self.file is not None
+        self.start = time.time()
+        self._last_write = time.perf_counter()
+        self.busy: Dict[int, _Stat] = {}
+        self.latency = _Stat()
+        self.ensembles: Dict[str, _Stat] = {}
+        self.moves: Dict[str, _Stat] = {}
+        self.scheduler: Dict[str, _Stat] = {}
+
+    def record_task(self, md_items: Dict[str, Any]) -> None:
+        """Record the timings of a finished task.
+
+        Args:
+            md_items: the md_items returned by a worker
+        """
+        if not self.enabled or "task_start" not in md_items:
+            return
+        duration = md_items["task_end"] - md_items["task_start"]
+        self.busy.setdefault(md_items["pin"], _Stat()).add(duration)
+        latency = md_items["task_start"] - md_items["md_start"]
+        self.latency.add(max(latency, 0.0))
+        ens = "-".join(f"{i + 1:03d}" for i in md_items["ens_nums"])
+        self.ensembles.setdefault(ens, _Stat()).add(duration)
+        if len(md_items["ens_nums"]) > 1:
+            move = "swap"
+        else:
+            move = md_items["moves"][0] if md_items["moves"] else "none"
+        self.moves.setdefault(move, _Stat()).add(duration)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Time a section of the scheduler.
+
+        Args:
+            name: the name of the section, e.g. "treat_output"
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.scheduler.setdefault(name, _Stat()).add(
+                time.perf_counter() - start
+            )
+
+    def snapshot(self, cstep: int) -> Dict[str, Any]:
+        """Return the accumulated metrics.
+
+        Args:
+            cstep: the current step of the simulation
+        """
+        now = time.time()
+        elapsed = now - self.start
+        return {
+            "time": now,
+            "elapsed": elapsed,
+            "cstep": cstep,
+            "workers": {
+                str(pin): {
+                    "tasks": stat.count,
+                    "busy": stat.sum,
+                    "idle": max(elapsed - stat.sum, 0.0),
+                }
+                for pin, stat in sorted(self.busy.items())
+            },
+            "latency": self.latency.as_dict(),
+            "ensembles": {
+                key: stat.as_dict()
+                for key, stat in sorted(self.ensembles.items())
+            },
+            "moves": {
+                key: stat.as_dict() for key, stat in sorted(self.moves.items())
+            },
+            "scheduler": {
+                key: stat.as_dict()
+                for key, stat in sorted(self.scheduler.items())
+            },
+        }
+
+    def maybe_write(self, cstep: int) -> None:
+        """Write the metrics if the write interval has passed."""
+        if not self.enabled:
+            return
+        if time.perf_counter() - self._last_write >= self.interval:
+            self.write(cstep)
+
+    def write(self, cstep: int) -> None:
+        """Write the metrics to the metrics file."""
+        if not self.enabled:
+            return
+        self._last_write = time.perf_counter()
+        snapshot = self.snapshot(cstep)
+        if self.format == "prometheus":
+            tmp_file = f"{self.file}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as write:
+                write.write(to_prometheus(snapshot))
+            os.replace(tmp_file, self.file)
+        else:
+            with open(self.file, "a", encoding="utf-8") as write:
+                write.write(json.dumps(snapshot) + "\n")
+
+
+def to_prometheus(snapshot: Dict[str, Any]) -> str:
+    """Convert a metrics snapshot to the Prometheus text format.
+
+    Args:
+        snapshot: the metrics from :py:meth:`Metrics.snapshot`
+    """
+    lines: List[str] = []
+
+    def add(name: str, help_txt: str, kind: str, values: List[Tuple]):
+        lines.append(f"# HELP infretis_{name} {help_txt}")
+        lines.append(f"# TYPE infretis_{name} {kind}")
+        for labels, value in values:
+            label_txt = ",".join(f'{key}="{val}"' for key, val in labels)
+            label_txt = f"{{{label_txt}}}" if label_txt else ""
+            lines.append(f"infretis_{name}{label_txt} {value}")
+
+    add("cstep", "The current step.", "gauge", [((), snapshot["cstep"])])
+    # the idle time goes down when the busy time of a task is added
+    for key, kind, help_txt in (
+        ("busy", "counter", "Time the worker spent running tasks."),
+        ("idle", "gauge", "Time the worker did not run tasks."),
+    ):
+        add(
+            f"worker_{key}_seconds",
+            help_txt,
+            kind,
+            [
+                ((("worker", pin),), stats[key])
+                for pin, stats in snapshot["workers"].items()
+            ],
+        )
+    add(
+        "worker_tasks",
+        "Number of tasks run by the worker.",
+        "counter",
+        [
+            ((("worker", pin),), stats["tasks"])
+            for pin, stats in snapshot["workers"].items()
+        ],
+    )
+    for name, metric, label, help_txt in (
+        ("ensembles", "task_seconds", "ensemble", "Task time per ensemble."),
+        ("moves", "move_seconds", "move", "Task time per move type."),
+        ("scheduler", "scheduler_seconds", "section", "Scheduler time."),
+    ):
+        for key in ("sum", "count"):
+            add(
+                f"{metric}_{key}",
+                help_txt,
+                "counter",
+                [
+                    (((label, section),), stat[key])
+                    for section, stat in snapshot[name].items()
+                ],
+            )
+    latency = snapshot["latency"]
+    add(
+        "submit_latency_seconds_sum",
+        "Time from submitting a task until a worker starts it.",
+        "counter",
+        [((), latency["sum"])],
+    )
+    add(
+        "submit_latency_seconds_count",
+        "Number of started tasks.",
+        "counter",
+        [((), latency["count"])],
+    )
+    add(
+        "submit_latency_seconds_max",
+        "The longest submit to start latency.",
+        "gauge",
+        [((), latency["max"])],
+    )
+    return "\n".join(lines) + "\n"
@@ -1,18 +1,143 @@
 """The main infretis loop."""
 
 import copy
+import logging
+import signal
+import threading
+import time
 
+from infretis.metrics import Metrics
 from infretis.setup import setup_internal, setup_runner
 
+logger = logging.getLogger("main")
+
+
+class GracefulStop:
+    """Catch SIGTERM and SIGUSR1 to stop the scheduler loop cleanly.
+
+    After a signal no new work is submitted, and the moves in flight
+    are given `drain_timeout` seconds (set in the [runner] section) to
+    finish before the run is checkpointed and stopped. The moves that
+    did not finish stay locked in restart.toml and are redone on
+    restart.
+    """
+
+    SIGNALS = ("SIGTERM", "SIGUSR1")
+    # the longest time between checks for a signal while waiting
+    poll = 1.0
+
+    def __init__(self, timeout=0.0):
+        """Set up the signal handling.
+
+        Args:
+            timeout: the time to wait for the moves in flight, in seconds
+        """
+        self.timeout = timeout
+        self.requested = False
+        self.deadline = None
+        self._handlers = {}
+
+    def install(self):
+        """Install the signal handlers, only possible in the main thread."""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for name in self.SIGNALS:
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                self._handlers[signum] = signal.signal(signum, self._handle)
+
+    def restore(self):
+        """Restore the previous signal handlers."""
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+        self._handlers = {}
+
+    def _handle(self, signum, frame):
+        if self.requested:
+            return
+        self.requested = True
+        self.deadline = time.monotonic() + self.timeout
+        logger.warning(
+            f"received {signal.Signals(signum).name}, stopping within"
+            f" {self.timeout} s"
+        )
+
+    def remaining(self):
+        """Return the time left to wait for the moves in flight."""
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def as_completed(self, futures, timeout=None):
+        """Return the next done future, checking for a signal meanwhile.
+
+        The signal handler does not interrupt the wait for the futures,
+        which is resumed after the handler (PEP 475), so the wait is
+        split in steps of `poll` seconds. Without a timeout, None is
+        returned once a stop is requested.
+
+        Args:
+            futures: the managed list of futures
+            timeout: the maximum time to wait, in seconds
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.poll
+            if end is not None:
+                wait = min(wait, max(end - time.monotonic(), 0.0))
+            future = futures.as_completed(wait)
+            if future is not None or len(futures) == 0:
+                return future
+            if end is None and self.requested:
+                return None
+            if end is not None and time.monotonic() >= end:
+                return None
+
 
 def scheduler(config):
     """Run infretis loop."""
     # setup repex, runner and futures
     md_items, state = setup_internal(config)
     runner, futures = setup_runner(state)
+    metrics = Metrics(config)
+    stopper = GracefulStop(config["runner"].get("drain_timeout", 0.0))
+    stopper.install()
+    try:
+        if state.speculative:
+            speculative_loop(
+                state, runner, futures, md_items, metrics, stopper
+            )
+        else:
+            main_loop(state, runner, futures, md_items, metrics, stopper)
+    finally:
+        stopper.restore()
+
+
+def main_loop(state, runner, futures, md_items, metrics, stopper):
+    """Run the infretis loop.
+
+    Args:
+        state: the REPEX state
+        runner: the task runner
+        futures: the managed list of futures
+        md_items: a blank md_items dict
+        metrics: the metrics of the workers and the scheduler
+        stopper: the signal handling, see :py:class:`GracefulStop`
+    """
+
+    def next_output(timeout=None):
+        # use the wait to calculate the likely next P matrices
+        state.start_prefetch()
+        try:
+            with metrics.timer("wait"):
+                future = stopper.as_completed(futures, timeout)
+        finally:
+            state.stop_prefetch()
+        if future is None:
+            return None
+        metrics.record_task(future.result())
+        return future.result()
 
     # submit the first number of workers
-    while state.initiate():
+    while not stopper.requested and state.initiate():
         # give each worker its own md_items
         worker_md_items = copy.deepcopy(md_items)
         # pick and prep ens and path for the next job
@@ -22,20 +147,211 @@ def scheduler(config):
         futures.add(runner.submit_work(worker_md_items))
 
     # main step loop
-    while state.loop():
+    while not stopper.requested and state.loop():
         # Get futures as they are completed
-        future = futures.as_completed()
-
-        if future:
-            worker_md_items = state.treat_output(future.result())
+        output = next_output()
+        if output is not None:
+            with metrics.timer("treat_output"):
+                worker_md_items = state.treat_output(output)
 
         # submit new job
+        if stopper.requested:
+            break
         if state.cstep + state.workers <= state.tsteps:
             # chose ens and path for the next job
-            worker_md_items = state.prep_md_items(worker_md_items)
+            with metrics.timer("prep_md_items"):
+                worker_md_items = state.prep_md_items(worker_md_items)
 
             # submit job to scheduler
-            futures.add(runner.submit_work(worker_md_items))
+            with metrics.timer("submit"):
+                futures.add(runner.submit_work(worker_md_items))
+        metrics.maybe_write(state.cstep)
+
+    if stopper.requested:
+        drain(state, runner, stopper, next_output, state.treat_output)
+        metrics.write(state.cstep)
+        return
 
     # end client
     runner.stop()
+    metrics.write(state.cstep)
+    log_failures(runner)
+
+
+def drain(state, runner, stopper, next_output, treat):
+    """Wait for the moves in flight after a stop signal and checkpoint.
+
+    The regular picks in flight are the locked ones, so the outputs are
+    treated until no pick is locked or the deadline has passed. The
+    picks that did not finish stay locked in restart.toml and are
+    redone by `REPEX_state.pick_lock` on restart.
+
+    Args:
+        state: the REPEX state
+        runner: the task runner
+        stopper: the signal handling, see :py:class:`GracefulStop`
+        next_output: returns the next output within a timeout, or None
+        treat: treats an output, like `REPEX_state.treat_output`
+    """
+    while state.locked and stopper.remaining() > 0:
+        try:
+            output = next_output(stopper.remaining())
+        except Exception as e:
+            logger.warning(f"a move in flight failed while stopping: {e}")
+            break
+        if output is None:
+            break
+        state.loop()
+        treat(output)
+
+    state.write_toml()
+    state.archiver.close()
+    runner.stop(wait=False)
+    log_failures(runner)
+    logger.info(
+        f"stopped at step {state.cstep} with {len(state.locked)} unfinished"
+        " moves, restart to continue"
+    )
+
+
+def log_failures(runner):
+    """Log the number of failed attempts to run a task."""
+    failures = getattr(runner, "failures", [])
+    if failures:
+        logger.warning(f"{len(failures)} failed attempts to run a task")
+
+
+def speculative_loop(state, runner, futures, md_items, metrics, stopper):
+    """Run the infretis loop with speculative moves on extra workers.
+
+    The `workers` regular workers run the picks as usual, and the
+    `speculative` extra workers run moves for ens and paths that are
+    likely to be picked later (see `REPEX_state.pick_speculative`).
+    A regular pick that matches a speculative move waits for its
+    result instead of running the move again, and the worker of the
+    pick takes over the speculative work in its place.
+
+    Args:
+        state: the REPEX state
+        runner: the task runner, with workers + speculative workers
+        futures: the managed list of futures
+        md_items: a blank md_items dict
+        metrics: the metrics of the workers and the scheduler
+        stopper: the signal handling, see :py:class:`GracefulStop`
+    """
+    # finished picks that were served by finished speculative moves
+    ready = []
+    # workers without work, and the speculative move of each future
+    idle = []
+    spec_ids = {}
+
+    def submit_speculative(pin):
+        worker_md_items = copy.deepcopy(md_items)
+        worker_md_items = state.pick_speculative(worker_md_items, pin)
+        if worker_md_items is None:
+            idle.append(pin)
+            return
+        future = runner.submit_work(worker_md_items)
+        spec_ids[future] = (worker_md_items["speculative"], pin)
+        futures.add(future)
+
+    def submit(worker_md_items):
+        pin = worker_md_items["pin"]
+        spec_id = state.match_speculative(worker_md_items)
+        if spec_id is None:
+            futures.add(runner.submit_work(worker_md_items))
+            return
+        spec_md_items = state.pop_speculative(spec_id)
+        if spec_md_items is not None:
+            # the pick is done already, the worker stays ours
+            spec_md_items["pin"] = pin
+            ready.append(spec_md_items)
+        else:
+            # wait for the speculative move and take over its work
+            submit_speculative(pin)
+
+    def next_output(timeout=None):
+        if ready:
+            return ready.pop(0)
+        while True:
+            state.start_prefetch()
+            try:
+                with metrics.timer("wait"):
+                    future = stopper.as_completed(futures, timeout)
+            finally:
+                state.stop_prefetch()
+            if future is None:
+                return None
+            if future not in spec_ids:
+                metrics.record_task(future.result())
+                return future.result()
+            spec_id, pin = spec_ids.pop(future)
+            try:
+                metrics.record_task(future.result())
+                output = state.finish_speculative(future.result())
+            except Exception:
+                if state.spec_moves[spec_id]["promoted"]:
+                    raise
+                logger.warning(f"speculative move {spec_id} failed")
+                state.discard_speculative(spec_id)
+                output = None
+            if output is not None:
+                return output
+            # only keep speculating while there are picks to come
+            if stopper.requested:
+                continue
+            if state.cstep + state.workers <= state.tsteps:
+                submit_speculative(pin)
+
+    def treat(output):
+        with metrics.timer("treat_output"):
+            worker_md_items = state.treat_output(output)
+        if "speculative" in worker_md_items:
+            state.end_speculative(worker_md_items)
+        state.discard_speculative()
+        return worker_md_items
+
+    # submit the first number of workers
+    while not stopper.requested and state.initiate():
+        worker_md_items = copy.deepcopy(md_items)
+        worker_md_items = state.prep_md_items(worker_md_items)
+        futures.add(runner.submit_work(worker_md_items))
+    for pin in range(state.workers, state.workers + state.speculative):
+        submit_speculative(pin)
+
+    # main step loop
+    while not stopper.requested and state.loop():
+        output = next_output()
+        if output is not None:
+            worker_md_items = treat(output)
+
+        # submit new job
+        if stopper.requested:
+            break
+        if state.cstep + state.workers <= state.tsteps:
+            with metrics.timer("prep_md_items"):
+                worker_md_items = state.prep_md_items(worker_md_items)
+            with metrics.timer("submit"):
+                submit(worker_md_items)
+
+            # paths changed, so the idle workers may find work again
+            for pin in list(idle):
+                idle.remove(pin)
+                submit_speculative(pin)
+        metrics.maybe_write(state.cstep)
+
+    if stopper.requested:
+        drain(state, runner, stopper, next_output, treat)
+    else:
+        runner.stop()
+        log_failures(runner)
+    metrics.write(state.cstep)
+
+    # drop the moves that were never used
+    for spec_id in list(state.spec_moves):
+        state.discard_speculative(spec_id)
+    stats = state.spec_stats
+    logger.info(
+        f"speculative moves: {stats['submitted']} submitted,"
+        f" {stats['used']} used and {stats['discarded']} discarded"
+    )
@@ -2,20 +2,40 @@
 
 import logging
 import os
-from typing import Optional, Tuple
+import time
+from typing import Optional, Tuple, Union
 
 import tomli
 
-from infretis.asyncrunner import aiorunner, future_list
+from infretis.asyncrunner import (
+    DEFAULT_MAX_RETRIES,
+    QUEUES,
+    aiorunner,
+    future_list,
+)
+from infretis.checkpoint import FORMATS as CHECKPOINT_FORMATS
+from infretis.checkpoint import load_checkpoint
 from infretis.classes.engines.factory import create_engines
-from infretis.classes.formatter import get_log_formatter
+from infretis.classes.formatter import (
+    PATH_ARCHIVE,
+    PATH_FORMATS,
+    get_log_formatter,
+)
 from infretis.classes.path import load_paths_from_disk
-from infretis.classes.repex import REPEX_state
+from infretis.classes.repex import PRECISIONS, REPEX_state
 from infretis.core.tis import run_md
+from infretis.metrics import FORMATS as METRICS_FORMATS
+from infretis.socketrunner import SocketRunner
 
 logger = logging.getLogger("main")
 logger.setLevel(logging.DEBUG)
 
+# the runner backends that can be selected in the [runner] section
+RUNNERS = {
+    "local": aiorunner,
+    "socket": SocketRunner,
+}
+
 
 class TOMLConfigError(Exception):
     """Raised when there is an error in the .toml configuration."""
@@ -37,16 +57,28 @@ def setup_internal(config: dict) -> Tuple[dict, REPEX_state]:
     """
     # setup logger
     setup_logger()
+    # the time of each phase, reported at the end
+    timings = {}
+    last = time.perf_counter()
+
+    def lap(phase):
+        nonlocal last
+        now = time.perf_counter()
+        timings[phase] = now - last
+        last = now
 
     # setup repex
     state = REPEX_state(config, minus=True)
 
     # setup ensembles
     state.initiate_ensembles()
+    lap("repex")
 
     # load paths from disk and add to repex
     paths = load_paths_from_disk(config)
+    lap("load paths")
     state.load_paths(paths)
+    lap("weights")
 
     # create first md_items dict
     md_items = {
@@ -58,18 +90,28 @@ def setup_internal(config: dict) -> Tuple[dict, REPEX_state]:
     # setup the engine_occupation list
     _, engine_occ = create_engines(config)
     state.engine_occ = engine_occ
+    lap("engines")
+
+    logger.info(
+        f"setup of {len(paths)} paths in {sum(timings.values()):.2f} s: "
+        + ", ".join(f"{key} {value:.2f} s" for key, value in timings.items())
+    )
 
     return md_items, state
 
 
-def setup_runner(state: REPEX_state) -> Tuple[aiorunner, future_list]:
+def setup_runner(
+    state: REPEX_state,
+) -> Tuple[Union[aiorunner, SocketRunner], future_list]:
     """Set the task runner class up.
 
     Args:
         state: A REPEX state from which to get the config dict
     """
     # setup client with state.workers workers
-    runner = aiorunner(state.config, state.config["runner"]["workers"])
+    backend = state.config["runner"].get("backend", "local")
+    n_workers = state.config["runner"]["workers"] + state.speculative
+    runner = RUNNERS[backend](state.config, n_workers)
 
     # Attach the run_md task and start the runner's workers
     runner.set_task(run_md)
@@ -112,6 +154,9 @@ def setup_config(
     if "current" in config:
         curr = config["current"]
 
+        # apply the steps saved after the restart file was written
+        load_checkpoint(config, inp)
+
         # if cstep and steps are equal, we stop here.
         if curr.get("cstep") == curr.get("restarted_from", -1):
             return None
@@ -123,7 +168,8 @@ def setup_config(
         load_dir = config["simulation"].get("load_dir", "trajs")
         for act in config["current"]["active"]:
             store_p = os.path.join(load_dir, str(act), "traj.txt")
-            if not os.path.isfile(store_p):
+            archive_p = os.path.join(load_dir, str(act), PATH_ARCHIVE)
+            if not os.path.isfile(store_p) and not os.path.isfile(archive_p):
                 return None
     else:
         # no 'current' in toml, start from step 0.
@@ -220,6 +266,97 @@ def check_config(config: dict) -> None:
     if n_workers > n_ens - 1:
         raise TOMLConfigError("Too many workers defined!")
 
+    speculative = config["runner"].get("speculative", 0)
+    if not isinstance(speculative, int) or speculative < 0:
+        raise TOMLConfigError("speculative must be a non-negative integer!")
+
+    max_retries = config["runner"].get("max_retries", DEFAULT_MAX_RETRIES)
+    if not isinstance(max_retries, int) or max_retries < 0:
+        raise TOMLConfigError("max_retries must be a non-negative integer!")
+
+    for section, key in (
+        ("runner", "affinity"),
+        ("simulation", "prefetch_prob"),
+    ):
+        if not isinstance(config[section].get(key, False), bool):
+            raise TOMLConfigError(f"{key} must be true or false!")
+
+    for key in ("prob_cache", "max_exact_block"):
+        value = config["simulation"].get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise TOMLConfigError(f"{key} must be a non-negative integer!")
+
+    for section, key in (
+        ("simulation", "random_tol"),
+        ("runner", "heartbeat"),
+        ("runner", "heartbeat_timeout"),
+    ):
+        value = config[section].get(key, 1.0)
+        if not isinstance(value, (int, float)) or value <= 0:
+            raise TOMLConfigError(f"{key} must be a positive number!")
+
+    if config["runner"].get("drain_timeout", 0.0) < 0:
+        raise TOMLConfigError("drain_timeout must be non-negative!")
+
+    wmdrun = config["runner"].get("wmdrun", False)
+    if wmdrun and len(wmdrun) < n_workers + speculative:
+        raise TOMLConfigError(
+            f"Define a wmdrun for each of the {n_workers + speculative}"
+            " workers!"
+        )
+
+    metrics_format = config.get("output", {}).get("metrics_format", "jsonl")
+    if metrics_format not in METRICS_FORMATS:
+        raise TOMLConfigError(
+            f"Unknown metrics_format '{metrics_format}', choose from"
+            f" {list(METRICS_FORMATS)}"
+        )
+
+    checkpoint = config.get("output", {}).get("checkpoint", "toml")
+    if checkpoint not in CHECKPOINT_FORMATS:
+        raise TOMLConfigError(
+            f"Unknown checkpoint '{checkpoint}', choose from"
+            f" {list(CHECKPOINT_FORMATS)}"
+        )
+    if config.get("output", {}).get("checkpoint_compact", 100) < 1:
+        raise TOMLConfigError("checkpoint_compact must be at least 1!")
+
+    if config["simulation"].get("load_workers", 4) < 1:
+        raise TOMLConfigError("load_workers must be at least 1!")
+
+    path_format = config.get("output", {}).get("path_format", "txt")
+    if path_format not in PATH_FORMATS:
+        raise TOMLConfigError(
+            f"Unknown path_format '{path_format}', choose from"
+            f" {list(PATH_FORMATS)}"
+        )
+
+    if config.get("output", {}).get("data_flush", 0.0) < 0:
+        raise TOMLConfigError("data_flush must be non-negative!")
+
+    queue = config["runner"].get("queue", "fifo")
+    if queue not in QUEUES:
+        raise TOMLConfigError(
+            f"Unknown runner queue '{queue}', choose from {list(QUEUES)}"
+        )
+
+    pick_convergence = config["simulation"].get("pick_convergence", 0)
+    if pick_convergence < 0:
+        raise TOMLConfigError("pick_convergence must be non-negative!")
+
+    precision = config["simulation"].get("prob_precision", "longdouble")
+    if precision not in PRECISIONS:
+        raise TOMLConfigError(
+            f"Unknown prob_precision '{precision}', choose from"
+            f" {list(PRECISIONS)}"
+        )
+
+    backend = config["runner"].get("backend", "local")
+    if backend not in RUNNERS:
+        raise TOMLConfigError(
+            f"Unknown runner backend '{backend}', choose from {list(RUNNERS)}"
+        )
+
     if sorted(intf) != intf:
         raise TOMLConfigError("Your interfaces are not sorted!")
 
@@ -275,8 +412,8 @@ def check_config(config: dict) -> None:
         config["current"]["tsubcycles"] = 0
     # if increased number of workers
     wsub_num = len(config["current"]["wsubcycles"])
-    if wsub_num < config["runner"]["workers"]:
-        extra = config["runner"]["workers"] - wsub_num
+    if wsub_num < n_workers + speculative:
+        extra = n_workers + speculative - wsub_num
         config["current"]["wsubcycles"] += [0] * extra
 
 
@@ -0,0 +1,511 @@
+"""A socket-based task runner for running infRETIS over several nodes.
+
+The runner is a drop-in replacement for the
+:py:class:`infretis.asyncrunner.aiorunner`, selected with
+`backend = "socket"` in the [runner] section. Instead of starting a
+local process pool, the scheduler listens on a TCP or Unix socket and
+dispatches work to worker daemons (`infretisworker`) that connect to
+it, possibly from other nodes sharing the same file system.
+
+The protocol is a small set of pickled tuples sent over
+:py:mod:`multiprocessing.connection` connections, authenticated with a
+shared key, `authkey` in the [runner] section or the INFRETIS_AUTHKEY
+environment variable. Anyone with the key can run code on the runner
+and the workers, so the key is required for addresses other machines
+can reach. On a loopback or Unix socket address without a key, the
+runner makes a random key and prints it:
+
+* worker -> runner: ("hello", worker_id), ("heartbeat",),
+  ("result", task_id, success, result or exception)
+* runner -> worker: ("init", config, heartbeat), ("task", task_id,
+  task_f, pickled work_unit), ("stop",)
+
+Results are sent back pickled as well, see
+:py:func:`infretis.asyncrunner.run_pickled`.
+
+Workers send heartbeats at a regular interval, also while they are
+running a task. A worker that stops sending heartbeats, or whose
+connection breaks, is dropped and the work it was running is put back
+first in the queue, so the pick is redone by another worker, up to
+`max_retries` times per task. Workers
+reconnect by themselves if the connection is lost, e.g. when the
+scheduler is restarted.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import logging
+import os
+import pickle
+import secrets
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from infretis.asyncrunner import (
+    DEFAULT_MAX_RETRIES,
+    RunnerError,
+    run_pickled,
+    unpickle_result,
+    worker_initializer,
+)
+
+logger = logging.getLogger("main")
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_ADDRESS = "localhost:8786"
+AUTHKEY_ENV = "INFRETIS_AUTHKEY"
+DEFAULT_HEARTBEAT = 5.0
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Address:
+    """Convert an address string to a socket address.
+
+    Args:
+        address: either "host:port" for a TCP socket, or
+            "unix:/path/to/socket" for a Unix socket.
+
+    Returns:
+        A (host, port) tuple for TCP sockets or a path for Unix sockets.
+    """
+    if address.startswith("unix:"):
+        return address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(
+            f"Runner address '{address}' is not 'host:port' or 'unix:path'"
+        )
+    return (host, int(port))
+
+
+def is_loopback(address: Address) -> bool:
+    """Check that only this machine can connect to an address.
+
+    Args:
+        address: a socket address from :py:func:`parse_address`
+    """
+    if isinstance(address, str):
+        return True
+    try:
+        host = socket.gethostbyname(address[0])
+    except OSError:
+        return False
+    return ipaddress.ip_address(host).is_loopback
+
+
+def runner_authkey(authkey: Optional[str], address: Address) -> str:
+    """Return the key to authenticate the worker connections with.
+
+    Args:
+        authkey: the [runner] authkey, if any
+        address: the socket address the runner listens on
+
+    Returns:
+        The `authkey`, or else the INFRETIS_AUTHKEY environment
+        variable. Without either, a random key for a loopback address,
+        which is printed and set in the environment of this process.
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if authkey:
+        return authkey
+    if not is_loopback(address):
+        raise RunnerError(
+            f"The runner address {address} is not a loopback address, "
+            f"set [runner] authkey or {AUTHKEY_ENV}"
+        )
+    authkey = secrets.token_hex(16)
+    os.environ[AUTHKEY_ENV] = authkey
+    print(f"Runner authkey for the workers: {AUTHKEY_ENV}={authkey}")
+    return authkey
+
+
+class _Worker:
+    """The runner side of a connected worker daemon."""
+
+    def __init__(self, conn: Connection, worker_id: Optional[int]) -> None:
+        """Set up the worker.
+
+        Args:
+            conn: the connection to the worker daemon
+            worker_id: the id the worker daemon was started with
+        """
+        self.conn = conn
+        self.worker_id = worker_id
+        self.last_seen = time.monotonic()
+        self.task_id: Optional[int] = None
+        self.alive = True
+        self.send_lock = threading.Lock()
+
+    def send(self, msg: Tuple[Any, ...]) -> None:
+        """Send a message to the worker daemon."""
+        with self.send_lock:
+            self.conn.send(msg)
+
+
+class SocketRunner:
+    """A runner dispatching work to worker daemons over sockets.
+
+    The runner has the same interface as the
+    :py:class:`infretis.asyncrunner.aiorunner`: attach a task function,
+    start the runner, submit work and get futures back.
+    """
+
+    def __init__(self, config: Dict, n_workers: int = 1) -> None:
+        """Init function of runner.
+
+        Args:
+            config: the configuration dictionary
+            n_workers: number of workers active in the runner
+        """
+        runner_cfg = config.get("runner", {})
+        self._config = config
+        self._n_workers = n_workers
+        self._heartbeat: float = runner_cfg.get("heartbeat", DEFAULT_HEARTBEAT)
+        self._timeout: float = runner_cfg.get(
+            "heartbeat_timeout", 6 * self._heartbeat
+        )
+        self._max_retries: int = runner_cfg.get(
+            "max_retries", DEFAULT_MAX_RETRIES
+        )
+        self.failures: List[Dict[str, Any]] = []
+        address = parse_address(runner_cfg.get("address", DEFAULT_ADDRESS))
+        authkey = runner_authkey(runner_cfg.get("authkey"), address)
+        self._listener = Listener(address, authkey=authkey.encode())
+        self._task_f: Optional[Callable] = None
+        self._started = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._next_id = 0
+        self._pending: Deque[Tuple[int, Any, Future]] = deque()
+        self._running: Dict[int, Tuple[_Worker, Any, Future]] = {}
+        self._sent: Dict[int, int] = {}
+        self._workers: List[_Worker] = []
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def address(self) -> Address:
+        """Return the address the runner is listening on."""
+        return self._listener.address
+
+    def set_task(self, task_f: Callable) -> None:
+        """Attach the task function to the runner.
+
+        Args:
+            task_f: a callable function, importable by the workers
+        """
+        self._task_f = task_f
+
+    def start(self) -> None:
+        """Start accepting worker daemons."""
+        if not self._task_f:
+            raise RunnerError("Can't start task(s) without a task function.")
+        for target in (self._accept_workers, self._monitor_workers):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._started = True
+        logger.info("Runner listening on %s", self.address)
+
+    def n_workers(self) -> int:
+        """Return runner number of workers."""
+        return self._n_workers
+
+    def submit_work(self, work_unit: Dict[str, Any]) -> Future:
+        """Submit work to the runner.
+
+        Args:
+            work_unit: a unit of work encapsulated in a dict
+
+        Return:
+            A future wih the results of the work
+        """
+        if not self._started:
+            raise RunnerError(
+                "Unable to submit work if the runner hasn't been started"
+            )
+        future: Future = Future()
+        with self._cond:
+            self._pending.append((self._next_id, work_unit, future))
+            self._next_id += 1
+            self._dispatch()
+        return future
+
+    def stop(self, wait: bool = True) -> None:
+        """Process the remaining work, then stop the worker daemons.
+
+        The futures of work that is dropped get a RunnerError.
+
+        Args:
+            wait: if False, the remaining work is dropped. The daemons
+                finish the task they are running before they stop. The
+                work is also dropped if no daemon is connected.
+        """
+        with self._cond:
+            while wait and self._workers and (self._pending or self._running):
+                self._cond.wait()
+            self._stopping = True
+            workers = list(self._workers)
+            dropped = [future for _, _, future in self._pending]
+            dropped += [future for _, _, future in self._running.values()]
+            self._pending.clear()
+            self._running.clear()
+            self._sent.clear()
+        if dropped:
+            logger.warning("Runner stopped, dropping %d tasks", len(dropped))
+        for future in dropped:
+            if not future.done():
+                future.set_exception(RunnerError("The runner was stopped"))
+        for worker in workers:
+            try:
+                worker.send(("stop",))
+            except OSError:
+                pass
+            self._drop_worker(worker)
+        self._listener.close()
+
+    def _accept_workers(self) -> None:
+        """Accept new worker daemons until the runner is stopped."""
+        while not self._stopping:
+            try:
+                conn = self._listener.accept()
+                msg = conn.recv()
+                assert msg[0] == "hello"
+                worker = _Worker(conn, msg[1])
+                worker.send(("init", self._config, self._heartbeat))
+            except Exception:
+                if self._stopping:
+                    return
+                logger.warning("A worker failed to connect to the runner")
+                continue
+            with self._cond:
+                self._workers.append(worker)
+                self._dispatch()
+            logger.info("Worker %s connected to the runner", msg[1])
+            thread = threading.Thread(
+                target=self._listen_to_worker, args=(worker,), daemon=True
+            )
+            thread.start()
+
+    def _listen_to_worker(self, worker: _Worker) -> None:
+        """Receive heartbeats and results from a worker daemon."""
+        while worker.alive:
+            try:
+                msg = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            worker.last_seen = time.monotonic()
+            if msg[0] != "result":
+                continue
+            _, task_id, success, result = msg
+            with self._cond:
+                running = self._running.get(task_id)
+                if running is None or running[0] is not worker:
+                    # the task was resubmitted after losing this worker
+                    continue
+                del self._running[task_id]
+                worker.task_id = None
+                n_sent = self._sent.pop(task_id)
+                if success:
+                    running[2].set_result(unpickle_result(result, n_sent))
+                else:
+                    running[2].set_exception(result)
+                self._dispatch()
+                self._cond.notify_all()
+        self._drop_worker(worker)
+
+    def _monitor_workers(self) -> None:
+        """Drop workers that stopped sending heartbeats."""
+        while not self._stopping:
+            time.sleep(self._heartbeat)
+            now = time.monotonic()
+            with self._cond:
+                workers = list(self._workers)
+            for worker in workers:
+                if now - worker.last_seen > self._timeout:
+                    logger.warning(
+                        "No heartbeat from worker %s for %.1f s",
+                        worker.worker_id,
+                        now - worker.last_seen,
+                    )
+                    self._drop_worker(worker)
+
+    def _drop_worker(self, worker: _Worker) -> None:
+        """Close the connection to a worker and resubmit its work."""
+        with self._cond:
+            if not worker.alive:
+                return
+            worker.alive = False
+            self._workers.remove(worker)
+            if worker.task_id is not None and not self._stopping:
+                task_id = worker.task_id
+                _, work_unit, future = self._running.pop(task_id)
+                del self._sent[task_id]
+                worker.task_id = None
+                self.failures.append(
+                    {
+                        "time": time.time(),
+                        "task": task_id,
+                        "worker": worker.worker_id,
+                        "error": "lost worker",
+                    }
+                )
+                n_failed = sum(i["task"] == task_id for i in self.failures)
+                if n_failed > self._max_retries:
+                    logger.warning(
+                        "Lost worker %s, giving up on its work",
+                        worker.worker_id,
+                    )
+                    future.set_exception(
+                        RunnerError(f"Task {task_id} failed {n_failed} times")
+                    )
+                else:
+                    logger.warning(
+                        "Lost worker %s, resubmitting its work",
+                        worker.worker_id,
+                    )
+                    self._pending.appendleft((task_id, work_unit, future))
+            self._dispatch()
+            self._cond.notify_all()
+        worker.conn.close()
+
+    def _dispatch(self) -> None:
+        """Send pending work to idle workers, must hold the lock.
+
+        Work with a pin waits for the worker daemon with the same id if
+        that one is connected, to keep its engines warm. Other work, and
+        work pinned to a daemon that is not connected, goes to the first
+        idle worker.
+        """
+        waiting: Deque[Tuple[int, Any, Future]] = deque()
+        while self._pending and not self._stopping:
+            idle = [w for w in self._workers if w.task_id is None]
+            if not idle:
+                break
+            task_id, work_unit, future = self._pending.popleft()
+            pin = work_unit.get("pin") if isinstance(work_unit, dict) else None
+            pinned = [w for w in self._workers if w.worker_id == pin]
+            if pinned and pinned[0].task_id is not None:
+                waiting.append((task_id, work_unit, future))
+                continue
+            worker = pinned[0] if pinned else idle[0]
+            payload = pickle.dumps(work_unit)
+            try:
+                worker.send(("task", task_id, self._task_f, payload))
+            except OSError:
+                self._pending.appendleft((task_id, work_unit, future))
+                worker.alive = False
+                self._workers.remove(worker)
+                worker.conn.close()
+                continue
+            worker.task_id = task_id
+            self._running[task_id] = (worker, work_unit, future)
+            self._sent[task_id] = len(payload)
+        self._pending.extendleft(reversed(waiting))
+
+
+def _send_heartbeats(
+    conn: Connection,
+    send_lock: threading.Lock,
+    interval: float,
+    stop: threading.Event,
+) -> None:
+    """Send heartbeats to the runner until stop is set."""
+    while not stop.wait(interval):
+        try:
+            with send_lock:
+                conn.send(("heartbeat",))
+        except OSError:
+            return
+
+
+def _sendable_error(error: Exception, trace: str) -> Exception:
+    """Return the error of a task, or a RunnerError if it can't be sent.
+
+    Args:
+        error: the exception raised by the task
+        trace: the formatted traceback of the exception
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RunnerError(f"{error!r}\n{trace}")
+    return error
+
+
+def worker_daemon(
+    address: str = DEFAULT_ADDRESS,
+    authkey: Optional[str] = None,
+    worker_id: int = 0,
+    reconnect: float = 60.0,
+) -> None:
+    """Run a worker daemon that executes work from a socket runner.
+
+    The daemon connects to the runner, receives the configuration,
+    initializes its engines once, and then runs tasks until the runner
+    tells it to stop. If the connection is lost, the daemon keeps trying
+    to reconnect for `reconnect` seconds before giving up.
+
+    Args:
+        address: the address of the runner, "host:port" or "unix:path"
+        authkey: the key shared with the runner, by default the
+            INFRETIS_AUTHKEY environment variable
+        worker_id: the id of this worker, used for the log file and
+            for dispatching pinned work
+        reconnect: how long to keep trying to (re)connect, in seconds
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise RunnerError(
+            f"No key to connect to the runner, set {AUTHKEY_ENV} to the "
+            "[runner] authkey or to the key printed by the runner"
+        )
+    initialized = False
+    last_connected = time.monotonic()
+    while True:
+        try:
+            conn = Client(parse_address(address), authkey=authkey.encode())
+        except OSError:
+            if time.monotonic() - last_connected > reconnect:
+                return
+            time.sleep(min(1.0, reconnect / 10))
+            continue
+        send_lock = threading.Lock()
+        stop = threading.Event()
+        try:
+            conn.send(("hello", worker_id))
+            _, config, heartbeat = conn.recv()
+            if not initialized:
+                worker_initializer(None, config, worker_id)
+                initialized = True
+            threading.Thread(
+                target=_send_heartbeats,
+                args=(conn, send_lock, heartbeat, stop),
+                daemon=True,
+            ).start()
+            while True:
+                msg = conn.recv()
+                if msg[0] == "stop":
+                    return
+                _, task_id, task_f, payload = msg
+                try:
+                    data = run_pickled(task_f, payload)
+                    reply = ("result", task_id, True, data)
+                except Exception as e:
+                    error = _sendable_error(e, traceback.format_exc())
+                    reply = ("result", task_id, False, error)
+                with send_lock:
+                    conn.send(reply)
+        except (EOFError, OSError):
+            logger.warning("Lost connection to the runner, reconnecting")
+        finally:
+            stop.set()
+            conn.close()
+            last_connected = time.monotonic()
@@ -5,7 +5,7 @@ import os
 
 import numpy as np
 
-from infretis.classes.engines.factory import create_engines
+from infretis.classes.engines.factory import assign_engines, create_engines
 from infretis.setup import setup_config
 
 HERE = pathlib.Path(__file__).resolve().parent
@@ -48,3 +48,14 @@ def test_potential_curves(tmp_path: pathlib.PosixPath):
         en0.append(e0.potential[0].potential(e1.system))
         en1.append(e1.potential[0].potential(e1.system))
     assert not np.allclose(en0, en1)
+
+
+def test_assign_engines_keeps_warm_engine():
+    """Test that a worker gets back the engine it used previously."""
+    engine_occ = {"engine": [-1, -1, -1]}
+    assert assign_engines(engine_occ, ["engine"], 0) == {"engine": 0}
+    assert assign_engines(engine_occ, ["engine"], 1) == {"engine": 1}
+    assert assign_engines(engine_occ, ["engine"], 2) == {"engine": 2}
+    # worker 1 frees its engine, but should get the same one back
+    assert assign_engines(engine_occ, ["engine"], 1) == {"engine": 1}
+    assert engine_occ["engine"] == [0, 1, 2]
@@ -1,7 +1,12 @@
 import numpy as np
 import pytest
 
-from infretis.classes.repex import REPEX_state
+from infretis.classes import repex
+from infretis.classes.repex import (
+    RANDOM_CHECK,
+    REPEX_state,
+    glynn_row_sums,
+)
 
 W_MATRIX1 = np.array(
     [
@@ -62,24 +67,43 @@ W_MATRIX3 = np.array([[1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
 [0, 1, 127, 113, 90, 89, 79, 49, 39, 31, 15, 3, 0, 0],
 [0, 1, 2452, 1898, 704, 702, 700, 700, 23904, 21818, 18418, 6382, 2322, 988],
 [0, 1, 2452, 1898, 704, 702, 700, 700, 23904, 21818, 18418, 6382, 2322, 988],
-[0, 1, 444, 444, 372, 350, 322, 258, 192, 108, 90, 202, 190, 164]], dtype=np.float64)
+[0, 1, 444, 444, 372, 350, 322, 258, 192, 108, 90, 202, 190, 164]],
+    dtype=np.float64)
 
 PERMANENT1 = 4.0
 PERMANENT2 = 10508395762604.0
-# I guess this should really be positive but.. maybe in the future with better permanent algos
+# I guess this should really be positive but.. maybe in the future with
+# better permanent algos
 PERMANENT3 = -4.456605869717995727e+25
 
 
-def test_matrix1():
-    """Test ..."""
-    state = REPEX_state(
+def staircase(n, seed=0):
+    """Return a random W matrix of paths reaching the next interface."""
+    rgen = np.random.default_rng(seed)
+    w_matrix = np.zeros((n, n))
+    for i in range(n):
+        top = min(i + 2, n)
+        w_matrix[i, :top] = rgen.random(top) * 10 ** rgen.uniform(0, 3, top)
+    return w_matrix
+
+
+def precision_state(precision="longdouble"):
+    """Return a REPEX state with the given P matrix precision."""
+    return REPEX_state(
         {
             "current": {"size": 1, "cstep": 0},
             "runner": {"workers": 1},
             "simulation": {"seed": 0, "steps":10,
-                           "zeroswap": 0.5, "pick_scheme": 0},
-        }
+                           "zeroswap": 0.5, "pick_scheme": 0,
+                           "prob_precision": precision},
+        },
+        minus=True
     )
+
+
+def test_matrix1():
+    """Test ..."""
+    state = precision_state()
     p_matrix = state.permanent_prob(W_MATRIX1)
     permanent = state.fast_glynn_perm(W_MATRIX1)
     assert pytest.approx(p_matrix) == P_MATRIX1
@@ -88,14 +112,7 @@ def test_matrix1():
 
 def test_matrix2():
     """Test ..."""
-    state = REPEX_state(
-        {
-            "current": {"size": 1, "cstep": 0},
-            "runner": {"workers": 1},
-            "simulation": {"seed": 0, "steps":10,
-                           "zeroswap": 0.5, "pick_scheme": 0},
-        }
-    )
+    state = precision_state()
     p_matrix = state.permanent_prob(W_MATRIX2)
     permanent = state.fast_glynn_perm(W_MATRIX2)
     assert pytest.approx(p_matrix) == P_MATRIX2
@@ -104,19 +121,11 @@ def test_matrix2():
 
 def test_matrix3(caplog):
     """This w matrix technically give negative number in the p matrix.
-     But we check here that no zeros are present.
+     But we check here that no negative numbers are present.
 
     """
     import logging
-    state = REPEX_state(
-        {
-            "current": {"size": 1, "cstep": 0},
-            "runner": {"workers": 1},
-            "simulation": {"seed": 0, "steps":10,
-                           "zeroswap": 0.5, "pick_scheme": 0},
-        },
-        minus=True
-    )
+    state = precision_state()
     locks = np.zeros(W_MATRIX3.shape[0])
     with caplog.at_level(logging.INFO):
         # this versions makes negative numbers zero
@@ -125,10 +134,174 @@ def test_matrix3(caplog):
     p_matrix2 = state.permanent_prob(W_MATRIX3)
     assert np.sum(np.abs(p_matrix1-p_matrix2)) < 10**(-5)
     assert np.sum(p_matrix1<0) == 0
-    assert np.sum(p_matrix2<0) > 1
-    assert np.abs(p_matrix2[p_matrix2<0])[0] < 10**(-10)
-    assert "errors in the P-matrix," in caplog.text
+    # the minors of the balanced W matrix give no negative numbers
+    assert np.sum(p_matrix2<0) == 0
+    assert "errors in the P-matrix," not in caplog.text
 
     permanent = state.fast_glynn_perm(W_MATRIX3)
     assert pytest.approx(permanent) == PERMANENT3
 
+
+def test_glynn_chunks():
+    """The row sums do not depend on the chunking of the Gray code."""
+    chunks = [np.concatenate(list(zip(*glynn_row_sums(W_MATRIX2, c)))[i])
+              for c in (3, 4096) for i in (0, 1)]
+    assert np.array_equal(chunks[0], chunks[2])
+    assert np.array_equal(chunks[1], chunks[3])
+
+
+def test_all_minor_perms():
+    """Test the permanents of all the minors of a matrix at once."""
+    state = precision_state()
+    minors = state.all_minor_perms(W_MATRIX2)
+    for i in range(len(W_MATRIX2)):
+        for j in range(len(W_MATRIX2)):
+            minor = np.delete(np.delete(W_MATRIX2, i, axis=0), j, axis=1)
+            expected = state.fast_glynn_perm(minor)
+            assert pytest.approx(minors[i, j], abs=1e-12) == expected
+    p_matrix = state.gradient_prob(W_MATRIX2)
+    assert pytest.approx(p_matrix) == P_MATRIX2
+
+
+def test_large_block():
+    """Blocks larger than 12 get an exact P matrix too."""
+    state = precision_state()
+    n = 15
+    rgen = np.random.default_rng(0)
+    w_matrix = np.zeros((n, n))
+    w_matrix[0, 0] = 1.0
+    for i in range(1, n):
+        top = min(i + 2, n)
+        w_matrix[i, 1:top] = rgen.random(top - 1) * 10 ** rgen.uniform(0, 3)
+    p_matrix = state.inf_retis(w_matrix, np.zeros(n))
+    assert state._random_count == 0
+    exact = state.permanent_prob(w_matrix[1:, 1:])
+    assert np.allclose(p_matrix[1:, 1:], exact)
+
+
+def test_block_reuse():
+    """The P matrices and their blocks are reused from the caches."""
+    state = precision_state()
+    p_matrix = state.inf_retis(W_MATRIX2, np.zeros(6))
+    assert len(state._block_probs) == 1
+
+    def fail(arr):
+        raise AssertionError("the block should be reused")
+
+    state.permanent_prob = fail
+    assert np.array_equal(state.inf_retis(W_MATRIX2, np.zeros(6)), p_matrix)
+    assert state.cache_hits == {"prob": 1, "block": 0}
+
+    # the same block with other locks
+    w_matrix = np.zeros((7, 7))
+    w_matrix[:6, :6] = W_MATRIX2
+    w_matrix[6, 6] = 1.0
+    locks = np.zeros(7)
+    locks[6] = 1
+    p_matrix2 = state.inf_retis(w_matrix, locks)
+    assert np.array_equal(p_matrix2[:6, :6], p_matrix)
+    assert state.cache_hits == {"prob": 1, "block": 1}
+
+    # the least recently used P matrix is dropped
+    state.prob_cache = 1
+    state.inf_retis(W_MATRIX1, np.zeros(8))
+    assert len(state._prob_cache) == 1
+    state.inf_retis(w_matrix, locks)
+    assert state.cache_hits["prob"] == 1
+
+
+def test_random_prob():
+    """The sampled P matrix is reproducible and stops when converged."""
+    states = [precision_state() for _ in range(4)]
+    p_matrix = states[0].random_prob(W_MATRIX2)
+    exact = states[0].permanent_prob(W_MATRIX2)
+    assert np.allclose(p_matrix, exact, atol=0.02)
+    assert np.array_equal(states[1].random_prob(W_MATRIX2), p_matrix)
+
+    # a loose tolerance stops once the chains agree, here after the
+    # burn-in and two doublings of the sweeps
+    states[2].random_tol = 1.0
+    states[2].random_prob(W_MATRIX2)
+    states[3].random_prob(W_MATRIX2, n=4 * RANDOM_CHECK)
+    assert states[2].rgen.random() == states[3].rgen.random()
+
+
+@pytest.mark.parametrize("kind", ["flat", "staircase"])
+def test_random_prob_exact(kind):
+    """The sampled P matrices of large blocks match the exact ones."""
+    state = precision_state("float64")
+    if kind == "flat":
+        w_matrix = np.ones((40, 40))
+        exact = np.full((40, 40), 1 / 40)
+    else:
+        w_matrix = staircase(20)
+        exact = state.permanent_prob(w_matrix)
+    p_matrix = state.random_prob(w_matrix)
+    assert np.allclose(p_matrix, exact, rtol=0, atol=0.02)
+    # the chains do not stay close to their start
+    assert np.allclose(np.diag(p_matrix), np.diag(exact), rtol=0, atol=0.01)
+
+
+@pytest.mark.parametrize(
+    "w_matrix, atol",
+    [
+        (W_MATRIX1, 1e-14),
+        (W_MATRIX2, 1e-14),
+        # the longdouble P matrix has the larger error here
+        (W_MATRIX3, 1e-7),
+        (staircase(12), 1e-12),
+        (staircase(16), 1e-12),
+    ],
+)
+def test_float64_precision(w_matrix, atol):
+    """The float64 P matrices match the longdouble ones."""
+    locks = np.zeros(len(w_matrix))
+    p_long = precision_state("longdouble").inf_retis(w_matrix, locks)
+    p_float = precision_state("float64").inf_retis(w_matrix, locks)
+    assert p_long.dtype == np.longdouble
+    assert p_float.dtype == np.float64
+    assert np.allclose(p_float, p_long, rtol=0, atol=atol)
+
+
+def test_float64_cost(monkeypatch):
+    """The float64 P matrix passes half the bytes through Glynn's sums."""
+    costs = {}
+    glynn_row_sums = repex.glynn_row_sums
+
+    def counting_row_sums(*args, **kwargs):
+        for chunk in glynn_row_sums(*args, **kwargs):
+            cost["states"] += len(chunk[1])
+            cost["bytes"] += chunk[1].nbytes
+            yield chunk
+
+    monkeypatch.setattr(repex, "glynn_row_sums", counting_row_sums)
+    w_matrix = staircase(16)
+    for precision in ("longdouble", "float64"):
+        cost = costs[precision] = {"states": 0, "bytes": 0}
+        precision_state(precision).inf_retis(w_matrix, np.zeros(16))
+    # the same Gray-code states, float64 is not redone in longdouble
+    assert costs["float64"]["states"] == costs["longdouble"]["states"] > 0
+    # 8 bytes per row sum instead of the 16 of longdouble (on x86-64)
+    ratio = np.dtype("longdouble").itemsize / np.dtype("float64").itemsize
+    assert costs["longdouble"]["bytes"] == ratio * costs["float64"]["bytes"]
+
+
+@pytest.mark.parametrize("n", [2, 7, 30, 120])
+def test_quick_prob(n):
+    """The vectorized quick_prob matches the one ensemble at a time."""
+    state = precision_state("longdouble")
+    rgen = np.random.default_rng(n)
+    w_matrix = np.zeros((n, n + 1))
+    for i in range(n):
+        top = min(i + 1 + int(rgen.random() < 0.75), n)
+        w_matrix[i, 1 : top + 1] = 1.0
+    p_matrix = state.quick_prob(w_matrix)
+    assert np.allclose(p_matrix, state.quick_prob_loop(w_matrix))
+    assert np.allclose(np.sum(p_matrix, axis=1), 1)
+    assert np.allclose(np.sum(p_matrix[:, 1:], axis=0), 1)
+
+    # not a staircase
+    w_matrix = np.array([[1.0, 0.0, 1.0], [1.0, 1.0, 0.0], [1.0, 1.0, 1.0]])
+    assert np.array_equal(
+        state.quick_prob(w_matrix), state.quick_prob_loop(w_matrix)
+    )
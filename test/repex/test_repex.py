@@ -1,8 +1,28 @@
 import os
+import threading
+import time
 from pathlib import PosixPath
+
+import numpy as np
+import pytest
 import tomli
 
-from infretis.classes.repex import REPEX_state, spawn_rng
+from infretis.archive import Archiver
+from infretis.checkpoint import (
+    CheckpointLog,
+    frac_table,
+    load_checkpoint,
+    log_file,
+)
+from infretis.classes import repex
+from infretis.classes.path import Path
+from infretis.classes.repex import (
+    REPEX_state,
+    cumulative,
+    sample_cdf,
+    spawn_rng,
+)
+from infretis.data import DataWriter, parse_rows, read_data
 
 
 def test_rgen_io(tmp_path: PosixPath) -> None:
@@ -41,3 +61,235 @@ def test_rgen_io(tmp_path: PosixPath) -> None:
         assert state.rgen.random() == rng
         child = spawn_rng(state.rgen)
         assert child.random() == child_rng
+
+
+def test_ens_acc_restart(tmp_path: PosixPath) -> None:
+    """Test that the accepted paths of the ensembles survive a restart."""
+    config = {
+        "current": {"size": 2, "cstep": 0},
+        "runner": {"workers": 1},
+        "simulation": {"seed": 0, "steps": 10, "zeroswap": 0.5,
+                       "pick_scheme": 0, "pick_convergence": 1.0},
+    }
+    state = REPEX_state(config, minus=True)
+    for ens, weights in ((-1, (1.0,)), (0, (1.0, 1.0)), (1, (1.0, 1.0))):
+        path = Path()
+        path.path_number = ens + 1
+        path.weights = weights
+        state.add_traj(ens, path, valid=weights, count=False)
+    state._ens_acc[:] = [3, 0, 5]
+    cdf = state.pick_cdf()
+    os.chdir(tmp_path)
+    state.write_toml()
+
+    with open("restart.toml", mode="rb") as f:
+        restart = tomli.load(f)
+    assert restart["current"]["ens_acc"] == [3, 0, 5]
+    restarted = REPEX_state(restart, minus=True)
+    for ens, path in zip((-1, 0, 1), state._trajs):
+        restarted.add_traj(ens, path, valid=path.weights, count=False)
+    assert np.array_equal(restarted._ens_acc, state._ens_acc)
+    assert np.array_equal(restarted.pick_cdf(), cdf)
+
+
+def test_prefetch() -> None:
+    """Test that the P matrix after a rejected move is prefetched."""
+    state = REPEX_state(
+        {
+            "current": {"size": 3, "cstep": 0},
+            "runner": {"workers": 1},
+            "simulation": {"seed": 0, "steps": 10,
+                           "zeroswap": 0.5, "pick_scheme": 0},
+        },
+        minus=True,
+    )
+    paths = []
+    for ens, weights in ((-1, (1.0,)), (0, (2.0, 1.0, 0.0)),
+                         (1, (1.0, 3.0, 0.0))):
+        path = Path()
+        path.path_number = ens + 1
+        path.weights = weights
+        state.add_traj(ens, path, valid=weights, count=False)
+        paths.append(path)
+
+    # lock ensemble 0 as if it was picked
+    state.lock(1)
+    state.locked.append(([0], ["1"]))
+    state.prefetch()
+    assert len(state._prob_cache) == 1
+    assert state.cache_misses == {"prob": 0, "block": 0}
+
+    # reject the move, the P matrix is in the cache
+    state.locked.pop()
+    state.add_traj(0, paths[1], valid=paths[1].weights)
+    state.prob
+    assert state.cache_hits["prob"] == 1
+    assert state.cache_misses["prob"] == 0
+
+
+def test_stop_prefetch(monkeypatch) -> None:
+    """Test that the prefetch of a large block stops within a chunk."""
+    state = REPEX_state(
+        {
+            "current": {"size": 20, "cstep": 0},
+            "runner": {"workers": 1},
+            "simulation": {"seed": 0, "steps": 10,
+                           "zeroswap": 0.5, "pick_scheme": 0,
+                           "prefetch_prob": True},
+        },
+        minus=True,
+    )
+    # a single block of the 20 plus ensembles with unequal weights
+    w_matrix = np.zeros((21, 21))
+    w_matrix[0, 0] = 1.0
+    w_matrix[1:, 1:] = np.random.default_rng(0).random((20, 20)) + 0.1
+    state.state = w_matrix
+    state._locks[:] = 0
+    state._locks[1] = 1
+    state.locked.append(([0], ["1"]))
+
+    chunks = []
+    glynn_row_sums = repex.glynn_row_sums
+
+    def stop_after_first_chunk(*args, **kwargs):
+        for chunk in glynn_row_sums(*args, **kwargs):
+            chunks.append(len(chunk[0]))
+            state._prefetch_stop.set()
+            yield chunk
+
+    monkeypatch.setattr(repex, "glynn_row_sums", stop_after_first_chunk)
+    state.start_prefetch()
+    state._prefetch_thread.join()
+    state.stop_prefetch()
+    # 2^19 states in chunks of GLYNN_CHUNK, only the first one is done
+    assert len(chunks) == 1
+    assert not state._prob_cache
+    assert not state._block_probs
+
+
+def test_sample_cdf() -> None:
+    """Test that sampling a cdf gives the same picks as rgen.choice."""
+    weights = np.random.default_rng(0).random(50)
+    weights[weights < 0.7] = 0
+    cdf = cumulative(weights)
+    rgen1, rgen2 = np.random.default_rng(1), np.random.default_rng(1)
+    for _ in range(100):
+        pick = rgen1.choice(50, p=np.nan_to_num(weights / np.sum(weights)))
+        assert sample_cdf(cdf, rgen2) == pick
+
+    with pytest.raises(ValueError):
+        cumulative(np.zeros(5))
+
+
+def test_checkpoint_log(tmp_path: PosixPath) -> None:
+    """Check that restart.toml and its log give the last [current]."""
+    os.chdir(tmp_path)
+    rgen = np.random.default_rng(0)
+    config = {
+        "simulation": {"seed": 0},
+        "current": {"cstep": 0, "active": [0, 1, 2], "frac": {}},
+    }
+    checkpoint = CheckpointLog("restart.toml", compact=3)
+    fracs = {}
+    for cstep in range(1, 9):
+        current = config["current"]
+        current["cstep"] = cstep
+        # retire a path and add a new one, only some fracs change
+        current["active"] = current["active"][1:] + [cstep + 2]
+        fracs = {
+            str(pn): fracs.get(str(pn), np.zeros(3, dtype=np.longdouble))
+            for pn in current["active"]
+        }
+        fracs[str(current["active"][0])] = rgen.random(3).astype(np.longdouble)
+        # rows of the data file, written every fourth step
+        pending = [] if cstep % 4 == 0 else current.get("data_pending", [])
+        current["data_pending"] = pending + [f"\t{cstep}\t10\n"]
+        checkpoint.write(config, fracs)
+
+        current["frac"] = frac_table(fracs)
+        with open("restart.toml", mode="rb") as f:
+            loaded = tomli.load(f)
+        load_checkpoint(loaded, "restart.toml")
+        assert loaded == config
+
+    # the first write and every third write after it rewrite the toml
+    with open(log_file("restart.toml")) as f:
+        assert len(f.readlines()) == 1
+    with open("restart.toml", mode="rb") as f:
+        assert tomli.load(f)["current"]["cstep"] == 7
+
+    # a line cut short by a crash is skipped
+    with open(log_file("restart.toml"), "a") as f:
+        f.write('{"current": {"cstep": 9')
+    with open("restart.toml", mode="rb") as f:
+        loaded = tomli.load(f)
+    assert load_checkpoint(loaded, "restart.toml") == 1
+    assert loaded == config
+
+
+def test_data_restore(tmp_path: PosixPath) -> None:
+    """Check that the rows of a restart are written once."""
+    os.chdir(tmp_path)
+    with open("infretis_data.txt", "w") as f:
+        f.write("# \txxx\tlen\tmax OP\t\t000\t001\n")
+    lines = [
+        f"\t{pn:3.0f}\t{10 * pn:5.0f}\t{0.1 * pn:8.5f}\t----\t0.5\t"
+        "----\t1.0\t\n"
+        for pn in range(3, 7)
+    ]
+    writer = DataWriter("infretis_data.txt", 2, flush=1000.0, binary=True)
+    writer.write(lines[:2], parse_rows("".join(lines[:2]), 2))
+    writer.flush()
+    writer.write(lines[2:], parse_rows("".join(lines[2:]), 2))
+    assert writer.pending() == lines[2:]
+
+    # a crash after the rows were in a restart file, which are written
+    # on restart, also when some of them were written after it
+    restarted = DataWriter("infretis_data.txt", 2, flush=1000.0, binary=True)
+    restarted.restore(lines[1:])
+    restarted.restore(lines[1:])
+    text = read_data("infretis_data.txt", binary=False)
+    binary = read_data("infretis_data.txt")
+    assert list(text["pn"]) == [3, 4, 5, 6]
+    assert list(binary["pn"]) == [3, 4, 5, 6]
+    assert np.array_equal(text["frac"], binary["frac"], equal_nan=True)
+
+
+def test_archiver() -> None:
+    """Check that the archiver keeps the order and raises failures."""
+    done = []
+
+    def slow(i):
+        time.sleep(0.01 * (i % 2))
+        done.append(i)
+
+    def fail():
+        raise OSError("no space left")
+
+    archiver = Archiver()
+    for i in range(5):
+        archiver.submit(slow, i)
+    archiver.wait()
+    assert done == list(range(5))
+
+    # nothing runs after a failure, which is raised by wait()
+    archiver.submit(fail)
+    archiver.submit(slow, 5)
+    with pytest.raises(OSError, match="no space left"):
+        archiver.wait()
+    assert done == list(range(5))
+    archiver.close()
+    assert archiver._thread is None
+
+    # check() raises a failure without waiting for the rest
+    release = threading.Event()
+    archiver.submit(fail)
+    archiver.submit(release.wait)
+    archiver.submit(slow, 6)
+    while archiver._error is None:
+        time.sleep(0.01)
+    with pytest.raises(OSError, match="no space left"):
+        archiver.check()
+    release.set()
+    archiver.close()
+    assert done == list(range(5))
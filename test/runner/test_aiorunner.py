@@ -1,11 +1,13 @@
 from pathlib import PosixPath
-from time import sleep
+from time import process_time, sleep
 from typing import Dict, Any
 import os
+import time
+from concurrent.futures.process import BrokenProcessPool
 
 import pytest
 import asyncio
-from infretis.asyncrunner import aiorunner, future_list
+from infretis.asyncrunner import EnsembleCosts, aiorunner, future_list
 
 class TaskError(Exception):
     """Exception class for the test task."""
@@ -104,6 +106,8 @@ def test_runner_check_return_success():
         futlist.add(runner.submit_work({"duration": 0.3}))
         fut = futlist.as_completed()
         assert fut.result().get("Time slept") == 0.3
+        assert fut.result().get("bytes_sent") > 0
+        assert fut.result().get("bytes_received") > 0
     finally:
         runner.stop()
         loop.close()
@@ -157,3 +161,189 @@ def test_runner_infretis_mode(tmp_path: PosixPath):
         runner.stop()
         loop.close()
         asyncio.set_event_loop(None)
+
+def test_future_list_completion_order():
+    """Test that futures are returned in the order they complete."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        runner = aiorunner({}, 2)
+        futlist = future_list()
+        runner.set_task(sleeping)
+        runner.start()
+        futlist.add(runner.submit_work({"duration": 1.5}))
+        futlist.add(runner.submit_work({"duration": 0.2}))
+        assert futlist.as_completed().result().get("Time slept") == 0.2
+        assert futlist.as_completed().result().get("Time slept") == 1.5
+        assert futlist.as_completed() is None
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def test_future_list_blocking_wait():
+    """Test that waiting on a future does not spin the CPU."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        runner = aiorunner({}, 1)
+        futlist = future_list()
+        runner.set_task(sleeping)
+        runner.start()
+        futlist.add(runner.submit_work({"duration": 1.0}))
+        cpu_start = process_time()
+        futlist.as_completed()
+        assert process_time() - cpu_start < 0.5
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def worker_pid(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the process id of the worker running the task."""
+    inp["pid"] = os.getpid()
+    return inp
+
+def test_runner_affinity(tmp_path: PosixPath):
+    """Test that pinned work always runs in the same worker process."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    os.chdir(tmp_path)
+    try:
+        runner = aiorunner({"runner": {"affinity": True}}, 2)
+        futlist = future_list()
+        runner.set_task(worker_pid)
+        runner.start()
+        pids = {0: set(), 1: set()}
+        for _ in range(3):
+            for pin in (0, 1):
+                futlist.add(runner.submit_work({"pin": pin}))
+            for _ in range(2):
+                result = futlist.as_completed().result()
+                pids[result["pin"]].add(result["pid"])
+        assert len(pids[0]) == 1
+        assert len(pids[1]) == 1
+        assert pids[0] != pids[1]
+        assert "worker0.log" in os.listdir(".")
+        assert "worker1.log" in os.listdir(".")
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def crash_once(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """Kill the worker process, once per marker file if given."""
+    marker = inp.get("marker")
+    if marker is None or not os.path.isfile(marker):
+        if marker is not None:
+            open(marker, "w").close()
+        os._exit(1)
+    return worker_pid(inp)
+
+@pytest.mark.parametrize("affinity", [False, True])
+def test_runner_replace_dead_worker(tmp_path: PosixPath, affinity: bool):
+    """Test that the work of a dead worker process is run again."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    os.chdir(tmp_path)
+    try:
+        runner = aiorunner({"runner": {"affinity": affinity}}, 2)
+        futlist = future_list()
+        runner.set_task(crash_once)
+        runner.start()
+        marker = str(tmp_path / "crashed")
+        futlist.add(runner.submit_work({"pin": 0, "marker": marker}))
+        result = futlist.as_completed().result()
+        assert result["pid"] != os.getpid()
+        assert len(runner.failures) == 1
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def test_runner_max_retries(tmp_path: PosixPath):
+    """Test that a task killing its worker fails after max_retries."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    os.chdir(tmp_path)
+    try:
+        runner = aiorunner({"runner": {"max_retries": 1}}, 1)
+        futlist = future_list()
+        runner.set_task(crash_once)
+        runner.start()
+        futlist.add(runner.submit_work({}))
+        with pytest.raises(BrokenProcessPool):
+            futlist.as_completed().result()
+        assert len(runner.failures) == 2
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def test_ensemble_costs():
+    """Test the predicted cost of tasks in the different ensembles."""
+    costs = EnsembleCosts(alpha=0.5)
+    assert costs.predict({"ens_nums": [0]}) == 0.0
+    costs.update({"ens_nums": [0], "subcycles": 10})
+    costs.update({"ens_nums": [2], "trial_len": [20, 30]})
+    costs.update({"Time slept": 1.0})
+    assert costs.predict({"ens_nums": [0]}) == 10.0
+    assert costs.predict({"ens_nums": [2]}) == 50.0
+    # unknown ensembles get the average cost
+    assert costs.predict({"ens_nums": [-1, 0]}) == 30.0
+    assert costs.predict({}) == 30.0
+    costs.update({"ens_nums": [0], "subcycles": 20})
+    assert costs.predict({"ens_nums": [0]}) == 15.0
+
+def cost_task(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """Sleep for a while and return the input."""
+    sleep(inp.get("duration", 0.0))
+    return inp
+
+def test_runner_priority_queue():
+    """Test that the most expensive waiting work is run first."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        runner = aiorunner({"runner": {"queue": "priority"}}, 1)
+        futlist = future_list()
+        runner.set_task(cost_task)
+        runner.start()
+        for ens, steps in ((0, 1), (5, 100)):
+            futlist.add(
+                runner.submit_work({"ens_nums": [ens], "subcycles": steps})
+            )
+        futlist.as_completed()
+        futlist.as_completed()
+        # keep the worker busy while the other work is queued
+        futlist.add(runner.submit_work({"duration": 1.0}))
+        for ens in (0, 5, 0, 5):
+            futlist.add(runner.submit_work({"ens_nums": [ens]}))
+        assert "ens_nums" not in futlist.as_completed().result()
+        order = [futlist.as_completed().result()["ens_nums"][0]
+                 for _ in range(4)]
+        assert order == [5, 5, 0, 0]
+    finally:
+        runner.stop()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def test_runner_stop_no_wait():
+    """Test stopping the runner without waiting for running work."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        runner = aiorunner({}, 1)
+        futlist = future_list()
+        runner.set_task(sleeping)
+        runner.start()
+        futlist.add(runner.submit_work({"duration": 60.0}))
+        futlist.add(runner.submit_work({"duration": 60.0}))
+        assert futlist.as_completed(timeout=0.2) is None
+        assert len(futlist) == 2
+        start = time.perf_counter()
+        runner.stop(wait=False)
+        assert time.perf_counter() - start < 10.0
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
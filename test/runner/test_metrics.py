@@ -0,0 +1,80 @@
+import json
+import os
+from pathlib import PosixPath
+
+from infretis.metrics import Metrics, to_prometheus
+
+
+def md_items(pin, ens_nums, moves, start, end):
+    return {
+        "pin": pin,
+        "ens_nums": ens_nums,
+        "moves": moves,
+        "md_start": start - 0.5,
+        "task_start": start,
+        "task_end": end,
+    }
+
+
+def test_metrics_disabled():
+    """Test that nothing is recorded without a metrics file."""
+    metrics = Metrics({"output": {}})
+    metrics.record_task(md_items(0, [1], ["sh"], 1.0, 2.0))
+    with metrics.timer("treat_output"):
+        pass
+    assert not metrics.busy
+    assert not metrics.scheduler
+
+
+def test_metrics_snapshot(tmp_path: PosixPath):
+    """Test the recorded task and scheduler metrics."""
+    os.chdir(tmp_path)
+    metrics = Metrics({"output": {"metrics_file": "metrics.jsonl"}})
+    metrics.record_task(md_items(0, [1], ["wf"], 1.0, 3.0))
+    metrics.record_task(md_items(0, [-1, 0], ["sh", "sh"], 3.0, 4.0))
+    metrics.record_task(md_items(1, [1], ["wf"], 1.0, 2.0))
+    with metrics.timer("treat_output"):
+        pass
+
+    metrics.write(3)
+    metrics.write(4)
+    with open("metrics.jsonl") as read:
+        lines = read.readlines()
+    assert len(lines) == 2
+    snapshot = json.loads(lines[-1])
+    assert snapshot["cstep"] == 4
+    assert snapshot["workers"]["0"]["tasks"] == 2
+    assert snapshot["workers"]["0"]["busy"] == 3.0
+    assert snapshot["workers"]["1"]["busy"] == 1.0
+    assert snapshot["latency"] == {"count": 3, "sum": 1.5, "max": 0.5}
+    assert snapshot["ensembles"]["002"]["count"] == 2
+    assert snapshot["ensembles"]["000-001"]["sum"] == 1.0
+    assert snapshot["moves"]["wf"]["sum"] == 3.0
+    assert snapshot["moves"]["swap"]["count"] == 1
+    assert snapshot["scheduler"]["treat_output"]["count"] == 1
+
+    text = to_prometheus(snapshot)
+    assert 'infretis_worker_busy_seconds{worker="0"} 3.0' in text
+    assert "# TYPE infretis_worker_busy_seconds counter" in text
+    assert "# TYPE infretis_worker_idle_seconds gauge" in text
+    assert 'infretis_move_seconds_count{move="swap"} 1' in text
+    assert "infretis_submit_latency_seconds_sum 1.5" in text
+
+
+def test_metrics_prometheus_file(tmp_path: PosixPath):
+    """Test that the prometheus file is replaced at each write."""
+    os.chdir(tmp_path)
+    config = {
+        "output": {
+            "metrics_file": "metrics.prom",
+            "metrics_format": "prometheus",
+        }
+    }
+    metrics = Metrics(config)
+    metrics.write(1)
+    metrics.write(2)
+    with open("metrics.prom") as read:
+        text = read.read()
+    assert "infretis_cstep 2" in text
+    assert "infretis_cstep 1" not in text
+    assert os.listdir(".") == ["metrics.prom"]
@@ -0,0 +1,95 @@
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future
+
+from infretis.archive import Archiver
+from infretis.asyncrunner import future_list
+from infretis.metrics import Metrics
+from infretis.scheduler import GracefulStop, main_loop
+
+
+class StuckState:
+    """A REPEX state with one move in flight that never finishes."""
+
+    def __init__(self):
+        self.workers = 1
+        self.cstep = 0
+        self.tsteps = 10
+        self.locked = [(1, "0")]
+        self.archiver = Archiver(enabled=False)
+        self.written = False
+        self._initiated = False
+
+    def initiate(self):
+        self._initiated, initiate = True, not self._initiated
+        return initiate
+
+    def prep_md_items(self, md_items):
+        return md_items
+
+    def loop(self):
+        return True
+
+    def start_prefetch(self):
+        pass
+
+    def stop_prefetch(self):
+        pass
+
+    def treat_output(self, md_items):
+        raise AssertionError("the move in flight never finishes")
+
+    def write_toml(self):
+        self.written = True
+
+
+class StuckRunner:
+    """A runner whose futures are only done when released."""
+
+    def __init__(self):
+        self.futures = []
+        self.stopped = False
+
+    def submit_work(self, md_items):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def stop(self, wait=True):
+        self.stopped = True
+
+    def release(self):
+        for future in self.futures:
+            if not future.done():
+                future.set_result({})
+
+
+def test_stop_while_waiting():
+    """Test that a signal stops the loop while a move is still running."""
+    state = StuckState()
+    runner = StuckRunner()
+    stopper = GracefulStop(timeout=0.5)
+    stopper.install()
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGUSR1)).start()
+    # only finish the move if the loop does not stop by itself
+    release = threading.Timer(30.0, runner.release)
+    release.start()
+    start = time.monotonic()
+    try:
+        main_loop(
+            state,
+            runner,
+            future_list(),
+            {},
+            Metrics({"output": {}}),
+            stopper,
+        )
+    finally:
+        release.cancel()
+        stopper.restore()
+    # the signal, a poll and the drain timeout
+    assert time.monotonic() - start < 0.2 + stopper.poll + 0.5 + 2.0
+    assert not any(future.done() for future in runner.futures)
+    assert state.written
+    assert runner.stopped
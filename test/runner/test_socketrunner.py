@@ -0,0 +1,220 @@
+import multiprocessing
+import os
+import threading
+from pathlib import PosixPath
+from time import sleep
+from typing import Any, Dict
+
+import pytest
+
+from infretis.asyncrunner import RunnerError, future_list
+from infretis.setup import TOMLConfigError, check_config
+from infretis.socketrunner import (
+    AUTHKEY_ENV,
+    SocketRunner,
+    is_loopback,
+    parse_address,
+    runner_authkey,
+    worker_daemon,
+)
+
+AUTHKEY = "test-key"
+
+
+class UnpicklableError(Exception):
+    """An error that can't be sent back to the runner."""
+
+    def __init__(self):
+        super().__init__("Task raise unpicklable error on purpose")
+        self.lock = threading.Lock()
+
+
+def sleeping(sleep_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Sleep and return the process id of the worker."""
+    sleep(sleep_dict.get("duration", 0.1))
+    if sleep_dict.get("raise_err", False):
+        raise ValueError("Task raise error on purpose")
+    if sleep_dict.get("raise_unpicklable", False):
+        raise UnpicklableError()
+    return {"pid": os.getpid(), "pin": sleep_dict.get("pin")}
+
+
+def start_daemons(address, n_daemons, reconnect=10.0):
+    """Start worker daemons as local processes."""
+    ctx = multiprocessing.get_context("spawn")
+    daemons = []
+    for i in range(n_daemons):
+        daemon = ctx.Process(
+            target=worker_daemon, args=(address, AUTHKEY, i, reconnect)
+        )
+        daemon.start()
+        daemons.append(daemon)
+    return daemons
+
+
+def wait_for_workers(runner, n_workers, timeout=30.0):
+    """Wait until n_workers daemons are connected to the runner."""
+    for _ in range(int(timeout / 0.1)):
+        if len(runner._workers) == n_workers:
+            return
+        sleep(0.1)
+    raise TimeoutError("Worker daemons did not connect")
+
+
+def socket_config(address):
+    return {
+        "runner": {
+            "address": address,
+            "authkey": AUTHKEY,
+            "heartbeat": 0.2,
+        }
+    }
+
+
+def test_parse_address():
+    """Test parsing of TCP and Unix socket addresses."""
+    assert parse_address("localhost:8786") == ("localhost", 8786)
+    assert parse_address("unix:/tmp/infretis.sock") == "/tmp/infretis.sock"
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+
+
+def test_runner_authkey(monkeypatch, capsys):
+    """Test that a key is required for addresses other hosts can reach."""
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    assert is_loopback(parse_address("localhost:8786"))
+    assert is_loopback(parse_address("127.0.0.1:8786"))
+    assert is_loopback(parse_address("unix:/tmp/infretis.sock"))
+    assert not is_loopback(parse_address("0.0.0.0:8786"))
+    with pytest.raises(RunnerError, match="authkey"):
+        SocketRunner({"runner": {"address": "0.0.0.0:0"}})
+    with pytest.raises(RunnerError, match=AUTHKEY_ENV):
+        worker_daemon("localhost:0", None, 0, 0.0)
+
+    assert runner_authkey("key", ("0.0.0.0", 0)) == "key"
+    monkeypatch.setenv(AUTHKEY_ENV, "env-key")
+    assert runner_authkey(None, ("0.0.0.0", 0)) == "env-key"
+
+    # a random key for a loopback address, printed for the workers
+    monkeypatch.delenv(AUTHKEY_ENV)
+    authkey = runner_authkey(None, ("localhost", 0))
+    assert os.environ[AUTHKEY_ENV] == authkey
+    assert authkey in capsys.readouterr().out
+    monkeypatch.delenv(AUTHKEY_ENV)
+    assert runner_authkey(None, ("localhost", 0)) != authkey
+
+
+def test_unknown_backend():
+    """Test that an unknown runner backend is caught by check_config."""
+    config = {
+        "runner": {"workers": 1, "backend": "foo"},
+        "simulation": {
+            "interfaces": [0.0, 1.0],
+            "shooting_moves": ["sh", "sh"],
+            "tis_set": {"lambda_minus_one": False},
+            "ensemble_engines": [],
+        },
+        "current": {},
+    }
+    with pytest.raises(TOMLConfigError, match="Unknown runner backend"):
+        check_config(config)
+
+
+def test_socket_runner_local_daemons(tmp_path: PosixPath):
+    """Test dispatching work to several local worker daemons."""
+    os.chdir(tmp_path)
+    address = "unix:" + str(tmp_path / "runner.sock")
+    runner = SocketRunner(socket_config(address), 2)
+    runner.set_task(sleeping)
+    runner.start()
+    daemons = start_daemons(address, 2)
+    try:
+        wait_for_workers(runner, 2)
+        futlist = future_list()
+        for i in range(6):
+            futlist.add(runner.submit_work({"pin": i % 2}))
+        pids = {0: set(), 1: set()}
+        while (future := futlist.as_completed()) is not None:
+            result = future.result()
+            pids[result["pin"]].add(result["pid"])
+        # pinned work goes to the daemon with the same worker number
+        assert pids[0] == {daemons[0].pid}
+        assert pids[1] == {daemons[1].pid}
+
+        future = runner.submit_work({"raise_err": True})
+        with pytest.raises(ValueError):
+            future.result()
+
+        # the daemon survives an error it can't send back
+        future = runner.submit_work({"raise_unpicklable": True})
+        with pytest.raises(RunnerError, match="UnpicklableError"):
+            future.result(timeout=30)
+        assert runner.submit_work({}).result(timeout=30)["pid"] in (
+            daemons[0].pid,
+            daemons[1].pid,
+        )
+    finally:
+        runner.stop()
+        for daemon in daemons:
+            daemon.join(10)
+    assert all(daemon.exitcode == 0 for daemon in daemons)
+    assert "worker0.log" in os.listdir(".")
+    assert "worker1.log" in os.listdir(".")
+
+
+def test_socket_runner_lost_worker(tmp_path: PosixPath):
+    """Test that work of a lost worker is resubmitted to another one."""
+    os.chdir(tmp_path)
+    address = "unix:" + str(tmp_path / "runner.sock")
+    runner = SocketRunner(socket_config(address), 2)
+    runner.set_task(sleeping)
+    runner.start()
+    daemons = start_daemons(address, 2)
+    try:
+        wait_for_workers(runner, 2)
+        # wait for both workers to run something
+        futlist = future_list()
+        for pin in (0, 1):
+            futlist.add(runner.submit_work({"pin": pin, "duration": 0.5}))
+        futlist.as_completed()
+        futlist.as_completed()
+
+        future = runner.submit_work({"pin": 0, "duration": 3.0})
+        sleep(0.5)
+        daemons[0].kill()
+        assert future.result(timeout=30)["pid"] == daemons[1].pid
+    finally:
+        runner.stop()
+        for daemon in daemons:
+            daemon.join(10)
+
+
+def test_socket_runner_stop_without_workers(tmp_path: PosixPath):
+    """Test that stopping without connected daemons drops the work."""
+    os.chdir(tmp_path)
+    address = "unix:" + str(tmp_path / "runner.sock")
+    runner = SocketRunner(socket_config(address), 1)
+    runner.set_task(sleeping)
+    runner.start()
+    future = runner.submit_work({"pin": 0})
+    runner.stop()
+    with pytest.raises(RunnerError, match="stopped"):
+        future.result(timeout=1)
+
+
+def test_worker_daemon_reconnect(tmp_path: PosixPath):
+    """Test that daemons started before the runner connect once it is up."""
+    os.chdir(tmp_path)
+    address = "unix:" + str(tmp_path / "runner.sock")
+    daemons = start_daemons(address, 1)
+    sleep(1.0)
+    runner = SocketRunner(socket_config(address), 1)
+    runner.set_task(sleeping)
+    runner.start()
+    try:
+        future = runner.submit_work({"pin": 0})
+        assert future.result(timeout=30)["pid"] == daemons[0].pid
+    finally:
+        runner.stop()
+        daemons[0].join(10)
+    assert daemons[0].exitcode == 0
@@ -53,6 +53,21 @@ def test_check_config():
         (["simulation", "interfaces"], [0.0, 0.5, 0.2, 1.0]),
         (["simulation", "interfaces"], [0.0, 0.2, 0.2, 1.0]),
         (["simulation", "interfaces"], []),
+        (["output", "checkpoint"], "json"),
+        (["output", "checkpoint_compact"], 0),
+        (["output", "data_flush"], -1.0),
+        (["output", "path_format"], "hdf5"),
+        (["simulation", "load_workers"], 0),
+        (["runner", "max_retries"], -1),
+        (["runner", "affinity"], "yes"),
+        (["simulation", "prefetch_prob"], 1),
+        (["simulation", "prob_cache"], -1),
+        (["simulation", "prob_cache"], 12.5),
+        (["simulation", "max_exact_block"], True),
+        (["simulation", "random_tol"], 0.0),
+        (["simulation", "random_tol"], "0.01"),
+        (["runner", "heartbeat"], -5.0),
+        (["runner", "heartbeat_timeout"], 0),
     ]
     for keys, invalid_value in test_cases:
         config = copy.deepcopy(original_config)
@@ -2,15 +2,21 @@
 import difflib
 import filecmp
 import os
+import re
 import shutil
+import signal
+import threading
+import time
 from pathlib import PosixPath
 from subprocess import STDOUT, check_output
 
+import numpy as np
 import pytest
 import tomli
 import tomli_w
 
 from infretis.bin import internalrun
+from infretis.data import read_data
 
 def get_diff_data(inp1, inp2):
     "Check the difference between two infretis_data.txt files in a simple way."
@@ -64,6 +70,37 @@ def rm_restarted_from(inp):
         tomli_w.dump(config, f)
 
 
+def setup_wf_run(tmp_path: PosixPath, overrides=None) -> PosixPath:
+    """Set up the wire fencing double well run of data/wf.toml.
+
+    Args:
+        tmp_path: the directory to run in
+        overrides: the settings to change, as {section: {key: value}}
+
+    Returns:
+        The directory of this file, with the reference data.
+    """
+    folder = tmp_path / "temp"
+    folder.mkdir()
+    basepath = PosixPath(__file__).parent
+    load_dir = (
+        basepath / "../../examples/turtlemd/double_well/load_copy"
+    ).resolve()
+    shutil.copytree(str(load_dir), str(folder) + "/load")
+    shutil.copy(str(load_dir / "../orderp.py"), str(folder))
+    shutil.copy(str(basepath / "data/wf.toml"), str(folder) + "/infretis.toml")
+    os.chdir(folder)
+
+    if overrides:
+        with open("infretis.toml", mode="rb") as f:
+            config = tomli.load(f)
+        for section, values in overrides.items():
+            config[section].update(values)
+        with open("infretis.toml", "wb") as f:
+            tomli_w.dump(config, f)
+    return basepath
+
+
 @pytest.mark.heavy
 def test_run_airetis_wf(tmp_path: PosixPath) -> None:
     folder = tmp_path / "temp"
@@ -199,3 +236,193 @@ def test_restart_multiple_w(tmp_path: PosixPath) -> None:
     dirs = os.listdir(".")
     for i in range(workers):
         assert f"worker{i}.log" in dirs
+
+
+@pytest.mark.heavy
+def test_run_speculative(tmp_path: PosixPath) -> None:
+    """Check a simulation with speculative moves on extra workers."""
+    setup_wf_run(
+        tmp_path,
+        {
+            "simulation": {"steps": 30},
+            "runner": {"workers": 2, "speculative": 2},
+        },
+    )
+
+    isnone = internalrun("infretis.toml")
+    assert isnone is None
+
+    with open("restart.toml", mode="rb") as f:
+        config = tomli.load(f)
+    assert config["current"]["cstep"] == 30
+    assert len(config["current"]["wsubcycles"]) == 4
+    # speculative moves were run, and all of them were used or discarded
+    with open("sim.log") as f:
+        stats = re.search(
+            r"speculative moves: (\d+) submitted, (\d+) used and (\d+) disc",
+            f.read(),
+        )
+    submitted, used, discarded = (int(i) for i in stats.groups())
+    assert submitted > 0
+    assert used > 0
+    assert used + discarded == submitted
+
+    # the folders of speculative moves are all cleaned up
+    for i in range(4):
+        assert not [d for d in os.listdir(f"worker{i}") if "spec" in d]
+
+
+@pytest.mark.heavy
+def test_run_prefetch(tmp_path: PosixPath) -> None:
+    """Check that prefetching the P matrices gives the same results."""
+    basepath = setup_wf_run(tmp_path, {"simulation": {"prefetch_prob": True}})
+
+    isnone = internalrun("infretis.toml")
+    assert isnone is None
+    assert filecmp.cmp(
+        "./infretis_data.txt", f"{basepath}/data/10steps_wf/infretis_data.txt"
+    )
+    with open("sim.log") as f:
+        assert "P matrices of rejected moves are prefetched" in f.read()
+
+
+@pytest.mark.heavy
+def test_run_checkpoint_log(tmp_path: PosixPath) -> None:
+    """Check that a run with the checkpoint log gives the same restarts."""
+    basepath = setup_wf_run(
+        tmp_path, {"output": {"checkpoint": "log", "checkpoint_compact": 4}}
+    )
+
+    for steps in (10, 20):
+        inp = "infretis.toml" if steps == 10 else "restart.toml"
+        change_toml_steps(inp, steps)
+        isnone = internalrun(inp)
+        assert isnone is None
+        if steps == 20:
+            rm_restarted_from("restart.toml")
+        assert filecmp.cmp(
+            "./infretis_data.txt",
+            f"{basepath}/data/{steps}steps_wf/infretis_data.txt",
+        )
+        with open("restart.toml", mode="rb") as f:
+            current = tomli.load(f)["current"]
+        with open(f"{basepath}/data/{steps}steps_wf/restart.toml", "rb") as f:
+            assert current == tomli.load(f)["current"]
+        # the run stopped, so the log is in restart.toml
+        assert os.path.getsize("restart.jsonl") == 0
+
+
+@pytest.mark.heavy
+def test_run_data_buffered(tmp_path: PosixPath) -> None:
+    """Check the buffered data file and its binary file."""
+    basepath = setup_wf_run(
+        tmp_path, {"output": {"data_flush": 1000.0, "data_binary": True}}
+    )
+
+    isnone = internalrun("infretis.toml")
+    assert isnone is None
+    assert filecmp.cmp(
+        "./infretis_data.txt", f"{basepath}/data/10steps_wf/infretis_data.txt"
+    )
+    text = read_data("infretis_data.txt", binary=False)
+    binary = read_data("infretis_data.txt")
+    assert len(text) > 0
+    for field in ("pn", "length", "max_op", "frac", "weights"):
+        assert np.allclose(
+            text[field], binary[field], atol=1e-5, equal_nan=True
+        )
+
+
+@pytest.mark.heavy
+def test_run_archive_async(tmp_path: PosixPath) -> None:
+    """Check that archiving the paths in a thread gives the same run."""
+    basepath = setup_wf_run(
+        tmp_path,
+        {"output": {"archive_async": True}, "simulation": {"steps": 20}},
+    )
+
+    isnone = internalrun("infretis.toml")
+    assert isnone is None
+    assert filecmp.cmp(
+        "./infretis_data.txt", f"{basepath}/data/20steps_wf/infretis_data.txt"
+    )
+    with open("restart.toml", mode="rb") as f:
+        current = tomli.load(f)["current"]
+    for pn in current["active"]:
+        assert os.path.isfile(os.path.join("load", str(pn), "traj.txt"))
+    # the old paths are deleted as without the thread
+    assert len(os.listdir("load")) < 40
+
+
+@pytest.mark.heavy
+def test_run_path_archive(tmp_path: PosixPath) -> None:
+    """Check a run that stores the paths in the binary format."""
+    basepath = setup_wf_run(tmp_path, {"output": {"path_format": "npz"}})
+
+    isnone = internalrun("infretis.toml")
+    assert isnone is None
+    assert filecmp.cmp(
+        "./infretis_data.txt", f"{basepath}/data/10steps_wf/infretis_data.txt"
+    )
+
+    # restart from the binary paths
+    change_toml_steps("restart.toml", 20)
+    isnone = internalrun("restart.toml")
+    assert isnone is None
+    with open("restart.toml", mode="rb") as f:
+        current = tomli.load(f)["current"]
+    assert current["cstep"] == 20
+    archived = [
+        pn for pn in current["active"] if pn >= len(current["active"])
+    ]
+    assert archived
+    for pn in archived:
+        pdir = os.path.join("load", str(pn))
+        assert sorted(os.listdir(pdir)) == ["accepted", "path.npz"]
+
+
+def signal_at_step(step: int, signum: int = signal.SIGUSR1) -> None:
+    """Send a signal to this process once restart.toml reaches step."""
+    while True:
+        time.sleep(0.1)
+        try:
+            with open("restart.toml", mode="rb") as f:
+                cstep = tomli.load(f)["current"]["cstep"]
+        except (OSError, KeyError, tomli.TOMLDecodeError):
+            # the file is being written
+            continue
+        if cstep >= step:
+            os.kill(os.getpid(), signum)
+            return
+
+
+@pytest.mark.heavy
+def test_run_stop_on_signal(tmp_path: PosixPath) -> None:
+    """Check that a run stops cleanly on a signal and can be restarted."""
+    setup_wf_run(
+        tmp_path,
+        {"simulation": {"steps": 2000}, "runner": {"drain_timeout": 60.0}},
+    )
+
+    threading.Thread(target=signal_at_step, args=(5,), daemon=True).start()
+    internalrun("infretis.toml")
+    # the default handler is back after the run
+    assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+
+    with open("restart.toml", mode="rb") as f:
+        config = tomli.load(f)
+    cstep = config["current"]["cstep"]
+    assert 5 <= cstep < 2000
+    # all the moves in flight finished within the drain timeout
+    assert config["current"]["locked"] == []
+    with open("sim.log") as f:
+        assert "stopped at step" in f.read()
+
+    # continue from the checkpoint
+    config["simulation"]["steps"] = cstep + 5
+    with open("restart.toml", "wb") as f:
+        tomli_w.dump(config, f)
+    internalrun("restart.toml")
+    with open("restart.toml", mode="rb") as f:
+        config = tomli.load(f)
+    assert config["current"]["cstep"] == cstep + 5
@@ -1,18 +1,23 @@
 """Test methods for doing TIS."""
 import os
+import pickle
+import shutil
+import threading
 from typing import Callable, Tuple
 from pathlib import PosixPath
 
 import numpy as np
 import pytest
 
+from infretis.archive import Archiver
 from infretis.classes.engines.engineparts import read_xyz_file
 from infretis.classes.engines.factory import create_engine
 from infretis.classes.engines.turtlemdengine import TurtleMDEngine
+from infretis.classes.formatter import PATH_ARCHIVE, PathStorage
 from infretis.classes.orderparameter import create_orderparameters
 
 # from infretis.classes.path import Path, restart_path
-from infretis.classes.path import Path, load_path
+from infretis.classes.path import Path, load_path, load_paths_from_disk
 from infretis.classes.path import Path as InfPath
 from infretis.classes.system import System
 from infretis.core.tis import (
@@ -618,3 +623,102 @@ class MockRandomGenerator():
                         _ = p.pop(idx)
                     break
         return out
+
+
+def test_path_pickle_roundtrip() -> None:
+    """Test that pickling a path with packed phase points is lossless."""
+    path = INP_PATH.copy()
+    path.path_number = 7
+    path.weights = (1.0, 0.0)
+    path.phasepoints[3].box = np.eye(3)
+    path.phasepoints[4].ekin = None
+    data = pickle.dumps(path)
+    assert len(data) < len(pickle.dumps(path.phasepoints))
+    new_path = pickle.loads(data)
+    for key in ("path_number", "weights", "maxlen", "generated", "length"):
+        assert getattr(new_path, key) == getattr(path, key)
+    for point, new_point in zip(path.phasepoints, new_path.phasepoints):
+        assert type(new_point) is System
+        assert point.__dict__.keys() == new_point.__dict__.keys()
+        for key, value in point.__dict__.items():
+            assert np.array_equal(value, new_point.__dict__[key])
+            assert type(value) is type(new_point.__dict__[key])
+
+    # phase points with extra attributes are pickled as they are
+    path.phasepoints[0].extra = "extra"
+    new_path = pickle.loads(pickle.dumps(path))
+    assert new_path.phasepoints[0].extra == "extra"
+
+
+def test_path_archive(tmp_path: PosixPath) -> None:
+    """Test that the binary path format loads like the text files."""
+    loaded = {}
+    for path_format in ("txt", "npz"):
+        source = tmp_path / path_format
+        shutil.copytree(PATH_DIR_2 / "0", source)
+        path = load_path(str(source))
+        path.path_number = 5
+        pstore = PathStorage()
+        pstore.path_format = path_format
+        pstore.output(0, {"path": path, "dir": str(tmp_path / "load")})
+        pdir = tmp_path / "load" / "5"
+        assert os.path.isfile(pdir / PATH_ARCHIVE) == (path_format == "npz")
+        assert os.path.isfile(pdir / "order.txt") == (path_format == "txt")
+        loaded[path_format] = load_path(str(pdir))
+        shutil.rmtree(pdir)
+
+    txt, npz = loaded["txt"], loaded["npz"]
+    assert npz.length == txt.length > 0
+    for point, new_point in zip(txt.phasepoints, npz.phasepoints):
+        # the text files round the order parameters
+        assert np.allclose(point.order, new_point.order, atol=1e-6)
+        assert point.config == new_point.config
+        assert point.vel_rev == new_point.vel_rev
+        for key in ("ekin", "vpot", "etot", "temp"):
+            assert np.allclose(
+                getattr(point, key), getattr(new_point, key), equal_nan=True
+            )
+
+
+def test_path_storage_archiver(tmp_path: PosixPath) -> None:
+    """Test that the trajectories are moved before the path files."""
+    source = tmp_path / "worker0"
+    shutil.copytree(PATH_DIR_2 / "0", source)
+    path = load_path(str(source))
+    path.path_number = 5
+    trajs = {pp.config[0] for pp in path.phasepoints}
+    # hold the archiver until the path is stored
+    archiver = Archiver()
+    release = threading.Event()
+    archiver.submit(release.wait)
+    pstore = PathStorage()
+    pstore.output(
+        0, {"path": path, "dir": str(tmp_path / "load")}, archiver=archiver
+    )
+    pdir = tmp_path / "load" / "5"
+    assert not any(os.path.isfile(traj) for traj in trajs)
+    assert sorted(os.listdir(pdir / "accepted")) == sorted(
+        os.path.basename(traj) for traj in trajs
+    )
+    assert not os.path.isfile(pdir / "traj.txt")
+    release.set()
+    archiver.close()
+    assert os.path.isfile(pdir / "traj.txt")
+
+
+def test_load_paths_from_disk() -> None:
+    """Test that loading the paths in threads keeps their order."""
+    config = {
+        "simulation": {"load_dir": str(PATH_DIR_2), "tis_set": {}},
+        "current": {"active": [3, 0, 2, 1]},
+    }
+    config["simulation"]["tis_set"]["maxlength"] = 100
+    loaded = {}
+    for workers in (1, 4):
+        config["simulation"]["load_workers"] = workers
+        loaded[workers] = load_paths_from_disk(config)
+    for path, new_path in zip(loaded[1], loaded[4]):
+        assert path.path_number == new_path.path_number
+        orders = [pp.order for pp in path.phasepoints]
+        assert np.array_equal(orders, [pp.order for pp in new_path.phasepoints])
+    assert [path.path_number for path in loaded[4]] == [3, 0, 2, 1]